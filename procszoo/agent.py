@@ -0,0 +1,474 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+A resident agent that runs commands in a sandbox on behalf of the host.
+
+The agent is the init of a new sandbox, instead of my_init, or joins the
+namespaces of a running sandbox alongside its init. It reads requests
+from a socket that it inherited, so a command costs one fork and one exec
+of the agent, instead of new namespaces or a setns(2) of each of them.
+The stdin/stdout/stderr of a command are passed to the agent with
+SCM_RIGHTS, by default memfds that the host reads after the command
+exits. The agent replies with the wait status and the rusage of the
+command, and, being the init of the sandbox, reaps orphans.
+"""
+
+import os
+import json
+import time
+import fcntl
+import errno
+import select
+import signal
+import socket
+import tempfile
+import threading
+from collections import namedtuple
+
+from procszoo.utils import workbench, _fork, _poll, _exit_status, \
+    _dup_stdio, _close_cloexec_fds, CFunctionNotFound
+from procszoo.executor import Future
+
+__all__ = ["SandboxAgent", "CommandResult", "AgentError"]
+
+_MAX_MSG_SIZE = 65536
+_MAX_FDS = 3
+
+CommandResult = namedtuple("CommandResult", [
+    "pid", "returncode", "status", "stdout", "stderr", "rusage",
+    "elapsed", "timed_out"])
+
+_RUSAGE_FIELDS = ["ru_utime", "ru_stime", "ru_maxrss", "ru_minflt",
+                  "ru_majflt", "ru_inblock", "ru_oublock", "ru_nvcsw",
+                  "ru_nivcsw"]
+
+class AgentError(RuntimeError):
+    pass
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _str(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+def _returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _scratch_fd(data=None):
+    """
+    return an anonymous file descriptor, a memfd if the kernel has it
+    """
+    try:
+        fd = workbench.memfd_create("procszoo-agent")
+    except (CFunctionNotFound, OSError):
+        hdr = tempfile.TemporaryFile()
+        fd = os.dup(hdr.fileno())
+        hdr.close()
+        _set_cloexec(fd)
+    if data:
+        os.write(fd, data)
+        os.lseek(fd, 0, os.SEEK_SET)
+    return fd
+
+def _read_all(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    chunks = []
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return "".join(chunks)
+        chunks.append(chunk)
+
+def _environ(pid):
+    hdr = open("/proc/%d/environ" % pid, 'r')
+    try:
+        data = hdr.read()
+    finally:
+        hdr.close()
+    return dict(item.split("=", 1) for item in data.split("\0")
+                if "=" in item)
+
+class _Agent(object):
+    """
+    the loop that runs in the sandbox
+    """
+    def __init__(self, sock, environ=None):
+        self.sock = sock
+        if environ is None:
+            environ = dict(os.environ)
+        self.environ = environ
+        self.children = {}
+
+    def serve(self):
+        _set_cloexec(self.sock.fileno())
+        wakeup_r, wakeup_w = os.pipe()
+        for fd in [wakeup_r, wakeup_w]:
+            _set_cloexec(fd)
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # a handler is needed for the wakeup fd to see SIGCHLD
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(wakeup_w)
+
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN)
+        poller.register(wakeup_r, select.POLLIN)
+        while True:
+            for fd, event in _poll(poller, self._poll_timeout()):
+                if fd == wakeup_r:
+                    try:
+                        while os.read(wakeup_r, 512):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    data, fds = workbench.recv_fds(
+                        self.sock, _MAX_MSG_SIZE, _MAX_FDS)
+                except RuntimeError:
+                    data, fds = "", []
+                if not data:
+                    self._kill_all()
+                    return
+                self._handle(data, fds)
+            self._reap()
+            self._expire()
+
+    def _poll_timeout(self):
+        deadlines = [child["deadline"] for child in self.children.values()
+                     if child["deadline"] is not None]
+        if not deadlines:
+            return None
+        return max(0, int((min(deadlines) - time.time()) * 1000) + 1)
+
+    def _handle(self, data, fds):
+        request = {}
+        try:
+            try:
+                request = json.loads(data)
+                if request.get("op") != "run":
+                    raise AgentError("unknown request: %s"
+                                     % request.get("op"))
+                if len(fds) != 3:
+                    raise AgentError("three stdio fds are expected")
+                self._run(request, fds)
+            except Exception, e:
+                self._reply({"id": request.get("id"), "error": "%s" % e})
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _run(self, request, fds):
+        env = self.environ
+        if request.get("env"):
+            env = dict(env)
+            env.update((_str(k), _str(v)) for k, v in request["env"].items())
+        argv = [_str(arg) for arg in request["argv"]]
+        cwd = request.get("cwd")
+        if cwd is not None:
+            cwd = _str(cwd)
+        pid = _fork()
+        if pid == 0:
+            try:
+                signal.set_wakeup_fd(-1)
+                for signum in [signal.SIGCHLD, signal.SIGPIPE]:
+                    signal.signal(signum, signal.SIG_DFL)
+                # the whole command could be killed on timeout
+                os.setpgid(0, 0)
+                _dup_stdio(fds)
+                if cwd is not None:
+                    os.chdir(cwd)
+                os.execvpe(argv[0], argv, env)
+            except BaseException, e:
+                try:
+                    os.write(2, "%s: %s\n" % (argv[0], e))
+                finally:
+                    os._exit(127)
+
+        deadline = None
+        if request.get("timeout") is not None:
+            deadline = time.time() + request["timeout"]
+        self.children[pid] = {"id": request["id"], "start": time.time(),
+                              "deadline": deadline, "timed_out": False}
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if pid == 0:
+                return
+            # as the init of the sandbox, we also reap orphans
+            child = self.children.pop(pid, None)
+            if child is None:
+                continue
+            self._reply({
+                "id": child["id"],
+                "pid": pid,
+                "status": status,
+                "rusage": dict((name, getattr(rusage, name))
+                               for name in _RUSAGE_FIELDS),
+                "elapsed": time.time() - child["start"],
+                "timed_out": child["timed_out"]})
+
+    def _expire(self):
+        now = time.time()
+        for pid, child in self.children.items():
+            if child["deadline"] is None or child["deadline"] > now:
+                continue
+            child["deadline"] = None
+            child["timed_out"] = True
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _kill_all(self):
+        for pid in self.children:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            self.children.pop(pid, None)
+
+    def _reply(self, reply):
+        try:
+            workbench.send_fds(self.sock, json.dumps(reply))
+        except RuntimeError:
+            pass
+
+class SandboxAgent(object):
+    """
+    E.g., a new sandbox whose init is the agent,
+        agent = SandboxAgent(namespaces=["pid", "mount", "net"])
+        agent.start()
+        result = agent.run(["ip", "link"])
+        print result.returncode, result.stdout, result.rusage["ru_utime"]
+        future = agent.submit(["sleep", "1"], timeout=10)
+        ...
+        agent.stop()
+
+    or an agent alongside the init of a running sandbox, target is a pid
+    or a ns_bind_dir like the one of enter_namespaces,
+        agent = SandboxAgent(target=1234)
+
+    kwargs are passed to spawn_plan for a new sandbox. Commands run with
+    the environment of the agent, i.e., ours for a new sandbox and the one
+    of target if it is a pid, updated by env. The agent runs the commands
+    concurrently and is thread safe.
+    """
+    def __init__(self, target=None, namespaces=None, **kwargs):
+        self.target = target
+        self.namespaces = namespaces
+        self.kwargs = kwargs
+        self.pid = None
+        self.sock = None
+        self._next_id = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._reader = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self.pid is not None:
+            return
+        sock, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        _set_cloexec(sock.fileno())
+        try:
+            if self.target is None:
+                self.pid = self._spawn(child)
+            else:
+                self.pid = self._attach(child)
+        except:
+            sock.close()
+            raise
+        finally:
+            child.close()
+        self.sock = sock
+        self._reader = threading.Thread(target=self._read_replies)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _spawn(self, child):
+        kwargs = dict(self.kwargs)
+        if self.namespaces is not None:
+            kwargs["namespaces"] = self.namespaces
+        plan = workbench.spawn_plan(**kwargs)
+        return plan.launch(target=_Agent(child).serve)
+
+    def _attach(self, child):
+        ns_files = workbench._ns_files_of_target(self.target,
+                                                 self.namespaces)
+        environ = None
+        if isinstance(self.target, int) or isinstance(self.target, long):
+            environ = _environ(self.target)
+        pid = _fork()
+        if pid == 0:
+            try:
+                _close_cloexec_fds()
+                entered = workbench._enter_ns_files(ns_files)
+                if "pid" in entered:
+                    pid = _fork()
+                    if pid > 0:
+                        child.close()
+                        pid, status = os.waitpid(pid, 0)
+                        os._exit(_exit_status(status))
+                _Agent(child, environ).serve()
+            except BaseException:
+                os._exit(1)
+            os._exit(0)
+        return pid
+
+    def submit(self, argv, env=None, cwd=None, input=None, stdin=None,
+               stdout=None, stderr=None, timeout=None):
+        """
+        run argv in the sandbox, return a Future of a CommandResult.
+
+        stdin, stdout and stderr are file descriptors for the command,
+        by default stdin is empty or input, and stdout and stderr are
+        captured in the CommandResult. After timeout seconds the process
+        group of the command is killed.
+        """
+        if self.sock is None:
+            raise AgentError("agent is not started")
+        if isinstance(argv, basestring):
+            argv = [argv]
+        own_fds = []
+        try:
+            if stdin is None:
+                stdin = _scratch_fd(input)
+                own_fds.append(stdin)
+            capture_stdout = stdout is None
+            if capture_stdout:
+                stdout = _scratch_fd()
+                own_fds.append(stdout)
+            capture_stderr = stderr is None
+            if capture_stderr:
+                stderr = _scratch_fd()
+                own_fds.append(stderr)
+        except:
+            for fd in own_fds:
+                os.close(fd)
+            raise
+
+        future = Future()
+        self._lock.acquire()
+        try:
+            request_id = self._next_id
+            self._next_id += 1
+            self._pending[request_id] = (
+                future, own_fds, stdout if capture_stdout else None,
+                stderr if capture_stderr else None)
+            request = {"op": "run", "id": request_id, "argv": list(argv),
+                       "env": env, "cwd": cwd, "timeout": timeout}
+            try:
+                workbench.send_fds(self.sock, json.dumps(request),
+                                   [stdin, stdout, stderr])
+            except:
+                del self._pending[request_id]
+                for fd in own_fds:
+                    os.close(fd)
+                raise
+        finally:
+            self._lock.release()
+        return future
+
+    def run(self, argv, **kwargs):
+        """
+        run argv in the sandbox and return its CommandResult, kwargs are
+        the ones of submit
+        """
+        return self.submit(argv, **kwargs).result()
+
+    def _read_replies(self):
+        while True:
+            try:
+                data, fds = workbench.recv_fds(
+                    self.sock, _MAX_MSG_SIZE, _MAX_FDS)
+            except RuntimeError:
+                data, fds = "", []
+            for fd in fds:
+                os.close(fd)
+            if not data:
+                break
+            reply = json.loads(data)
+            self._lock.acquire()
+            try:
+                pending = self._pending.pop(reply.get("id"), None)
+            finally:
+                self._lock.release()
+            if pending is None:
+                continue
+            future, own_fds, stdout, stderr = pending
+            try:
+                if reply.get("error"):
+                    error = AgentError(reply["error"])
+                    if future.set_running_or_notify_cancel():
+                        future.set_exception(error)
+                    continue
+                result = CommandResult(
+                    reply["pid"], _returncode(reply["status"]),
+                    reply["status"],
+                    _read_all(stdout) if stdout is not None else None,
+                    _read_all(stderr) if stderr is not None else None,
+                    reply["rusage"], reply["elapsed"], reply["timed_out"])
+                if future.set_running_or_notify_cancel():
+                    future.set_result(result)
+            finally:
+                for fd in own_fds:
+                    os.close(fd)
+
+        self._lock.acquire()
+        try:
+            pending = self._pending.values()
+            self._pending = {}
+        finally:
+            self._lock.release()
+        for future, own_fds, stdout, stderr in pending:
+            for fd in own_fds:
+                os.close(fd)
+            if future.set_running_or_notify_cancel():
+                future.set_exception(AgentError("the agent has exited"))
+
+    def stop(self):
+        """
+        close the socket, the agent kills the commands that are running
+        and exits
+        """
+        if self.pid is None:
+            return
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._reader.join()
+        self.sock.close()
+        self.sock = None
+        self._reader = None
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        self.pid = None
@@ -0,0 +1,269 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Capture stdout/stderr of many spawned namespaces with one reader thread.
+"""
+
+import os
+import pty
+import time
+import fcntl
+import errno
+import select
+import threading
+from collections import deque
+
+from procszoo.utils import workbench
+
+__all__ = ["StdioCollector", "RingBuffer"]
+
+_READ_SIZE = 65536
+_BUFFER_SIZE = 1 << 20
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _set_nonblock(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class RingBuffer(object):
+    """
+    keep the last size bytes that are appended
+    """
+    def __init__(self, size=_BUFFER_SIZE):
+        self.size = size
+        self.length = 0
+        self.dropped = 0
+        self._chunks = deque()
+
+    def append(self, data):
+        self._chunks.append(data)
+        self.length += len(data)
+        while self.length > self.size:
+            chunk = self._chunks.popleft()
+            excess = self.length - self.size
+            if len(chunk) > excess:
+                self._chunks.appendleft(chunk[excess:])
+                chunk = chunk[:excess]
+            self.length -= len(chunk)
+            self.dropped += len(chunk)
+
+    def getvalue(self):
+        return "".join(self._chunks)
+
+class _Stream(object):
+    def __init__(self, pid, name, fd, buffer_size):
+        self.pid = pid
+        self.name = name
+        self.fd = fd
+        self.buffer = RingBuffer(buffer_size)
+        self.closed = False
+
+class StdioCollector(object):
+    """
+    E.g.,
+        collector = StdioCollector()
+        pid = collector.spawn(nscmd=["ls", "-l"])
+        os.waitpid(pid, 0)
+        collector.wait_eof(pid)
+        print collector.output(pid)
+
+    stdout and stderr of each sandbox are kept in ring buffers of
+    buffer_size bytes, or passed to callback(pid, name, data) in the reader
+    thread, name is "stdout" or "stderr", data is "" at EOF. With
+    stdio="pty", nscmd runs in a new session whose controlling terminal
+    is a pseudo terminal, and both go to "stdout".
+    """
+    def __init__(self, buffer_size=_BUFFER_SIZE, callback=None):
+        self.buffer_size = buffer_size
+        self.callback = callback
+        self.streams = {}
+        self._fds = {}
+        self._lock = threading.Condition()
+        self._epoll = select.epoll()
+        self._stop_r, self._stop_w = os.pipe()
+        for fd in self._stop_r, self._stop_w:
+            _set_cloexec(fd)
+        self._epoll.register(self._stop_r, select.EPOLLIN)
+        self._thread = None
+
+    def _pipes(self, stdio):
+        if stdio == "pty":
+            master, slave = pty.openpty()
+            child_fds = [slave, slave, slave]
+            parent_fds = [("stdout", master)]
+            close_fds = [slave]
+        elif stdio == "pipe":
+            stdin = os.open(os.devnull, os.O_RDONLY)
+            stdout_r, stdout_w = os.pipe()
+            stderr_r, stderr_w = os.pipe()
+            child_fds = [stdin, stdout_w, stderr_w]
+            parent_fds = [("stdout", stdout_r), ("stderr", stderr_r)]
+            close_fds = child_fds
+        else:
+            raise ValueError("stdio should be 'pipe' or 'pty'")
+        for fd in close_fds + [fd for name, fd in parent_fds]:
+            _set_cloexec(fd)
+        return child_fds, parent_fds, close_fds
+
+    def launch(self, plan, nscmd=None, stdio="pipe"):
+        """
+        launch a SpawnPlan with captured stdio, return the pid
+        """
+        return self._spawn(stdio, lambda fds: plan.launch(
+            nscmd, stdio=fds, ctty=(stdio == "pty")))
+
+    def spawn(self, stdio="pipe", **kwargs):
+        """
+        spawn_namespaces(**kwargs) with captured stdio, return the pid
+        """
+        return self.launch(workbench.spawn_plan(**kwargs), stdio=stdio)
+
+    def _spawn(self, stdio, spawn):
+        child_fds, parent_fds, close_fds = self._pipes(stdio)
+        try:
+            pid = spawn(child_fds)
+        except:
+            for name, fd in parent_fds:
+                os.close(fd)
+            raise
+        finally:
+            for fd in close_fds:
+                os.close(fd)
+
+        self._lock.acquire()
+        try:
+            self.streams[pid] = {}
+            for name, fd in parent_fds:
+                _set_nonblock(fd)
+                stream = _Stream(pid, name, fd, self.buffer_size)
+                self.streams[pid][name] = stream
+                self._fds[fd] = stream
+                self._epoll.register(fd, select.EPOLLIN)
+        finally:
+            self._lock.release()
+        self._start()
+        return pid
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                events = self._epoll.poll()
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._stop_r:
+                    return
+                self._read(fd)
+
+    def _read(self, fd):
+        while True:
+            # read under the lock, forget() could close the fd and its
+            # number could be reused by another stream
+            self._lock.acquire()
+            try:
+                stream = self._fds.get(fd)
+                if stream is None or stream.closed:
+                    return
+                try:
+                    data = os.read(fd, _READ_SIZE)
+                except OSError, e:
+                    if e.errno == errno.EAGAIN:
+                        return
+                    if e.errno == errno.EINTR:
+                        continue
+                    data = ""
+                if not data:
+                    self._close(stream)
+            finally:
+                self._lock.release()
+            self._deliver(stream, data)
+            if len(data) < _READ_SIZE:
+                return
+
+    def _close(self, stream):
+        # with the lock held
+        if self._fds.get(stream.fd) is stream:
+            self._epoll.unregister(stream.fd)
+            del self._fds[stream.fd]
+            os.close(stream.fd)
+        stream.closed = True
+        self._lock.notify_all()
+
+    def _deliver(self, stream, data):
+        if self.callback is not None:
+            self.callback(stream.pid, stream.name, data)
+        elif data:
+            self._lock.acquire()
+            try:
+                stream.buffer.append(data)
+            finally:
+                self._lock.release()
+
+    def output(self, pid, name="stdout"):
+        """
+        return what is kept in the buffer of the stream
+        """
+        self._lock.acquire()
+        try:
+            return self.streams[pid][name].buffer.getvalue()
+        finally:
+            self._lock.release()
+
+    def wait_eof(self, pid, timeout=None):
+        """
+        wait until every stream of pid is closed, return True if so
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._lock.acquire()
+        try:
+            while [stream for stream in self.streams[pid].values()
+                   if not stream.closed]:
+                if deadline is None:
+                    self._lock.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+            return not [stream for stream in self.streams[pid].values()
+                        if not stream.closed]
+        finally:
+            self._lock.release()
+
+    def forget(self, pid):
+        """
+        drop the buffers of pid, the streams that are still open are closed
+        """
+        self._lock.acquire()
+        try:
+            for stream in self.streams.pop(pid, {}).values():
+                if not stream.closed:
+                    self._close(stream)
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        if self._thread is not None:
+            os.write(self._stop_w, "x")
+            self._thread.join()
+            self._thread = None
+        for pid in self.streams.keys():
+            self.forget(pid)
+        self._epoll.close()
+        os.close(self._stop_r)
+        os.close(self._stop_w)
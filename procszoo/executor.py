@@ -0,0 +1,346 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+An Executor whose workers live in their own namespaces.
+
+Each worker is spawned once by a SpawnPlan and then runs many pickled
+tasks, so a task costs a round trip on a unix socket.
+"""
+
+import os
+import fcntl
+import pickle
+import socket
+import struct
+import threading
+import traceback
+import Queue
+
+try:
+    from concurrent.futures import Executor, Future, CancelledError, \
+        TimeoutError
+except ImportError:
+    _futures_module_available = False
+else:
+    _futures_module_available = True
+
+from procszoo.utils import workbench
+
+__all__ = ["NamespacesExecutor", "WorkerCrashed", "Future", "CancelledError",
+           "TimeoutError"]
+
+_HEADER = struct.Struct("!I")
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+if not _futures_module_available:
+    class CancelledError(Exception):
+        pass
+
+    class TimeoutError(Exception):
+        pass
+
+    class Future(object):
+        """
+        the subset of concurrent.futures.Future that we need when the
+        futures module is not installed
+        """
+        def __init__(self):
+            self._condition = threading.Condition()
+            self._done = False
+            self._cancelled = False
+            self._running = False
+            self._result = None
+            self._exception = None
+            self._callbacks = []
+
+        def cancel(self):
+            self._condition.acquire()
+            try:
+                if self._running or self._done:
+                    return self._cancelled
+                self._cancelled = True
+                self._done = True
+                self._condition.notify_all()
+            finally:
+                self._condition.release()
+            self._invoke_callbacks()
+            return True
+
+        def cancelled(self):
+            return self._cancelled
+
+        def running(self):
+            return self._running and not self._done
+
+        def done(self):
+            return self._done
+
+        def set_running_or_notify_cancel(self):
+            self._condition.acquire()
+            try:
+                if self._cancelled:
+                    return False
+                self._running = True
+                return True
+            finally:
+                self._condition.release()
+
+        def _set(self, result=None, exception=None):
+            self._condition.acquire()
+            try:
+                self._result = result
+                self._exception = exception
+                self._done = True
+                self._condition.notify_all()
+            finally:
+                self._condition.release()
+            self._invoke_callbacks()
+
+        def set_result(self, result):
+            self._set(result=result)
+
+        def set_exception(self, exception):
+            self._set(exception=exception)
+
+        def _invoke_callbacks(self):
+            for callback in self._callbacks:
+                try:
+                    callback(self)
+                except Exception:
+                    traceback.print_exc()
+
+        def add_done_callback(self, callback):
+            self._condition.acquire()
+            try:
+                if not self._done:
+                    self._callbacks.append(callback)
+                    return
+            finally:
+                self._condition.release()
+            callback(self)
+
+        def _wait(self, timeout):
+            self._condition.acquire()
+            try:
+                if not self._done:
+                    self._condition.wait(timeout)
+                if self._cancelled:
+                    raise CancelledError()
+                if not self._done:
+                    raise TimeoutError("future is not done in %s seconds"
+                                       % timeout)
+            finally:
+                self._condition.release()
+
+        def exception(self, timeout=None):
+            self._wait(timeout)
+            return self._exception
+
+        def result(self, timeout=None):
+            self._wait(timeout)
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+
+    class Executor(object):
+        """
+        subclasses give submit(fn, *args, **kwargs)
+        """
+        def map(self, fn, *iterables, **kwargs):
+            timeout = kwargs.get("timeout")
+            futures = [self.submit(fn, *args) for args in zip(*iterables)]
+            return (future.result(timeout) for future in futures)
+
+        def shutdown(self, wait=True):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            self.shutdown(wait=True)
+            return False
+
+def _send(sock, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+def _recv(sock):
+    size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return pickle.loads(_recv_exactly(sock, size))
+
+def _worker_loop(sock):
+    while True:
+        try:
+            task = _recv(sock)
+        except EOFError:
+            return
+        if task is None:
+            return
+        fn, args, kwargs = task
+        try:
+            reply = (True, fn(*args, **kwargs))
+        except Exception, e:
+            reply = (False, e)
+        try:
+            _send(sock, reply)
+        except (pickle.PicklingError, TypeError, AttributeError), e:
+            _send(sock, (False, RuntimeError(
+                "cannot pickle the result: %s" % e)))
+
+class _Worker(object):
+    def __init__(self, plan):
+        parent_sock, child_sock = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_STREAM)
+        flags = fcntl.fcntl(parent_sock.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(parent_sock.fileno(), fcntl.F_SETFD,
+                    flags | fcntl.FD_CLOEXEC)
+        try:
+            self.pid = plan.launch(target=lambda: _worker_loop(child_sock))
+        finally:
+            child_sock.close()
+        self.sock = parent_sock
+        self.tasks = 0
+
+    def run(self, fn, args, kwargs):
+        self.tasks += 1
+        try:
+            # the worker could have died after its last task
+            _send(self.sock, (fn, args, kwargs))
+        except socket.error:
+            raise WorkerCrashed("worker %d crashed" % self.pid)
+        try:
+            ok, result = _recv(self.sock)
+        except (EOFError, socket.error):
+            raise WorkerCrashed("worker %d crashed" % self.pid)
+        if ok:
+            return result
+        raise result
+
+    def stop(self):
+        try:
+            _send(self.sock, None)
+        except socket.error:
+            pass
+        self.sock.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+class NamespacesExecutor(Executor):
+    """
+    E.g.,
+        executor = NamespacesExecutor(max_workers=4,
+                                      namespaces=["user", "net", "pid"])
+        future = executor.submit(pow, 2, 10)
+        print future.result()
+        executor.shutdown()
+
+    kwargs are passed to spawn_plan, every worker of the pool lives in its
+    own namespaces made by the plan. A worker is replaced after
+    max_tasks_per_worker tasks, or when it crashes, the future of the task
+    that it was running gets WorkerCrashed. Functions, arguments and
+    results should be picklable, functions are pickled by reference, and
+    they are there in the workers because workers are forked from us.
+    """
+    def __init__(self, max_workers=4, max_tasks_per_worker=None, **kwargs):
+        if max_workers < 1:
+            raise ValueError("max_workers should be a positive number")
+        kwargs.setdefault("mountproc", False)
+        self.plan = workbench.spawn_plan(**kwargs)
+        self.max_workers = max_workers
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.crashed_workers = 0
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._shutdown = False
+        self._lock = threading.Lock()
+        self._spawn_lock = threading.Lock()
+
+    def _new_worker(self):
+        self._spawn_lock.acquire()
+        try:
+            return _Worker(self.plan)
+        finally:
+            self._spawn_lock.release()
+
+    def _adjust_threads(self):
+        if len(self._threads) >= self.max_workers:
+            return
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        self._lock.acquire()
+        try:
+            if self._shutdown:
+                raise RuntimeError("cannot submit after shutdown")
+            future = Future()
+            self._queue.put((future, fn, args, kwargs))
+            self._adjust_threads()
+            return future
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        worker = None
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                future, fn, args, kwargs = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if worker is None:
+                        worker = self._new_worker()
+                    result = worker.run(fn, args, kwargs)
+                except WorkerCrashed, e:
+                    self._lock.acquire()
+                    try:
+                        self.crashed_workers += 1
+                    finally:
+                        self._lock.release()
+                    worker.stop()
+                    worker = None
+                    future.set_exception(e)
+                except BaseException, e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                if (worker is not None and self.max_tasks_per_worker and
+                        worker.tasks >= self.max_tasks_per_worker):
+                    worker.stop()
+                    worker = None
+        finally:
+            if worker is not None:
+                worker.stop()
+
+    def shutdown(self, wait=True):
+        self._lock.acquire()
+        try:
+            self._shutdown = True
+            for thread in self._threads:
+                self._queue.put(None)
+        finally:
+            self._lock.release()
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,344 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+A small fork server that spawns namespaces on behalf of its clients.
+
+The server is forked from the caller early, before the caller grows big or
+starts threads, so spawning a new namespaces env costs a fork of the small
+server instead of a fork of the caller. A sandbox either execs nscmd, or
+calls a Python entry point in the forked server, which then starts with
+the modules the server has preloaded.
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import select
+import socket
+import threading
+
+from procszoo.utils import workbench, _exit_status, _poll
+
+__all__ = ["ForkServer", "ForkServerClient", "ForkServerError",
+           "connect_fork_server"]
+
+_MAX_MSG_SIZE = 65536
+_MAX_FDS = 4
+_POLL_TIMEOUT = 1000
+
+class ForkServerError(RuntimeError):
+    pass
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _resolve_entry(entry):
+    """
+    return the callable of "module:function", function could be dotted
+    """
+    module_name, sep, name = entry.partition(":")
+    if not module_name or not name:
+        raise ForkServerError("entry should be 'module:function': %s"
+                              % entry)
+    __import__(module_name)
+    obj = sys.modules[module_name]
+    for attr in name.split("."):
+        obj = getattr(obj, attr)
+    if not callable(obj):
+        raise ForkServerError("%s is not callable" % entry)
+    return obj
+
+class ForkServerClient(object):
+    """
+    client side of the fork server. It is thread safe, e.g.,
+
+        client = connect_fork_server("/run/procszoo.sock")
+        pid, pidfd, fds = client.spawn(nscmd=["ls", "-l"], stdio="pipe")
+        status = client.wait(pid, pidfd)
+    """
+    def __init__(self, sock=None):
+        self.sock = sock
+        self._lock = threading.Lock()
+
+    def _request(self, request, fds=None):
+        if self.sock is None:
+            raise ForkServerError("fork server is not connected")
+        self._lock.acquire()
+        try:
+            workbench.send_fds(self.sock, json.dumps(request), fds)
+            data, fds = workbench.recv_fds(
+                self.sock, _MAX_MSG_SIZE, _MAX_FDS)
+        finally:
+            self._lock.release()
+        if not data:
+            raise ForkServerError("fork server closed the connection")
+        reply = json.loads(data)
+        if reply.get("error"):
+            for fd in fds:
+                os.close(fd)
+            raise ForkServerError(reply["error"])
+        return reply, fds
+
+    def spawn(self, stdio=None, entry=None, args=None, **kwargs):
+        """
+        spawn namespaces, kwargs are the same as spawn_namespaces. stdio
+        could be None to inherit the stdio of the server, "pipe" to get
+        pipes connected to the stdin/stdout/stderr of nscmd, or a list of
+        three file descriptors.
+
+        If entry, "module:function", is given, function(*args) is called
+        in the new namespaces instead of exec'ing nscmd, args must be JSON
+        serializable. The sandbox exits with 0 when function returns, or
+        with the code of sys.exit.
+
+        return (pid, pidfd, fds), pidfd is None if the kernel cannot give
+        us one, fds are the pipes when stdio is "pipe", else [].
+        """
+        request = {"op": "spawn", "kwargs": kwargs, "stdio": None,
+                   "entry": entry, "args": list(args or [])}
+        fds = None
+        if stdio == "pipe":
+            request["stdio"] = "pipe"
+        elif stdio is not None:
+            if len(stdio) != 3:
+                raise ValueError("stdio should be three file descriptors")
+            request["stdio"] = "fds"
+            fds = list(stdio)
+        reply, fds = self._request(request, fds)
+        pidfd = None
+        if reply["pidfd"]:
+            pidfd = fds.pop(0)
+        return reply["pid"], pidfd, fds
+
+    def status(self, pid):
+        """
+        return the exit status of pid, None if it is still running
+        """
+        reply, fds = self._request({"op": "status", "pid": pid})
+        return reply["status"]
+
+    def wait(self, pid, pidfd=None, interval=0.05):
+        """
+        block until pid exits and return its exit status
+        """
+        if pidfd is not None:
+            poller = select.poll()
+            poller.register(pidfd, select.POLLIN)
+            _poll(poller)
+        while True:
+            status = self.status(pid)
+            if status is not None:
+                return status
+            time.sleep(interval)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class ForkServer(ForkServerClient):
+    """
+    E.g.,
+        server = ForkServer(preload=["myapp.worker"])
+        server.start()
+        ...
+        pid, pidfd, fds = server.spawn(nscmd="/bin/true")
+        server.wait(pid, pidfd)
+        pid, pidfd, fds = server.spawn(entry="myapp.worker:main",
+                                       args=["job-1"])
+        server.wait(pid, pidfd)
+        server.stop()
+
+    The modules in preload are imported by the server before it serves,
+    so entry points in them run without importing them again. If address
+    is given, the server also listens on the unix socket, and other
+    processes can use connect_fork_server(address) to spawn.
+    """
+    def __init__(self, address=None, preload=None):
+        ForkServerClient.__init__(self)
+        self.address = address
+        self.preload = preload
+        self.pid = None
+        self._statuses = {}
+
+    def start(self):
+        if self.pid is not None:
+            return self.pid
+        workbench.check_namespaces_available_status()
+        listener = None
+        if self.address is not None:
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            listener.bind(self.address)
+            listener.listen(128)
+        parent_sock, child_sock = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                try:
+                    parent_sock.close()
+                    self._serve(child_sock, listener)
+                except Exception, e:
+                    sys.stderr.write("fork server: %s\n" % e)
+                    code = 1
+            finally:
+                os._exit(code)
+
+        child_sock.close()
+        if listener is not None:
+            listener.close()
+        _set_cloexec(parent_sock.fileno())
+        self.sock = parent_sock
+        self.pid = pid
+        return pid
+
+    def stop(self):
+        if self.pid is None:
+            return
+        self.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        if self.address is not None and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.pid = None
+
+    def _preload(self):
+        if not self.preload:
+            return
+        for name in self.preload:
+            try:
+                __import__(name)
+            except ImportError, e:
+                sys.stderr.write("fork server: cannot preload %s: %s\n"
+                                 % (name, e))
+
+    def _serve(self, sock, listener):
+        self._preload()
+        conns = {sock.fileno(): sock}
+        poller = select.poll()
+        for s in [sock, listener]:
+            if s is None:
+                continue
+            _set_cloexec(s.fileno())
+            poller.register(s.fileno(), select.POLLIN)
+
+        while conns:
+            for fd, event in _poll(poller, _POLL_TIMEOUT):
+                if listener is not None and fd == listener.fileno():
+                    conn, addr = listener.accept()
+                    _set_cloexec(conn.fileno())
+                    conns[conn.fileno()] = conn
+                    poller.register(conn.fileno(), select.POLLIN)
+                    continue
+                conn = conns[fd]
+                try:
+                    data, fds = workbench.recv_fds(
+                        conn, _MAX_MSG_SIZE, _MAX_FDS)
+                except RuntimeError:
+                    data, fds = "", []
+                if not data:
+                    poller.unregister(fd)
+                    del conns[fd]
+                    conn.close()
+                    continue
+                self._handle(conn, data, fds)
+            self._reap()
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if pid == 0:
+                return
+            self._statuses[pid] = status
+
+    def _handle(self, conn, data, fds):
+        reply_fds = []
+        try:
+            try:
+                request = json.loads(data)
+                op = request.get("op")
+                if op == "spawn":
+                    reply, reply_fds = self._spawn(request, fds)
+                elif op == "status":
+                    reply = self._status(request["pid"])
+                else:
+                    reply = {"error": "unknown request: %s" % op}
+            except Exception, e:
+                reply = {"error": "%s" % e}
+            workbench.send_fds(conn, json.dumps(reply), reply_fds)
+        finally:
+            for fd in fds + reply_fds:
+                os.close(fd)
+
+    def _status(self, pid):
+        if pid not in self._statuses:
+            self._reap()
+        status = self._statuses.pop(pid, None)
+        if status is not None:
+            status = _exit_status(status)
+        return {"status": status}
+
+    def _spawn(self, request, fds):
+        kwargs = dict((str(k), v) for k, v in request["kwargs"].items())
+        child_fds = None
+        reply_fds = []
+        if request["stdio"] == "pipe":
+            stdin_r, stdin_w = os.pipe()
+            stdout_r, stdout_w = os.pipe()
+            stderr_r, stderr_w = os.pipe()
+            child_fds = [stdin_r, stdout_w, stderr_w]
+            reply_fds = [stdin_w, stdout_r, stderr_r]
+            for fd in child_fds + reply_fds:
+                _set_cloexec(fd)
+        elif request["stdio"] == "fds":
+            child_fds = fds
+
+        target = None
+        if request.get("entry"):
+            function = _resolve_entry(request["entry"])
+            args = request.get("args") or []
+            target = lambda: function(*args)
+
+        try:
+            plan = workbench.spawn_plan(**kwargs)
+            pid = plan.launch(stdio=child_fds, target=target)
+        except:
+            for fd in reply_fds:
+                os.close(fd)
+            raise
+        finally:
+            if request["stdio"] == "pipe":
+                for fd in child_fds:
+                    os.close(fd)
+
+        reply = {"pid": pid, "pidfd": False}
+        try:
+            pidfd = workbench.pidfd_open(pid)
+        except Exception:
+            pass
+        else:
+            reply["pidfd"] = True
+            reply_fds.insert(0, pidfd)
+        return reply, reply_fds
+
+def connect_fork_server(address):
+    """
+    connect to a fork server that listens on address
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.connect(address)
+    _set_cloexec(sock.fileno())
+    return ForkServerClient(sock)
@@ -0,0 +1,297 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Allocate non-overlapping subordinate uid/gid ranges to user namespaces.
+"""
+
+import os
+import pwd
+import json
+import fcntl
+import subprocess
+from bisect import bisect_left, bisect_right, insort
+
+from procszoo.utils import workbench, _map_id
+from procszoo.namespaces import NamespaceSettingError
+
+__all__ = ["IdRanges", "SubordinateIdAllocator", "read_subordinate_ids"]
+
+_DEFAULT_RANGE_SIZE = 65536
+
+def read_subordinate_ids(path, user=None):
+    """
+    return [(start, count)] of user in /etc/subuid or /etc/subgid
+    """
+    if user is None:
+        user = os.geteuid()
+    if isinstance(user, int) or isinstance(user, long):
+        keys = ["%d" % user]
+        try:
+            keys.append(pwd.getpwuid(user).pw_name)
+        except KeyError:
+            pass
+    else:
+        keys = [user]
+        try:
+            keys.append("%d" % pwd.getpwnam(user).pw_uid)
+        except KeyError:
+            pass
+
+    ranges = []
+    if not os.path.exists(path):
+        return ranges
+    hdr = open(path, 'r')
+    for line in hdr:
+        fields = line.strip().split(":")
+        if len(fields) != 3 or fields[0] not in keys:
+            continue
+        try:
+            ranges.append((int(fields[1]), int(fields[2])))
+        except ValueError:
+            continue
+    hdr.close()
+    return ranges
+
+class IdRanges(object):
+    """
+    free id ranges, adjacent ranges are coalesced. Ranges are indexed by
+    start and by size in sorted lists, so allocate and free find a range
+    with a binary search; inserting into the lists moves the entries
+    behind it, which is cheap for the few ranges in /etc/subuid.
+    """
+    def __init__(self, ranges=None):
+        self._starts = []
+        self._counts = {}
+        self._sizes = []
+        if ranges:
+            for start, count in ranges:
+                self.free(start, count)
+
+    def _add(self, start, count):
+        insort(self._starts, start)
+        insort(self._sizes, (count, start))
+        self._counts[start] = count
+
+    def _remove(self, start):
+        count = self._counts.pop(start)
+        del self._starts[bisect_left(self._starts, start)]
+        del self._sizes[bisect_left(self._sizes, (count, start))]
+        return count
+
+    def allocate(self, count):
+        """
+        take the smallest free range that is big enough, return its start
+        """
+        i = bisect_left(self._sizes, (count, -1))
+        if i == len(self._sizes):
+            raise NamespaceSettingError("no %d free subordinate ids" % count)
+        size, start = self._sizes[i]
+        self._remove(start)
+        if size > count:
+            self._add(start + count, size - count)
+        return start
+
+    def reserve(self, start, count):
+        """
+        take the range [start, start + count) that must be free
+        """
+        i = bisect_right(self._starts, start) - 1
+        if i < 0:
+            raise NamespaceSettingError("ids %d-%d are not free"
+                                        % (start, start + count - 1))
+        free_start = self._starts[i]
+        free_count = self._counts[free_start]
+        if start + count > free_start + free_count:
+            raise NamespaceSettingError("ids %d-%d are not free"
+                                        % (start, start + count - 1))
+        self._remove(free_start)
+        if start > free_start:
+            self._add(free_start, start - free_start)
+        end = start + count
+        if free_start + free_count > end:
+            self._add(end, free_start + free_count - end)
+
+    def free(self, start, count):
+        i = bisect_left(self._starts, start)
+        if i > 0:
+            prev_start = self._starts[i - 1]
+            prev_count = self._counts[prev_start]
+            if prev_start + prev_count > start:
+                raise NamespaceSettingError("ids %d-%d are free already"
+                                            % (start, start + count - 1))
+            if prev_start + prev_count == start:
+                self._remove(prev_start)
+                start = prev_start
+                count = prev_count + count
+                i -= 1
+        if i < len(self._starts):
+            next_start = self._starts[i]
+            if start + count > next_start:
+                raise NamespaceSettingError("ids %d-%d are free already"
+                                            % (start, start + count - 1))
+            if start + count == next_start:
+                count += self._remove(next_start)
+        self._add(start, count)
+
+    def ranges(self):
+        return [(start, self._counts[start]) for start in self._starts]
+
+class SubordinateIdAllocator(object):
+    """
+    hand out subordinate uid/gid ranges of a user to sandboxes, e.g.,
+        allocator = SubordinateIdAllocator(
+            state_file="/var/lib/procszoo/idmap.json")
+        allocator.allocate("sandbox-1")
+        spawn_namespaces(maproot=False,
+                         users_map=allocator.users_map("sandbox-1"),
+                         groups_map=allocator.groups_map("sandbox-1"))
+        allocator.free("sandbox-1")
+
+    With a state_file, allocations are shared by every process that uses
+    the same file, and the file is locked while it is updated.
+    """
+    def __init__(self, user=None, state_file=None, subuid="/etc/subuid",
+                 subgid="/etc/subgid"):
+        self.user = user
+        self.state_file = state_file
+        self.subuid = subuid
+        self.subgid = subgid
+        self.allocations = {}
+        self._reset()
+
+    def _reset(self):
+        self.uids = IdRanges(read_subordinate_ids(self.subuid, self.user))
+        self.gids = IdRanges(read_subordinate_ids(self.subgid, self.user))
+        self.allocations = {}
+
+    def _lock(self):
+        if self.state_file is None:
+            return None
+        fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        # mtime could miss a write of another process in the same tick
+        try:
+            self._load(fd)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    def _unlock(self, fd, changed=False):
+        if fd is None:
+            return
+        try:
+            if changed:
+                data = json.dumps(self.allocations)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _load(self, fd):
+        self._reset()
+        data = ""
+        while True:
+            buf = os.read(fd, 65536)
+            if not buf:
+                break
+            data += buf
+        if not data:
+            return
+        for owner, allocation in json.loads(data).items():
+            uid_start, uid_count = allocation["uid"]
+            gid_start, gid_count = allocation["gid"]
+            self.uids.reserve(uid_start, uid_count)
+            self.gids.reserve(gid_start, gid_count)
+            self.allocations[owner] = allocation
+
+    def allocate(self, owner, count=None):
+        """
+        return {"uid": (start, count), "gid": (start, count)} of owner, a
+        new allocation is made if owner does not have one
+        """
+        if count is None:
+            count = _DEFAULT_RANGE_SIZE
+        fd = self._lock()
+        changed = False
+        try:
+            if owner not in self.allocations:
+                uid_start = self.uids.allocate(count)
+                try:
+                    gid_start = self.gids.allocate(count)
+                except NamespaceSettingError:
+                    self.uids.free(uid_start, count)
+                    raise
+                self.allocations[owner] = {
+                    "uid": (uid_start, count), "gid": (gid_start, count)}
+                changed = True
+            return self.allocations[owner]
+        finally:
+            self._unlock(fd, changed)
+
+    def free(self, owner):
+        fd = self._lock()
+        changed = False
+        try:
+            allocation = self.allocations.pop(owner, None)
+            if allocation is not None:
+                self.uids.free(*allocation["uid"])
+                self.gids.free(*allocation["gid"])
+                changed = True
+        finally:
+            self._unlock(fd, changed)
+
+    def _maps(self, owner, key, maproot):
+        fd = self._lock()
+        try:
+            if owner not in self.allocations:
+                raise NamespaceSettingError("%s: no ids allocated" % owner)
+            start, count = self.allocations[owner][key]
+        finally:
+            self._unlock(fd)
+        if maproot:
+            if key == "uid":
+                outside = os.geteuid()
+            else:
+                outside = os.getegid()
+            return ["0 %d 1" % outside, "1 %d %d" % (start, count)]
+        return ["0 %d %d" % (start, count)]
+
+    def users_map(self, owner, maproot=False):
+        """
+        return uid map lines, could be used as spawn_namespaces users_map
+        """
+        return self._maps(owner, "uid", maproot)
+
+    def groups_map(self, owner, maproot=False):
+        return self._maps(owner, "gid", maproot)
+
+    def write_maps(self, owner, pid, maproot=False, use_helpers=None,
+                   setgroups=None):
+        """
+        write uid_map and gid_map of pid. Superuser writes the maps by
+        itself, others need newuidmap(1) and newgidmap(1). setgroups,
+        "deny" or "allow", is written to /proc/PID/setgroups before
+        gid_map. newgidmap(1) does not deny setgroups(2), so it is "deny"
+        by default when the helpers are used.
+        """
+        if use_helpers is None:
+            use_helpers = os.geteuid() != 0
+        if setgroups is None and use_helpers:
+            setgroups = "deny"
+        for key, helper, map_file in [
+                ("uid", "newuidmap", "uid_map"),
+                ("gid", "newgidmap", "gid_map")]:
+            maps = self._maps(owner, key, maproot)
+            if key == "gid":
+                workbench.setgroups_control(setgroups, pid)
+            if use_helpers:
+                args = [helper, "%d" % pid]
+                for line in maps:
+                    args.extend(line.split())
+                if subprocess.call(args) != 0:
+                    raise NamespaceSettingError("%s failed" % helper)
+            else:
+                _map_id(map_file, "%s\n" % "\n".join(maps), pid)
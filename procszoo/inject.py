@@ -0,0 +1,319 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Copy files into the mount namespace of a running sandbox.
+
+The destination files are opened in the mount namespace by a helper
+process that joined it, and passed back to us, or through
+/proc/<pid>/root. The data is copied by copy_file_range(2) or
+sendfile(2), so it does not go through user space, and files are copied
+by a few threads in parallel.
+"""
+
+import os
+import json
+import fcntl
+import errno
+import socket
+import threading
+import time
+import Queue
+
+from procszoo.utils import (workbench, CFunctionNotFound, _close_cloexec_fds,
+                            _fork)
+from procszoo.namespaces import NamespaceSettingError
+
+__all__ = ["FileInjector", "inject_files"]
+
+_BATCH_SIZE = 64
+_CHUNK_SIZE = 1 << 26
+_FALLBACK_ERRNOS = [errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                    errno.EOPNOTSUPP, errno.EBADF]
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _open_destination(path, mode, makedirs):
+    if makedirs:
+        parent = os.path.dirname(path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    # neither umask nor an existed file should change the mode
+    os.fchmod(fd, mode)
+    return fd
+
+def _copy_with(func, src, dst, size, progress):
+    copied = 0
+    while copied < size:
+        length = min(size - copied, _CHUNK_SIZE)
+        res = func(src, dst, length)
+        if res == 0:
+            break
+        copied += res
+        progress(res)
+    return copied
+
+def _copy(src, dst, size, progress):
+    """
+    copy size bytes from src to dst, return the way that was used
+    """
+    # the file offsets move with what is copied, so the next way goes on
+    # from where the last one failed
+    try:
+        _copy_with(workbench.copy_file_range, src, dst, size, progress)
+        return "copy_file_range"
+    except CFunctionNotFound:
+        pass
+    except OSError, e:
+        if e.errno not in _FALLBACK_ERRNOS:
+            raise
+    try:
+        _copy_with(lambda src, dst, length: workbench.sendfile(
+            dst, src, length), src, dst, size, progress)
+        return "sendfile"
+    except CFunctionNotFound:
+        pass
+    except OSError, e:
+        if e.errno not in _FALLBACK_ERRNOS:
+            raise
+    _copy_with(lambda src, dst, length: os.write(dst, os.read(src, length)),
+               src, dst, size, progress)
+    return "read"
+
+class _Opener(object):
+    """
+    open destination files in the mount namespace of target
+    """
+    def __init__(self, target, via):
+        self.target = target
+        self.via = via
+        self.pid = None
+        self.sock = None
+        self.root = None
+
+    def start(self):
+        if self.via == "proc_root":
+            if not (isinstance(self.target, int) or
+                    isinstance(self.target, long)):
+                raise TypeError("proc_root needs a pid target")
+            self.root = "/proc/%d/root" % self.target
+            return
+        if self.via != "setns":
+            raise ValueError("via should be 'setns' or 'proc_root'")
+        ns_files = workbench._ns_files_of_target(self.target,
+                                                 ["user", "mount"])
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX,
+                                                    socket.SOCK_SEQPACKET)
+        pid = _fork()
+        if pid == 0:
+            status = 1
+            try:
+                parent_sock.close()
+                _close_cloexec_fds()
+                workbench._enter_ns_files(ns_files)
+                self._serve(child_sock)
+                status = 0
+            finally:
+                os._exit(status)
+        child_sock.close()
+        _set_cloexec(parent_sock.fileno())
+        self.pid = pid
+        self.sock = parent_sock
+
+    def _serve(self, sock):
+        while True:
+            data = sock.recv(1 << 20)
+            if not data:
+                return
+            request = json.loads(data)
+            fds = []
+            errors = []
+            for path, mode in request["files"]:
+                try:
+                    fds.append(_open_destination(path, mode,
+                                                 request["makedirs"]))
+                    errors.append(None)
+                except (OSError, IOError), e:
+                    errors.append("%s: %s" % (path, e.strerror))
+            workbench.send_fds(sock, json.dumps(errors), fds)
+            for fd in fds:
+                os.close(fd)
+
+    def open(self, files, makedirs):
+        """
+        open [(path, mode)], return [(fd, error)]
+        """
+        if self.root is not None:
+            results = []
+            for path, mode in files:
+                try:
+                    fd = _open_destination("%s/%s" % (
+                        self.root, path.lstrip("/")), mode, makedirs)
+                    results.append((fd, None))
+                except (OSError, IOError), e:
+                    results.append((None, "%s: %s" % (path, e.strerror)))
+            return results
+        self.sock.send(json.dumps({"files": files, "makedirs": makedirs}))
+        data, fds = workbench.recv_fds(self.sock, maxfds=len(files))
+        if not data:
+            raise NamespaceSettingError("the helper of %s has gone"
+                                        % self.target)
+        results = []
+        fds.reverse()
+        for error in json.loads(data):
+            if error is None:
+                results.append((fds.pop(), None))
+            else:
+                results.append((None, error))
+        return results
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.pid is not None:
+            try:
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+            self.pid = None
+
+class FileInjector(object):
+    """
+    E.g.,
+        injector = FileInjector(pid)
+        results = injector.inject([("/srv/model.bin", "/data/model.bin"),
+                                   ("/srv/run.sh", "/usr/bin/run.sh")])
+        injector.close()
+
+    target is a pid or a ns_bind_dir. Destination paths are paths in the
+    mount namespace of target, with via="setns" they are opened by a
+    helper process in the user and mount namespaces of target, so they
+    are owned by root of the sandbox. via="proc_root" opens them through
+    /proc/<pid>/root from this process, absolute symlinks in them are
+    followed on the host.
+
+    progress(stats) is called from the copying threads, stats is a dict of
+    files_done, files_total, bytes_done and bytes_total.
+    """
+    def __init__(self, target, via="setns", jobs=4, batch_size=_BATCH_SIZE,
+                 makedirs=True, progress=None):
+        self.target = target
+        self.jobs = max(1, jobs)
+        self.batch_size = batch_size
+        self.makedirs = makedirs
+        self.progress = progress
+        self._opener = _Opener(target, via)
+        self._opener.start()
+        self._lock = threading.Lock()
+        self._stats = None
+
+    def _report(self, files=0, size=0):
+        self._lock.acquire()
+        try:
+            self._stats["files_done"] += files
+            self._stats["bytes_done"] += size
+            stats = dict(self._stats)
+        finally:
+            self._lock.release()
+        if self.progress is not None:
+            self.progress(stats)
+
+    def _worker(self, queue, results):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            i, src_fd, dst_fd, size = item
+            try:
+                start = time.time()
+                way = _copy(src_fd, dst_fd, size,
+                            lambda size: self._report(size=size))
+                results[i].update({"bytes": size, "way": way,
+                                   "elapsed": time.time() - start})
+            except (OSError, IOError), e:
+                results[i]["error"] = "%s" % e
+            finally:
+                os.close(src_fd)
+                os.close(dst_fd)
+                self._report(files=1)
+
+    def inject(self, files):
+        """
+        files is [(source, destination)] or [(source, destination, mode)],
+        the mode of the source is used if mode is not given. Return a list
+        of dicts with the result of each file.
+        """
+        jobs = []
+        results = []
+        bytes_total = 0
+        for item in files:
+            source, destination = item[:2]
+            result = {"source": source, "destination": destination,
+                      "error": None}
+            results.append(result)
+            try:
+                st = os.stat(source)
+            except OSError, e:
+                result["error"] = "%s: %s" % (source, e.strerror)
+                continue
+            mode = st.st_mode & 07777
+            if len(item) > 2:
+                mode = item[2]
+            jobs.append((len(results) - 1, source, destination, mode,
+                         st.st_size))
+            bytes_total += st.st_size
+        self._stats = {"files_done": 0, "files_total": len(jobs),
+                       "bytes_done": 0, "bytes_total": bytes_total}
+
+        queue = Queue.Queue(self.batch_size * 2)
+        threads = []
+        for i in range(min(self.jobs, len(jobs))):
+            thread = threading.Thread(target=self._worker,
+                                      args=(queue, results))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for start in range(0, len(jobs), self.batch_size):
+                batch = jobs[start:start + self.batch_size]
+                opened = self._opener.open(
+                    [(destination, mode) for i, source, destination, mode,
+                     size in batch], self.makedirs)
+                for (i, source, destination, mode, size), (dst_fd, error) \
+                        in zip(batch, opened):
+                    if error is not None:
+                        results[i]["error"] = error
+                        self._report(files=1)
+                        continue
+                    try:
+                        src_fd = os.open(source, os.O_RDONLY)
+                    except OSError, e:
+                        os.close(dst_fd)
+                        results[i]["error"] = "%s: %s" % (source, e.strerror)
+                        self._report(files=1)
+                        continue
+                    queue.put((i, src_fd, dst_fd, size))
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+        return results
+
+    def close(self):
+        self._opener.close()
+
+def inject_files(target, files, via="setns", jobs=4, progress=None):
+    """
+    copy [(source, destination)] into the mount namespace of target,
+    return the results of FileInjector.inject
+    """
+    injector = FileInjector(target, via=via, jobs=jobs, progress=progress)
+    try:
+        return injector.inject(files)
+    finally:
+        injector.close()
@@ -0,0 +1,163 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Host wide namespaces inventory: which processes share which namespaces.
+"""
+
+import os
+import json
+
+from procszoo.utils import workbench
+
+__all__ = ["NamespacesInventory"]
+
+class NamespacesInventory(object):
+    """
+    index built from /proc/*/ns/*, e.g.,
+        inventory = NamespacesInventory()
+        inventory.scan()
+        inventory.pids_of("net", 4026531992)
+        inventory.namespaces_of(1)
+        inventory.counts()
+
+    scan() only reads the ns entries of the processes that are new since
+    the last scan, and drops the processes that have gone. If a process
+    called setns(2) or unshare(2) after it was indexed, use
+    scan(full=True) or rescan(pids).
+    """
+    def __init__(self, proc="/proc", namespaces=None):
+        self.proc = proc
+        if namespaces is None:
+            namespaces = [ns for ns in workbench.namespaces.namespaces
+                          if getattr(workbench.namespaces, ns).available]
+        self.entries = [getattr(workbench.namespaces, ns).entry
+                        for ns in namespaces]
+        self.ns_pids = {}
+        self.pid_ns = {}
+        self.unreadable_pids = set()
+        for entry in self.entries:
+            self.ns_pids[entry] = {}
+
+    def _list_pids(self):
+        return set(int(name) for name in os.listdir(self.proc)
+                   if name.isdigit())
+
+    def _read_pid(self, pid):
+        path = "%s/%d/ns/" % (self.proc, pid)
+        inodes = []
+        for entry in self.entries:
+            try:
+                link = os.readlink(path + entry)
+            except OSError:
+                inodes.append(None)
+                continue
+            inodes.append(int(link[link.index("[") + 1:-1]))
+        if [inode for inode in inodes if inode is not None]:
+            return tuple(inodes)
+        return None
+
+    def _add(self, pid, inodes):
+        self.pid_ns[pid] = inodes
+        for entry, inode in zip(self.entries, inodes):
+            if inode is None:
+                continue
+            self.ns_pids[entry].setdefault(inode, set()).add(pid)
+
+    def _remove(self, pid):
+        inodes = self.pid_ns.pop(pid, None)
+        if inodes is None:
+            return
+        for entry, inode in zip(self.entries, inodes):
+            pids = self.ns_pids[entry].get(inode)
+            if pids is None:
+                continue
+            pids.discard(pid)
+            if not pids:
+                del self.ns_pids[entry][inode]
+
+    def _index(self, pids):
+        for pid in pids:
+            inodes = self._read_pid(pid)
+            if inodes is None:
+                self.unreadable_pids.add(pid)
+            else:
+                self._add(pid, inodes)
+
+    def rescan(self, pids):
+        """
+        reread the ns entries of pids
+        """
+        for pid in pids:
+            self._remove(pid)
+            self.unreadable_pids.discard(pid)
+        self._index(pids)
+
+    def scan(self, full=False):
+        """
+        update the index, return (new pids, gone pids)
+        """
+        pids = self._list_pids()
+        known_pids = set(self.pid_ns.keys()) | self.unreadable_pids
+        if full:
+            gone_pids = known_pids
+            new_pids = pids
+        else:
+            gone_pids = known_pids - pids
+            new_pids = pids - known_pids
+        for pid in gone_pids:
+            self._remove(pid)
+            self.unreadable_pids.discard(pid)
+        self._index(new_pids)
+        if full:
+            gone_pids = known_pids - pids
+            new_pids = pids - known_pids
+        return new_pids, gone_pids
+
+    def pids_of(self, namespace, inode):
+        """
+        return pids that live in the namespace, namespace is a name, e.g.,
+        "net", or an entry name, e.g., "mnt".
+        """
+        entry = self._entry(namespace)
+        return sorted(self.ns_pids[entry].get(inode, []))
+
+    def namespaces_of(self, pid):
+        """
+        return {entry: inode} of the pid
+        """
+        inodes = self.pid_ns.get(pid)
+        if inodes is None:
+            return None
+        return dict((entry, inode) for entry, inode
+                    in zip(self.entries, inodes) if inode is not None)
+
+    def counts(self):
+        """
+        return {entry: number of live namespaces}
+        """
+        return dict((entry, len(self.ns_pids[entry]))
+                    for entry in self.entries)
+
+    def _entry(self, namespace):
+        if namespace in self.entries:
+            return namespace
+        if namespace in workbench.namespaces.namespaces:
+            entry = getattr(workbench.namespaces, namespace).entry
+            if entry in self.entries:
+                return entry
+        raise RuntimeError("%s: unknown namespace" % namespace)
+
+    def to_json(self, with_pids=True):
+        inventory = {"counts": self.counts(), "namespaces": {}}
+        for entry in self.entries:
+            inventory["namespaces"][entry] = dict(
+                ("%d" % inode, sorted(pids))
+                for inode, pids in self.ns_pids[entry].items())
+        if with_pids:
+            inventory["pids"] = dict(
+                ("%d" % pid, self.namespaces_of(pid)) for pid in self.pid_ns)
+        return json.dumps(inventory)
+
+    def __str__(self):
+        return self.to_json()
@@ -0,0 +1,395 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Resource usage of the namespaces spawned by procszoo, in the Prometheus
+text format.
+
+The files under /proc/<pid> and the cgroup are opened once and reread by
+pread at each sample, so a sample costs a few reads per process.
+"""
+
+import os
+import sys
+import fcntl
+import errno
+import select
+import socket
+import threading
+import time
+
+from procszoo.utils import workbench, _poll
+
+__all__ = ["SandboxMetrics"]
+
+_CLK_TCK = float(os.sysconf("SC_CLK_TCK"))
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+_READ_SIZE = 4096
+_CGROUP_ROOT = "/sys/fs/cgroup"
+
+_METRICS = [
+    ("cpu_seconds_total", "counter",
+     "user and system cpu time of the processes in the sandbox"),
+    ("rss_bytes", "gauge", "resident memory of the processes in the sandbox"),
+    ("io_read_bytes_total", "counter", "bytes read from storage"),
+    ("io_write_bytes_total", "counter", "bytes written to storage"),
+    ("context_switches_total", "counter",
+     "voluntary and involuntary context switches"),
+    ("processes", "gauge", "processes in the sandbox"),
+    ("cgroup_cpu_seconds_total", "counter", "cpu time of the sandbox cgroup"),
+    ("cgroup_memory_bytes", "gauge", "memory usage of the sandbox cgroup"),
+    ("cgroup_pids", "gauge", "tasks in the sandbox cgroup"),
+]
+
+def _pread(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    return os.read(fd, _READ_SIZE)
+
+# the errors of a process that has gone, or of a file we may not read
+_GONE_ERRNOS = [errno.ESRCH, errno.ENOENT]
+_SKIP_ERRNOS = _GONE_ERRNOS + [errno.EACCES, errno.EPERM]
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _open_cloexec(path):
+    # spawned sandboxes must not inherit the /proc files of the others
+    fd = os.open(path, os.O_RDONLY)
+    _set_cloexec(fd)
+    return fd
+
+def _open(path):
+    try:
+        return _open_cloexec(path)
+    except OSError, e:
+        if e.errno not in _SKIP_ERRNOS:
+            raise
+        return None
+
+def _close(fds):
+    for fd in fds:
+        if fd is not None:
+            os.close(fd)
+
+class _Process(object):
+    def __init__(self, pid):
+        self.pid = pid
+        path = "/proc/%d" % pid
+        self.stat = _open_cloexec("%s/stat" % path)
+        self.io = self.status = self.children = None
+        try:
+            self.io = _open("%s/io" % path)
+            self.status = _open("%s/status" % path)
+            self.children = _open("%s/task/%d/children" % (path, pid))
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        _close([self.stat, self.io, self.status, self.children])
+
+    def sample(self, metrics):
+        fields = _pread(self.stat)
+        if not fields:
+            raise OSError(errno.ESRCH, "process has gone")
+        fields = fields[fields.rindex(")") + 2:].split()
+        ticks = sum(int(field) for field in fields[11:15])
+        metrics["cpu_seconds_total"] += ticks / _CLK_TCK
+        metrics["rss_bytes"] += int(fields[21]) * _PAGE_SIZE
+        metrics["processes"] += 1
+
+        if self.io is not None:
+            for line in _pread(self.io).splitlines():
+                if line.startswith("read_bytes:"):
+                    metrics["io_read_bytes_total"] += int(line.split()[1])
+                elif line.startswith("write_bytes:"):
+                    metrics["io_write_bytes_total"] += int(line.split()[1])
+        if self.status is not None:
+            for line in _pread(self.status).splitlines():
+                if "ctxt_switches:" in line:
+                    metrics["context_switches_total"] += int(line.split()[1])
+
+        if self.children is None:
+            return []
+        return [int(pid) for pid in _pread(self.children).split()]
+
+class _Cgroup(object):
+    def __init__(self, path):
+        self.path = path
+        self.cpu = _open("%s/cpu.stat" % path)
+        self.memory = _open("%s/memory.current" % path)
+        self.pids = _open("%s/pids.current" % path)
+
+    def close(self):
+        _close([self.cpu, self.memory, self.pids])
+
+    def sample(self, metrics):
+        if self.cpu is not None:
+            for line in _pread(self.cpu).splitlines():
+                if line.startswith("usage_usec "):
+                    metrics["cgroup_cpu_seconds_total"] = \
+                        int(line.split()[1]) / 1000000.0
+                    break
+        if self.memory is not None:
+            metrics["cgroup_memory_bytes"] = int(_pread(self.memory))
+        if self.pids is not None:
+            metrics["cgroup_pids"] = int(_pread(self.pids))
+
+def _cgroup_of(pid):
+    try:
+        hdr = open("/proc/%s/cgroup" % pid, 'r')
+    except IOError:
+        return None
+    path = None
+    for line in hdr:
+        if line.startswith("0::"):
+            path = line[3:].strip()
+    hdr.close()
+    return path
+
+class _Sandbox(object):
+    def __init__(self, pid, name):
+        self.pid = pid
+        self.name = name
+        self.processes = {}
+        self.cgroup = None
+        cgroup = _cgroup_of(pid)
+        if cgroup is not None and cgroup != _cgroup_of("self"):
+            self.cgroup = _Cgroup("%s%s" % (_CGROUP_ROOT, cgroup))
+        try:
+            self.processes[pid] = _Process(pid)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        for process in self.processes.values():
+            process.close()
+        self.processes = {}
+        if self.cgroup is not None:
+            self.cgroup.close()
+
+    def sample(self):
+        metrics = {}
+        for name, kind, help in _METRICS:
+            if not name.startswith("cgroup_"):
+                metrics[name] = 0
+        pids = [self.pid]
+        seen = set()
+        while pids:
+            pid = pids.pop()
+            if pid in seen:
+                continue
+            seen.add(pid)
+            process = self.processes.get(pid)
+            try:
+                if process is None:
+                    process = _Process(pid)
+                    self.processes[pid] = process
+                pids.extend(process.sample(metrics))
+            except OSError, e:
+                # e.g., EMFILE must not untrack a live sandbox
+                if e.errno not in _GONE_ERRNOS:
+                    raise
+                if process is not None:
+                    process.close()
+                self.processes.pop(pid, None)
+                if pid == self.pid:
+                    return None
+        for pid in set(self.processes.keys()) - seen:
+            self.processes.pop(pid).close()
+        if self.cgroup is not None:
+            self.cgroup.sample(metrics)
+        return metrics
+
+class SandboxMetrics(object):
+    """
+    E.g.,
+        metrics = SandboxMetrics(path="/var/lib/node_exporter/procszoo.prom")
+        metrics.start()
+        spawn_namespaces(...)
+        ...
+        metrics.stop()
+
+    start() tracks every namespaces spawned by spawn_namespaces from now,
+    and samples them every interval seconds in a thread. The metrics are
+    written to path, and/or sent to anyone that connects to the unix
+    socket address.
+    """
+    def __init__(self, interval=10, path=None, address=None,
+                 prefix="procszoo_sandbox"):
+        self.interval = interval
+        self.path = path
+        self.address = address
+        self.prefix = prefix
+        self.sandboxes = {}
+        self.samples = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_r = None
+        self._stop_w = None
+
+    def track(self, pid, sandbox_pid=None, name=None):
+        """
+        sample pid and its descendants. sandbox_pid is accepted so track
+        could be used as a spawn callback.
+        """
+        if name is None:
+            name = "%d" % pid
+        try:
+            sandbox = _Sandbox(pid, name)
+        except OSError, e:
+            if e.errno not in _GONE_ERRNOS:
+                sys.stderr.write("sandbox metrics: cannot track %d: %s\n"
+                                 % (pid, e))
+            return
+        self._lock.acquire()
+        try:
+            old = self.sandboxes.pop(pid, None)
+            self.sandboxes[pid] = sandbox
+        finally:
+            self._lock.release()
+        if old is not None:
+            old.close()
+
+    def untrack(self, pid):
+        self._lock.acquire()
+        try:
+            sandbox = self.sandboxes.pop(pid, None)
+            self.samples.pop(pid, None)
+        finally:
+            self._lock.release()
+        if sandbox is not None:
+            sandbox.close()
+
+    def sample(self):
+        """
+        sample each sandbox, the sandboxes that have gone are untracked.
+        A sandbox that could not be sampled keeps its last sample. Return
+        {pid: {metric: value}}
+        """
+        self._lock.acquire()
+        try:
+            samples = {}
+            for pid, sandbox in self.sandboxes.items():
+                try:
+                    metrics = sandbox.sample()
+                except OSError, e:
+                    sys.stderr.write("sandbox metrics: cannot sample %d: "
+                                     "%s\n" % (pid, e))
+                    if pid in self.samples:
+                        samples[pid] = self.samples[pid]
+                    continue
+                if metrics is None:
+                    sandbox.close()
+                    del self.sandboxes[pid]
+                else:
+                    samples[pid] = metrics
+            self.samples = samples
+            return samples
+        finally:
+            self._lock.release()
+
+    def prometheus(self):
+        """
+        return the last samples in the Prometheus text format
+        """
+        self._lock.acquire()
+        try:
+            lines = []
+            for name, kind, help in _METRICS:
+                metric = "%s_%s" % (self.prefix, name)
+                values = []
+                for pid, metrics in sorted(self.samples.items()):
+                    if name not in metrics:
+                        continue
+                    labels = 'pid="%d",name="%s"' % (
+                        pid, self.sandboxes[pid].name.replace('"', '\\"'))
+                    values.append("%s{%s} %s" % (metric, labels,
+                                                 metrics[name]))
+                if not values:
+                    continue
+                lines.append("# HELP %s %s" % (metric, help))
+                lines.append("# TYPE %s %s" % (metric, kind))
+                lines.extend(values)
+            return "%s\n" % "\n".join(lines)
+        finally:
+            self._lock.release()
+
+    def write(self, path=None):
+        if path is None:
+            path = self.path
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        hdr = open(tmp_path, 'w')
+        hdr.write(self.prometheus())
+        hdr.close()
+        os.rename(tmp_path, path)
+
+    def start(self, track_spawned=True):
+        if self._thread is not None:
+            return
+        if track_spawned:
+            workbench.register_spawn_callback(self.track)
+        listener = None
+        if self.address is not None:
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            _set_cloexec(listener.fileno())
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            listener.bind(self.address)
+            listener.listen(16)
+        self._stop_r, self._stop_w = os.pipe()
+        for fd in self._stop_r, self._stop_w:
+            _set_cloexec(fd)
+        self._thread = threading.Thread(target=self._run, args=(listener,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        workbench.unregister_spawn_callback(self.track)
+        os.write(self._stop_w, "x")
+        self._thread.join()
+        self._thread = None
+        _close([self._stop_r, self._stop_w])
+        self._lock.acquire()
+        try:
+            pids = self.sandboxes.keys()
+        finally:
+            self._lock.release()
+        for pid in pids:
+            self.untrack(pid)
+
+    def _run(self, listener):
+        poller = select.poll()
+        poller.register(self._stop_r, select.POLLIN)
+        if listener is not None:
+            poller.register(listener.fileno(), select.POLLIN)
+        deadline = 0
+        try:
+            while True:
+                now = time.time()
+                if now >= deadline:
+                    self.sample()
+                    if self.path is not None:
+                        self.write()
+                    deadline = now + self.interval
+                    continue
+                timeout = int((deadline - now) * 1000) + 1
+                for fd, event in _poll(poller, timeout):
+                    if fd == self._stop_r:
+                        return
+                    conn, addr = listener.accept()
+                    _set_cloexec(conn.fileno())
+                    try:
+                        conn.sendall(self.prometheus())
+                    except socket.error:
+                        pass
+                    conn.close()
+        finally:
+            if listener is not None:
+                listener.close()
+                if os.path.exists(self.address):
+                    os.unlink(self.address)
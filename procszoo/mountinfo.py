@@ -0,0 +1,248 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Parse /proc/<pid>/mountinfo, and watch it for changes.
+
+The kernel marks mountinfo with POLLPRI when the mount table of the
+namespace changes, so a watcher only rereads it then, and only parses the
+lines that it has not seen.
+"""
+
+import os
+import re
+import errno
+import select
+import threading
+from collections import namedtuple
+
+__all__ = ["MountInfo", "MountTable", "MountWatcher", "read_mountinfo"]
+
+_READ_SIZE = 1 << 16
+_OCTAL_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+# propagation is "shared", "slave", "private" or "unbindable", peer_group
+# and master are the peer group ids of shared:X and master:X, or None
+MountInfo = namedtuple("MountInfo", [
+    "mount_id", "parent_id", "device", "root", "mount_point", "options",
+    "propagation", "peer_group", "master", "fs_type", "source",
+    "super_options"])
+
+def _unescape(field):
+    if "\\" not in field:
+        return field
+    return _OCTAL_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+def _parse_line(line):
+    fields = line.split()
+    separator = fields.index("-", 6)
+    propagation = "private"
+    peer_group = None
+    master = None
+    for tag in fields[6:separator]:
+        name, sep, value = tag.partition(":")
+        if name == "shared":
+            propagation = "shared"
+            peer_group = int(value)
+        elif name == "master":
+            if propagation != "shared":
+                propagation = "slave"
+            master = int(value)
+        elif name == "unbindable":
+            propagation = "unbindable"
+    return MountInfo(
+        int(fields[0]), int(fields[1]), fields[2], _unescape(fields[3]),
+        _unescape(fields[4]), fields[5], propagation, peer_group, master,
+        _unescape(fields[separator + 1]), _unescape(fields[separator + 2]),
+        fields[separator + 3] if len(fields) > separator + 3 else "")
+
+def _mountinfo_path(pid):
+    if pid == "self":
+        return "/proc/self/mountinfo"
+    return "/proc/%d/mountinfo" % pid
+
+def _read_fd(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    chunks = []
+    while True:
+        chunk = os.read(fd, _READ_SIZE)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return "".join(chunks)
+
+def read_mountinfo(pid="self", path=None):
+    """
+    return [MountInfo] of the mount namespace of pid
+    """
+    if path is None:
+        path = _mountinfo_path(pid)
+    hdr = open(path, 'r')
+    try:
+        return [_parse_line(line) for line in hdr]
+    finally:
+        hdr.close()
+
+class MountTable(object):
+    """
+    mounts of a mount namespace indexed by mount id and mount point, e.g.,
+        table = MountTable(1234)
+        table.is_mount_point("/proc")
+        table.below("/sys")
+
+    update(data) takes the new content of mountinfo, reuses the records
+    of the lines that did not change and returns (added, removed).
+    """
+    def __init__(self, pid="self", data=None):
+        self.pid = pid
+        self.mounts = {}
+        self._lines = {}
+        self._mount_points = {}
+        if data is None:
+            hdr = open(_mountinfo_path(pid), 'r')
+            try:
+                data = hdr.read()
+            finally:
+                hdr.close()
+        self.update(data)
+
+    def update(self, data):
+        lines = {}
+        added = []
+        for line in data.splitlines():
+            mount = self._lines.get(line)
+            if mount is None:
+                mount = _parse_line(line)
+                added.append(mount)
+            lines[line] = mount
+        removed = [mount for line, mount in self._lines.iteritems()
+                   if line not in lines]
+        self._lines = lines
+        for mount in removed:
+            del self.mounts[mount.mount_id]
+            mounts = self._mount_points[mount.mount_point]
+            mounts.remove(mount)
+            if not mounts:
+                del self._mount_points[mount.mount_point]
+        for mount in added:
+            self.mounts[mount.mount_id] = mount
+            self._mount_points.setdefault(mount.mount_point,
+                                          []).append(mount)
+        return added, removed
+
+    def __len__(self):
+        return len(self.mounts)
+
+    def __iter__(self):
+        return iter(sorted(self.mounts.values()))
+
+    def is_mount_point(self, path):
+        return os.path.normpath(path) in self._mount_points
+
+    def find(self, path):
+        """
+        return the mounts on path, the top one is the last
+        """
+        return sorted(self._mount_points.get(os.path.normpath(path), []))
+
+    def below(self, path):
+        """
+        return the mounts whose mount points are under path
+        """
+        prefix = os.path.normpath(path).rstrip("/") + "/"
+        return sorted(mount for mount in self.mounts.itervalues()
+                      if mount.mount_point.startswith(prefix))
+
+    def children(self, mount_id):
+        return sorted(mount for mount in self.mounts.itervalues()
+                      if mount.parent_id == mount_id and
+                      mount.mount_id != mount_id)
+
+class MountWatcher(object):
+    """
+    E.g.,
+        watcher = MountWatcher(1234)
+        for added, removed in watcher.changes():
+            ...
+
+    or run callback(added, removed) in a thread,
+        watcher.start(callback)
+        ...
+        watcher.stop()
+
+    watcher.table is kept up to date.
+    """
+    def __init__(self, pid="self"):
+        self.pid = pid
+        self.fd = os.open(_mountinfo_path(pid), os.O_RDONLY)
+        self.table = MountTable(pid, data=_read_fd(self.fd))
+        self._poller = select.poll()
+        self._poller.register(self.fd, select.POLLPRI | select.POLLERR)
+        self._thread = None
+        self._stop_r = None
+        self._stop_w = None
+
+    def _poll(self, poller, timeout):
+        while True:
+            try:
+                return poller.poll(timeout)
+            except select.error, e:
+                if e[0] != errno.EINTR:
+                    raise
+
+    def poll(self, timeout=None):
+        """
+        wait for a change of the mount table at most timeout seconds,
+        return (added, removed), or None if nothing changed
+        """
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        if not self._poll(self._poller, timeout):
+            return None
+        return self.table.update(_read_fd(self.fd))
+
+    def changes(self, timeout=None):
+        """
+        yield (added, removed), stop when nothing changes in timeout
+        seconds
+        """
+        while True:
+            change = self.poll(timeout)
+            if change is None:
+                return
+            if change[0] or change[1]:
+                yield change
+
+    def start(self, callback):
+        if self._thread is not None:
+            return
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = threading.Thread(target=self._run, args=(callback,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, callback):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLPRI | select.POLLERR)
+        poller.register(self._stop_r, select.POLLIN)
+        while True:
+            for fd, event in self._poll(poller, None):
+                if fd == self._stop_r:
+                    return
+                added, removed = self.table.update(_read_fd(self.fd))
+                if added or removed:
+                    callback(added, removed)
+
+    def stop(self):
+        if self._thread is not None:
+            os.write(self._stop_w, "x")
+            self._thread.join()
+            self._thread = None
+            os.close(self._stop_r)
+            os.close(self._stop_w)
+
+    def close(self):
+        self.stop()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
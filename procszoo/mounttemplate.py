@@ -0,0 +1,121 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Mount namespace templates.
+
+A holder process prepares a mount tree once, e.g., prunes the mounts,
+makes tmpfs and bind mounts, and keeps its mount namespace alive.
+Sandboxes spawned with mount_template=MountTemplate join it and unshare
+a new mount namespace, which is a copy of it, so a complex layout costs
+one copy per sandbox instead of many mount(2) calls.
+"""
+
+import os
+import fcntl
+import traceback
+
+from procszoo.utils import workbench
+
+__all__ = ["MountTemplate", "MountTemplateError"]
+
+class MountTemplateError(RuntimeError):
+    pass
+
+class MountTemplate(object):
+    """
+    E.g.,
+        def setup():
+            mount(source="none", target="/srv", filesystemtype="tmpfs")
+            ...
+
+        template = MountTemplate(setup, keep_mounts=["/", "/dev"])
+        template.start()
+        for i in range(100):
+            spawn_namespaces(mount_template=template, nscmd=["make"])
+        template.stop()
+
+    setup() runs in the mount namespace of the template, after the mounts
+    that are not in keep_mounts are detached. propagation should be
+    private or slave, so the mounts of the template stay in it. With
+    userns, e.g., a SharedUserNamespace, the template is made in that user
+    namespace, and so are the sandboxes spawned from it. The holder exits
+    when stop() is called, or when this process exits.
+    """
+    def __init__(self, setup=None, keep_mounts=None, propagation="private",
+                 userns=None):
+        if propagation not in ["private", "slave"]:
+            raise MountTemplateError(
+                "propagation should be private or slave")
+        self.setup = setup
+        self.keep_mounts = keep_mounts
+        self.propagation = propagation
+        self.userns = userns
+        self.pid = None
+        self.ns_file = None
+        self._w = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self.pid is not None:
+            return
+        plan = workbench.spawn_plan(
+            namespaces=["mount"], maproot=False, mountproc=False,
+            propagation=self.propagation, keep_mounts=self.keep_mounts,
+            userns=self.userns)
+        r, w = os.pipe()
+        ready_r, ready_w = os.pipe()
+        # sandboxes must not keep the holder alive
+        for fd in [w, ready_r]:
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        def hold():
+            try:
+                if self.setup is not None:
+                    self.setup()
+            except Exception:
+                # the keeper has ready_w as well, we see EOF once it exits
+                os.write(ready_w, "E%s" % traceback.format_exc())
+                os._exit(1)
+            os.write(ready_w, "R")
+            os.close(ready_w)
+            while os.read(r, 1):
+                pass
+        try:
+            pid = plan.launch(target=hold)
+        finally:
+            os.close(r)
+            os.close(ready_w)
+        error = []
+        data = os.read(ready_r, 4096)
+        while data and data != "R":
+            error.append(data)
+            data = os.read(ready_r, 4096)
+        os.close(ready_r)
+        if error or not data:
+            os.close(w)
+            os.waitpid(pid, 0)
+            raise MountTemplateError("setup of the template failed:\n%s"
+                                     % "".join(error)[1:])
+        self.pid = pid
+        self._w = w
+        # the keeper is in the mount namespace of the template as well
+        self.ns_file = "/proc/%d/ns/mnt" % pid
+
+    def stop(self):
+        if self.pid is None:
+            return
+        os.close(self._w)
+        self._w = None
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        self.pid = None
+        self.ns_file = None
@@ -0,0 +1,196 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Threads that run callables in the net namespaces of sandboxes.
+
+The net namespace is a property of a thread, not of a process, so a
+thread that called setns(2) makes its sockets in that namespace, and the
+sockets work from any thread of the process. One process could serve
+the net namespaces of hundreds of sandboxes this way. Joining a net
+namespace needs CAP_SYS_ADMIN in our user namespace, i.e., root, as a
+thread cannot join a user namespace.
+"""
+
+import os
+import socket
+import threading
+import Queue
+
+from procszoo.utils import workbench
+from procszoo.executor import Future
+
+__all__ = ["NetNamespacePool"]
+
+_IDLE_TIMEOUT = 60
+
+def _net_ns_file(target):
+    if isinstance(target, int) or isinstance(target, long):
+        return "/proc/%d/ns/net" % target
+    if os.path.isdir(target):
+        return "%s/net" % target.rstrip("/")
+    return target
+
+class _Worker(object):
+    """
+    a thread in one net namespace and its queue of tasks
+    """
+    def __init__(self, pool, key, ns_file):
+        self.pool = pool
+        self.key = key
+        self.ns_file = ns_file
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def _run(self):
+        try:
+            # another thread could have left its net namespace already
+            workbench._enter_ns_files([("net", self.ns_file)], always=True)
+        except Exception, e:
+            self.pool._retire(self, e)
+            return
+        while True:
+            try:
+                task = self.queue.get(timeout=self.pool.idle_timeout)
+            except Queue.Empty:
+                if self.pool._retire(self):
+                    return
+                continue
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+class NetNamespacePool(object):
+    """
+    E.g.,
+        pool = NetNamespacePool()
+        sock = pool.socket(pid).result()
+        sock.connect(("10.0.0.2", 80))
+        future = pool.submit(pid, os.system, "ip link")
+        ...
+        pool.shutdown()
+
+    target is a pid, a ns_bind_dir or a net namespace file, targets in
+    the same net namespace share their threads. A thread leaves when it
+    has nothing to do for idle_timeout seconds. If the namespace could
+    not be joined, the futures of it get the error.
+    """
+    def __init__(self, threads_per_namespace=1, idle_timeout=_IDLE_TIMEOUT):
+        if threads_per_namespace < 1:
+            raise ValueError("threads_per_namespace should be positive")
+        self.threads_per_namespace = threads_per_namespace
+        self.idle_timeout = idle_timeout
+        self._workers = {}
+        self._next = {}
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def _key(self, ns_file):
+        st = os.stat(ns_file)
+        return st.st_dev, st.st_ino
+
+    def _dispatch(self, target, task):
+        ns_file = _net_ns_file(target)
+        key = self._key(ns_file)
+        # tasks are queued with the lock held, so a worker that is
+        # retired with the lock held could not get any more
+        self._lock.acquire()
+        try:
+            if self._shutdown:
+                raise RuntimeError("cannot submit after shutdown")
+            workers = self._workers.setdefault(key, [])
+            if len(workers) < self.threads_per_namespace:
+                worker = _Worker(self, key, ns_file)
+                workers.append(worker)
+                worker.thread.start()
+            else:
+                i = self._next.get(key, 0)
+                self._next[key] = i + 1
+                worker = workers[i % len(workers)]
+            worker.queue.put(task)
+        finally:
+            self._lock.release()
+
+    def _retire(self, worker, error=None):
+        """
+        drop an idle or broken worker, return False if it got tasks
+        """
+        tasks = []
+        self._lock.acquire()
+        try:
+            if error is None and not worker.queue.empty():
+                return False
+            workers = self._workers.get(worker.key, [])
+            if worker in workers:
+                workers.remove(worker)
+            if not workers:
+                self._workers.pop(worker.key, None)
+                self._next.pop(worker.key, None)
+            while not worker.queue.empty():
+                tasks.append(worker.queue.get_nowait())
+        finally:
+            self._lock.release()
+        for task in tasks:
+            if task is not None and task[0].set_running_or_notify_cancel():
+                task[0].set_exception(error)
+        return True
+
+    def submit(self, target, fn, *args, **kwargs):
+        """
+        run fn(*args, **kwargs) in the net namespace of target, return a
+        Future
+        """
+        future = Future()
+        self._dispatch(target, (future, fn, args, kwargs))
+        return future
+
+    def map(self, targets, fn, *args, **kwargs):
+        """
+        run fn in the net namespace of each target, return {target: Future}
+        """
+        return dict((target, self.submit(target, fn, *args, **kwargs))
+                    for target in targets)
+
+    def socket(self, target, family=socket.AF_INET, type=socket.SOCK_STREAM,
+               proto=0):
+        """
+        return a Future of a socket made in the net namespace of target
+        """
+        return self.submit(target, socket.socket, family, type, proto)
+
+    def namespaces(self):
+        self._lock.acquire()
+        try:
+            return len(self._workers)
+        finally:
+            self._lock.release()
+
+    def shutdown(self, wait=True):
+        self._lock.acquire()
+        try:
+            self._shutdown = True
+            workers = [worker for workers in self._workers.values()
+                       for worker in workers]
+        finally:
+            self._lock.release()
+        for worker in workers:
+            worker.queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
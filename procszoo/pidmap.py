@@ -0,0 +1,386 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Translate pids between the host and the pid namespaces of sandboxes.
+
+The NSpid and NSpgid lines of /proc/PID/status list the pid and the
+process group of a process in each pid namespace from ours down to its
+own. They are read once per process, when the sandbox is tracked or when
+the process forks, and the index is dropped when the process exits, so a
+lookup is a dict access. Forks and exits come from ProcEventMonitor; if
+the netlink process connector is not for us, exits come from pidfds, and
+a lookup that misses rescans the processes of the sandbox.
+"""
+
+import os
+import fcntl
+import errno
+import select
+import signal
+import socket
+import threading
+
+from procszoo.utils import workbench, _poll
+from procszoo.procevents import ProcEventMonitor, PROC_EVENT_FORK, \
+    PROC_EVENT_EXEC, PROC_EVENT_EXIT
+
+__all__ = ["PidIndex", "PidIndexError"]
+
+class PidIndexError(RuntimeError):
+    pass
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _read_status(pid):
+    """
+    return (NSpid, NSpgid) of a live process, None if it is gone
+    """
+    try:
+        hdr = open("/proc/%d/status" % pid, 'r')
+    except IOError:
+        return None
+    fields = {}
+    try:
+        for line in hdr:
+            name, sep, value = line.partition(":")
+            if name in ["State", "NSpid", "NSpgid"]:
+                fields[name] = value.split()
+    finally:
+        hdr.close()
+    if not fields.get("State") or fields["State"][0] in "ZX":
+        return None
+    if "NSpid" not in fields:
+        raise PidIndexError("the kernel does not report NSpid")
+    nspgid = fields.get("NSpgid") or [None] * len(fields["NSpid"])
+    return [int(value) for value in fields["NSpid"]], nspgid
+
+def _children_of(pid):
+    children = []
+    try:
+        tasks = os.listdir("/proc/%d/task" % pid)
+    except OSError:
+        return children
+    for task in tasks:
+        try:
+            hdr = open("/proc/%d/task/%s/children" % (pid, task), 'r')
+        except IOError:
+            continue
+        children.extend(int(child) for child in hdr.read().split())
+        hdr.close()
+    return children
+
+class _Sandbox(object):
+    """
+    the processes of a sandbox, level is the depth of its pid namespace
+    below ours, i.e., the index of its pids in NSpid
+    """
+    def __init__(self, key, init, level):
+        self.key = key
+        self.init = init
+        self.level = level
+        self.to_host = {}
+        # ns_pgid: [host_pgid, number of processes in it]
+        self.pgids = {}
+
+class PidIndex(object):
+    """
+    E.g.,
+        index = PidIndex()
+        index.start()
+        pid = spawn_namespaces(nscmd=["make"])
+        ...
+        host_pid = index.to_host(pid, 2)
+        sandbox, ns_pid = index.to_namespace(host_pid)
+        index.kill(pid, 2, signal.SIGTERM)
+        index.stop()
+
+    A sandbox is known by the pid that spawn_namespaces returned, the
+    sandboxes spawned after start() are tracked, others could be added by
+    track(pid). Process groups are the ones of the last fork or exec.
+    """
+    def __init__(self, track_spawned=True):
+        self.track_spawned = track_spawned
+        self.mode = None
+        self.sandboxes = {}
+        self._hosts = {}
+        self._lock = threading.RLock()
+        self._monitor = None
+        self._pidfds = {}
+        self._thread = None
+        self._wake_r = None
+        self._wake_w = None
+        self._stopping = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self.mode is not None:
+            return
+        # fail here, not in the spawn callback, on kernels without NSpid
+        _read_status(os.getpid())
+        monitor = ProcEventMonitor(track_spawned=False)
+        try:
+            monitor.start(self._on_event)
+        except socket.error, e:
+            if e.errno not in [errno.EPERM, errno.EACCES,
+                               errno.EPROTONOSUPPORT]:
+                raise
+            self.mode = "pidfd"
+            self._stopping = False
+            self._wake_r, self._wake_w = os.pipe()
+            for fd in self._wake_r, self._wake_w:
+                _set_cloexec(fd)
+            self._thread = threading.Thread(target=self._watch_pidfds)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self.mode = "events"
+            self._monitor = monitor
+        if self.track_spawned:
+            workbench.register_spawn_callback(self.track)
+
+    def stop(self):
+        if self.mode is None:
+            return
+        if self.track_spawned:
+            workbench.unregister_spawn_callback(self.track)
+        if self._monitor is not None:
+            self._monitor.stop()
+            self._monitor = None
+        if self._thread is not None:
+            self._stopping = True
+            os.write(self._wake_w, "x")
+            self._thread.join()
+            self._thread = None
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+        self._lock.acquire()
+        try:
+            for fd in self._pidfds:
+                os.close(fd)
+            self._pidfds = {}
+            self.sandboxes = {}
+            self._hosts = {}
+        finally:
+            self._lock.release()
+        self.mode = None
+
+    def track(self, pid, sandbox_pid=None):
+        """
+        index the processes of the sandbox that pid was returned for,
+        sandbox_pid is its first process, i.e., pid 1 in a new pid
+        namespace. track could be used as a spawn callback.
+        """
+        if sandbox_pid is None:
+            sandbox_pid = pid
+        if self._monitor is not None:
+            # forks from now on are reported, the others are scanned
+            self._monitor.track(pid, sandbox_pid)
+        status = _read_status(sandbox_pid)
+        if status is None:
+            return
+        self._lock.acquire()
+        try:
+            if pid not in self.sandboxes:
+                self.sandboxes[pid] = _Sandbox(pid, sandbox_pid,
+                                               len(status[0]) - 1)
+        finally:
+            self._lock.release()
+        self.rescan(pid)
+
+    def untrack(self, pid):
+        self._lock.acquire()
+        try:
+            sandbox = self.sandboxes.pop(pid, None)
+            if sandbox is None:
+                return
+            for host_pid in sandbox.to_host.values():
+                self._hosts.pop(host_pid, None)
+            closed = False
+            for fd, host_pid in self._pidfds.items():
+                if host_pid not in self._hosts:
+                    os.close(fd)
+                    del self._pidfds[fd]
+                    closed = True
+            if closed:
+                os.write(self._wake_w, "x")
+        finally:
+            self._lock.release()
+        if self._monitor is not None:
+            self._monitor.untrack(pid)
+
+    def rescan(self, pid):
+        """
+        index the processes of the sandbox that are not indexed yet
+        """
+        sandbox = self.sandboxes.get(pid)
+        if sandbox is None:
+            return
+        pids = [sandbox.init]
+        while pids:
+            host_pid = pids.pop()
+            if host_pid not in self._hosts:
+                self._add(sandbox, host_pid)
+            pids.extend(_children_of(host_pid))
+
+    def _add(self, sandbox, host_pid, status=None):
+        if status is None:
+            status = _read_status(host_pid)
+        if status is None:
+            return
+        nspid, nspgid = status
+        # a process could be in a pid namespace nested in the sandbox
+        if len(nspid) <= sandbox.level:
+            return
+        ns_pid = nspid[sandbox.level]
+        host_pgid = ns_pgid = None
+        if nspgid[0] is not None and len(nspgid) > sandbox.level:
+            host_pgid = int(nspgid[0])
+            ns_pgid = int(nspgid[sandbox.level])
+        pidfd = None
+        if self.mode == "pidfd":
+            try:
+                pidfd = workbench.pidfd_open(host_pid)
+            except Exception:
+                return
+
+        self._lock.acquire()
+        try:
+            if sandbox.key not in self.sandboxes:
+                if pidfd is not None:
+                    os.close(pidfd)
+                return
+            self._remove(host_pid, exited=False)
+            self._hosts[host_pid] = (sandbox, ns_pid, ns_pgid)
+            sandbox.to_host[ns_pid] = host_pid
+            if ns_pgid is not None:
+                sandbox.pgids.setdefault(ns_pgid, [host_pgid, 0])[1] += 1
+            if pidfd is not None:
+                self._pidfds[pidfd] = host_pid
+        finally:
+            self._lock.release()
+        if pidfd is not None:
+            os.write(self._wake_w, "x")
+
+    def _remove(self, host_pid, exited=True):
+        self._lock.acquire()
+        try:
+            record = self._hosts.pop(host_pid, None)
+            if record is None:
+                return
+            sandbox, ns_pid, ns_pgid = record
+            if sandbox.to_host.get(ns_pid) == host_pid:
+                del sandbox.to_host[ns_pid]
+            group = sandbox.pgids.get(ns_pgid)
+            if group is not None:
+                group[1] -= 1
+                if group[1] <= 0:
+                    del sandbox.pgids[ns_pgid]
+            # the pid namespace is gone with its init
+            if exited and host_pid == sandbox.init and sandbox.level > 0:
+                self.untrack(sandbox.key)
+        finally:
+            self._lock.release()
+
+    def _on_event(self, event):
+        if event.what == PROC_EVENT_EXIT:
+            self._remove(event.pid)
+            return
+        sandbox = self.sandboxes.get(event.sandbox)
+        if sandbox is None:
+            return
+        if event.what == PROC_EVENT_FORK:
+            self._add(sandbox, event.pid)
+        elif event.what == PROC_EVENT_EXEC:
+            # setpgid(2) is not reported, it is usually done before exec
+            self._add(sandbox, event.pid)
+
+    def _watch_pidfds(self):
+        while not self._stopping:
+            poller = select.poll()
+            poller.register(self._wake_r, select.POLLIN)
+            self._lock.acquire()
+            try:
+                for fd in self._pidfds:
+                    poller.register(fd, select.POLLIN)
+            finally:
+                self._lock.release()
+            for fd, event in _poll(poller):
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 512)
+                    continue
+                self._lock.acquire()
+                try:
+                    host_pid = self._pidfds.pop(fd, None)
+                    if host_pid is None:
+                        continue
+                    os.close(fd)
+                    self._remove(host_pid)
+                finally:
+                    self._lock.release()
+
+    def to_host(self, pid, ns_pid):
+        """
+        return the host pid of ns_pid in the sandbox of pid, or None
+        """
+        sandbox = self.sandboxes.get(pid)
+        if sandbox is None:
+            return None
+        host_pid = sandbox.to_host.get(ns_pid)
+        if host_pid is None and self.mode == "pidfd":
+            self.rescan(pid)
+            host_pid = sandbox.to_host.get(ns_pid)
+        return host_pid
+
+    def to_namespace(self, host_pid):
+        """
+        return (pid of the sandbox, pid in its pid namespace) of a host
+        pid, or None
+        """
+        record = self._hosts.get(host_pid)
+        if record is None:
+            return None
+        return record[0].key, record[1]
+
+    def host_pgid(self, pid, ns_pgid):
+        """
+        return the host process group of ns_pgid in the sandbox of pid
+        """
+        sandbox = self.sandboxes.get(pid)
+        if sandbox is None:
+            return None
+        group = sandbox.pgids.get(ns_pgid)
+        if group is None:
+            return None
+        return group[0]
+
+    def processes(self, pid):
+        """
+        return {ns_pid: host_pid} of the sandbox of pid
+        """
+        sandbox = self.sandboxes.get(pid)
+        if sandbox is None:
+            return {}
+        self._lock.acquire()
+        try:
+            return dict(sandbox.to_host)
+        finally:
+            self._lock.release()
+
+    def kill(self, pid, ns_pid, signum=signal.SIGTERM):
+        """
+        send signum to ns_pid of the sandbox of pid
+        """
+        host_pid = self.to_host(pid, ns_pid)
+        if host_pid is None:
+            raise OSError(errno.ESRCH, "%d: no such process in %d"
+                          % (ns_pid, pid))
+        os.kill(host_pid, signum)
@@ -0,0 +1,463 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Forward TCP ports of the host to services in the net namespace of a
+sandbox, without veth pairs or NAT.
+
+Sockets on the sandbox side are made in its net namespace, by a thread
+that called setns(2), or by a helper process when we cannot setns from a
+thread. Bytes are moved by splice(2) through a pipe per direction, so
+they stay in the kernel, and one epoll loop serves all connections.
+"""
+
+import os
+import json
+import errno
+import fcntl
+import select
+import socket
+import threading
+import Queue
+
+from procszoo.utils import workbench, _close_cloexec_fds, _fork
+from procszoo.namespaces import NamespaceSettingError
+
+__all__ = ["PortForwarder"]
+
+_SPLICE_F_MOVE = 1
+_SPLICE_F_NONBLOCK = 2
+_F_SETPIPE_SZ = 1031
+_PIPE_SIZE = 1 << 20
+_CHUNK_SIZE = 1 << 20
+_CONNECT_TIMEOUT = 10
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _set_nonblock(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def _address(address):
+    if isinstance(address, int) or isinstance(address, long):
+        return ("127.0.0.1", address)
+    return tuple(address)
+
+def _family(address):
+    if ":" in address[0]:
+        return socket.AF_INET6
+    return socket.AF_INET
+
+def _connect(address, timeout):
+    sock = socket.socket(_family(address), socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.setblocking(0)
+        _set_cloexec(sock.fileno())
+    except:
+        sock.close()
+        raise
+    return sock
+
+class _Connector(object):
+    """
+    make sockets in the net namespace of target. It is used by one
+    thread only, in thread mode that thread joins the net namespace.
+    """
+    def __init__(self, target, use_thread):
+        self.target = target
+        self.use_thread = use_thread
+        self.pid = None
+        self.sock = None
+
+    def start(self):
+        if self.use_thread:
+            ns_files = workbench._ns_files_of_target(self.target, ["net"])
+            workbench._enter_ns_files(ns_files)
+            return
+        ns_files = workbench._ns_files_of_target(self.target,
+                                                 ["user", "net"])
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX,
+                                                    socket.SOCK_SEQPACKET)
+        _set_cloexec(parent_sock.fileno())
+        pid = _fork()
+        if pid == 0:
+            status = 1
+            try:
+                _close_cloexec_fds()
+                workbench._enter_ns_files(ns_files)
+                self._serve(child_sock)
+                status = 0
+            finally:
+                os._exit(status)
+        child_sock.close()
+        self.pid = pid
+        self.sock = parent_sock
+
+    def _serve(self, sock):
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                return
+            request = json.loads(data)
+            try:
+                conn = _connect(_address(request["address"]),
+                                request["timeout"])
+            except (socket.error, socket.timeout), e:
+                workbench.send_fds(sock, json.dumps({"error": "%s" % e}))
+                continue
+            workbench.send_fds(sock, json.dumps({"error": None}),
+                               [conn.fileno()])
+            conn.close()
+
+    def connect(self, address, timeout=_CONNECT_TIMEOUT):
+        if self.use_thread:
+            return _connect(address, timeout)
+        self.sock.send(json.dumps({"address": address, "timeout": timeout}))
+        data, fds = workbench.recv_fds(self.sock, maxfds=1)
+        if not data:
+            raise socket.error(errno.EPIPE, "the connector has gone")
+        reply = json.loads(data)
+        if reply["error"] is not None:
+            raise socket.error(reply["error"])
+        sock = socket.fromfd(fds[0], _family(address), socket.SOCK_STREAM)
+        os.close(fds[0])
+        sock.setblocking(0)
+        return sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.pid is not None:
+            try:
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+            self.pid = None
+
+class _Direction(object):
+    """
+    bytes from src to dst, they wait in the pipe while dst is full
+    """
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.pipe_r, self.pipe_w = os.pipe()
+        for fd in self.pipe_r, self.pipe_w:
+            _set_cloexec(fd)
+            _set_nonblock(fd)
+        try:
+            fcntl.fcntl(self.pipe_w, _F_SETPIPE_SZ, _PIPE_SIZE)
+        except IOError:
+            pass
+        self.pending = 0
+        self.eof = False
+        self.shut = False
+        self.bytes = 0
+
+    @property
+    def reading(self):
+        return not self.eof and not self.pending
+
+    def pump(self):
+        flags = _SPLICE_F_MOVE | _SPLICE_F_NONBLOCK
+        while True:
+            if self.pending:
+                try:
+                    size = workbench.splice(self.pipe_r, self.dst.fileno(),
+                                            self.pending, flags)
+                except OSError, e:
+                    if e.errno == errno.EAGAIN:
+                        return
+                    raise
+                self.pending -= size
+                self.bytes += size
+                continue
+            if self.eof:
+                if not self.shut:
+                    self.shut = True
+                    try:
+                        self.dst.shutdown(socket.SHUT_WR)
+                    except socket.error:
+                        pass
+                return
+            try:
+                size = workbench.splice(self.src.fileno(), self.pipe_w,
+                                        _CHUNK_SIZE, flags)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            if size == 0:
+                self.eof = True
+            self.pending += size
+
+    def close(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+class _Connection(object):
+    def __init__(self, client, remote):
+        self.client = client
+        self.remote = remote
+        self.outbound = _Direction(client, remote)
+        self.inbound = _Direction(remote, client)
+
+    def _events(self, sock):
+        if sock is self.client:
+            reading, writing = self.outbound, self.inbound
+        else:
+            reading, writing = self.inbound, self.outbound
+        events = 0
+        if reading.reading:
+            events |= select.EPOLLIN
+        if writing.pending:
+            events |= select.EPOLLOUT
+        return events
+
+    def register(self, epoll):
+        for sock in self.client, self.remote:
+            epoll.register(sock.fileno(), self._events(sock))
+
+    def handle(self, epoll, sock, events):
+        """
+        move what could be moved, return False if the connection is done
+        """
+        if events & (select.EPOLLHUP | select.EPOLLERR):
+            # the peer could not get any more bytes
+            if sock is self.client and self.outbound.eof:
+                return False
+            if sock is self.remote and self.inbound.eof:
+                return False
+        try:
+            self.outbound.pump()
+            self.inbound.pump()
+        except (OSError, socket.error):
+            return False
+        if self.outbound.shut and self.inbound.shut:
+            return False
+        for sock in self.client, self.remote:
+            epoll.modify(sock.fileno(), self._events(sock))
+        return True
+
+    def close(self, epoll):
+        for sock in self.client, self.remote:
+            try:
+                epoll.unregister(sock.fileno())
+            except (IOError, ValueError):
+                pass
+            sock.close()
+        self.outbound.close()
+        self.inbound.close()
+
+class PortForwarder(object):
+    """
+    E.g.,
+        pid = spawn_namespaces(namespaces=["user", "net", "pid"],
+                               nscmd=["python", "-m", "SimpleHTTPServer"])
+        forwarder = PortForwarder(pid)
+        forwarder.forward(8080, 8000)
+        forwarder.start()
+        ...
+        forwarder.stop()
+
+    target is a pid or a ns_bind_dir. Connections to 127.0.0.1:8080 on
+    the host are relayed to 127.0.0.1:8000 in the net namespace of target,
+    addresses could be ports or (host, port) tuples. If use_thread is
+    None, sockets are made by a thread in the net namespace when we are
+    the superuser, otherwise by a helper process that joins the user and
+    net namespaces of target.
+    """
+    def __init__(self, target, use_thread=None, backlog=128,
+                 connect_timeout=_CONNECT_TIMEOUT):
+        if use_thread is None:
+            use_thread = os.geteuid() == 0
+        self.target = target
+        self.use_thread = use_thread
+        self.backlog = backlog
+        self.connect_timeout = connect_timeout
+        self.listeners = {}
+        self.connections = {}
+        self.accepted = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._requests = Queue.Queue()
+        self._connected = Queue.Queue()
+        self._epoll = None
+        self._wake_r = None
+        self._wake_w = None
+        self._threads = []
+        self._started = threading.Event()
+        self._error = None
+
+    def forward(self, listen, target):
+        """
+        listen on the host, return the address that is listened, that is
+        useful when the port is 0
+        """
+        listen = _address(listen)
+        sock = socket.socket(_family(listen), socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(listen)
+            sock.listen(self.backlog)
+            sock.setblocking(0)
+            _set_cloexec(sock.fileno())
+        except:
+            sock.close()
+            raise
+        self.listeners[sock.fileno()] = (sock, _address(target))
+        if self._epoll is not None:
+            self._epoll.register(sock.fileno(), select.EPOLLIN)
+        return sock.getsockname()
+
+    def start(self):
+        if self._threads:
+            return
+        self._epoll = select.epoll()
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in self._wake_r, self._wake_w:
+            _set_cloexec(fd)
+        _set_nonblock(self._wake_r)
+        self._epoll.register(self._wake_r, select.EPOLLIN)
+        for fd in self.listeners:
+            self._epoll.register(fd, select.EPOLLIN)
+        for target in self._connect_loop, self._relay_loop:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._started.wait()
+        if self._error is not None:
+            self.stop()
+            raise NamespaceSettingError("cannot join the net namespace of "
+                                        "%s: %s" % (self.target, self._error))
+
+    def stop(self):
+        if not self._threads:
+            return
+        self._requests.put(None)
+        self._connected.put(None)
+        os.write(self._wake_w, "x")
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for conn in self.connections.values():
+            self._close_connection(conn)
+        for sock, target in self.listeners.values():
+            sock.close()
+        self.listeners = {}
+        self._epoll.close()
+        self._epoll = None
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _connect_loop(self):
+        connector = _Connector(self.target, self.use_thread)
+        try:
+            connector.start()
+        except Exception, e:
+            self._error = e
+            self._started.set()
+            return
+        self._started.set()
+        try:
+            while True:
+                request = self._requests.get()
+                if request is None:
+                    return
+                client, target = request
+                try:
+                    remote = connector.connect(target, self.connect_timeout)
+                except (socket.error, socket.timeout):
+                    remote = None
+                self._connected.put((client, remote))
+                os.write(self._wake_w, "x")
+        finally:
+            connector.close()
+
+    def _relay_loop(self):
+        self._started.wait()
+        if self._error is not None:
+            return
+        while True:
+            try:
+                events = self._epoll.poll()
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wake_r:
+                    if not self._wake():
+                        return
+                elif fd in self.listeners:
+                    self._accept(*self.listeners[fd])
+                elif fd in self.connections:
+                    conn = self.connections[fd]
+                    sock = conn.client
+                    if fd == conn.remote.fileno():
+                        sock = conn.remote
+                    if not conn.handle(self._epoll, sock, event):
+                        self._close_connection(conn)
+
+    def _accept(self, listener, target):
+        while True:
+            try:
+                client, addr = listener.accept()
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+            client.setblocking(0)
+            _set_cloexec(client.fileno())
+            self.accepted += 1
+            self._requests.put((client, target))
+
+    def _wake(self):
+        try:
+            os.read(self._wake_r, 4096)
+        except OSError:
+            pass
+        while True:
+            try:
+                item = self._connected.get_nowait()
+            except Queue.Empty:
+                return True
+            if item is None:
+                return False
+            client, remote = item
+            if remote is None:
+                self.failed += 1
+                client.close()
+                continue
+            conn = _Connection(client, remote)
+            self.connections[client.fileno()] = conn
+            self.connections[remote.fileno()] = conn
+            conn.register(self._epoll)
+            if not conn.handle(self._epoll, client, 0):
+                self._close_connection(conn)
+
+    def _close_connection(self, conn):
+        for sock in conn.client, conn.remote:
+            self.connections.pop(sock.fileno(), None)
+        self.bytes_out += conn.outbound.bytes
+        self.bytes_in += conn.inbound.bytes
+        conn.close(self._epoll)
+
+    def stats(self):
+        active = set(self.connections.values())
+        return {
+            "accepted": self.accepted,
+            "failed": self.failed,
+            "active": len(active),
+            "bytes_out": self.bytes_out + sum(conn.outbound.bytes
+                                              for conn in active),
+            "bytes_in": self.bytes_in + sum(conn.inbound.bytes
+                                            for conn in active),
+        }
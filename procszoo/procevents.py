@@ -0,0 +1,284 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+fork, exec and exit events of the processes in sandboxes, from the netlink
+process connector, so nobody has to poll /proc.
+
+The kernel only sends these events to the superuser of the initial user
+namespace (CAP_NET_ADMIN).
+"""
+
+import os
+import fcntl
+import errno
+import select
+import socket
+import struct
+import threading
+from collections import namedtuple
+
+from procszoo.utils import workbench, _poll
+
+__all__ = ["ProcEventMonitor", "ProcEvent", "PROC_EVENT_FORK",
+           "PROC_EVENT_EXEC", "PROC_EVENT_EXIT"]
+
+_NETLINK_CONNECTOR = 11
+_CN_IDX_PROC = 1
+_CN_VAL_PROC = 1
+_NLMSG_DONE = 3
+_PROC_CN_MCAST_LISTEN = 1
+_PROC_CN_MCAST_IGNORE = 2
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+_NLMSG_HDR = struct.Struct("=IHHII")
+_CN_MSG = struct.Struct("=IIIIHH")
+_PROC_EVENT = struct.Struct("=IIQ")
+_FORK_EVENT = struct.Struct("=IIII")
+_EXEC_EVENT = struct.Struct("=II")
+_EXIT_EVENT = struct.Struct("=IIII")
+_RECV_SIZE = 65536
+
+PROC_EVENT_FORK = "fork"
+PROC_EVENT_EXEC = "exec"
+PROC_EVENT_EXIT = "exit"
+_PROC_EVENTS = {0x1: PROC_EVENT_FORK, 0x2: PROC_EVENT_EXEC,
+                0x80000000: PROC_EVENT_EXIT}
+
+# pid is the process the event is about, parent is the forking process of
+# a fork event, sandbox is the pid that was tracked, timestamp is the
+# monotonic time of the kernel in nanoseconds, exit_code is a wait status
+ProcEvent = namedtuple("ProcEvent", ["what", "pid", "parent", "exit_code",
+                                     "sandbox", "timestamp"])
+
+def _children_of(pid):
+    children = []
+    try:
+        tasks = os.listdir("/proc/%d/task" % pid)
+    except OSError:
+        return children
+    for task in tasks:
+        try:
+            hdr = open("/proc/%d/task/%s/children" % (pid, task), 'r')
+        except IOError:
+            continue
+        children.extend(int(child) for child in hdr.read().split())
+        hdr.close()
+    return children
+
+class ProcEventMonitor(object):
+    """
+    E.g.,
+        monitor = ProcEventMonitor()
+        monitor.open()
+        spawn_namespaces(nscmd=["make"])
+        for event in monitor.events():
+            print event
+
+    or run callback(event) in a thread,
+        monitor.start(callback)
+        ...
+        monitor.stop()
+
+    Processes of the sandboxes spawned from now on are followed through
+    their fork events, pids could be added by track(pid) as well. With
+    all_processes, the events of every process are delivered.
+    """
+    def __init__(self, track_spawned=True, all_processes=False):
+        self.track_spawned = track_spawned
+        self.all_processes = all_processes
+        self.sandboxes = {}
+        self.lost = 0
+        self.sock = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_r = None
+        self._stop_w = None
+
+    def open(self):
+        if self.sock is not None:
+            return
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                             _NETLINK_CONNECTOR)
+        try:
+            # sandboxes must not get the events of the host
+            _set_cloexec(sock.fileno())
+            # the kernel picks the port id, so monitors could coexist
+            sock.bind((0, _CN_IDX_PROC))
+            self._control(sock, _PROC_CN_MCAST_LISTEN)
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+        if self.track_spawned:
+            workbench.register_spawn_callback(self.track)
+
+    def close(self):
+        if self.sock is None:
+            return
+        if self.track_spawned:
+            workbench.unregister_spawn_callback(self.track)
+        try:
+            self._control(self.sock, _PROC_CN_MCAST_IGNORE)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.sock = None
+
+    def _control(self, sock, op):
+        data = struct.pack("=I", op)
+        cn_msg = _CN_MSG.pack(_CN_IDX_PROC, _CN_VAL_PROC, 0, 0, len(data), 0)
+        length = _NLMSG_HDR.size + len(cn_msg) + len(data)
+        nlmsg = _NLMSG_HDR.pack(length, _NLMSG_DONE, 0, 0,
+                                sock.getsockname()[0])
+        sock.send(nlmsg + cn_msg + data)
+
+    def track(self, pid, sandbox_pid=None):
+        """
+        follow pid, its descendants and sandbox_pid. sandbox_pid is
+        accepted so track could be used as a spawn callback.
+        """
+        self._lock.acquire()
+        try:
+            pids = [pid]
+            if sandbox_pid is not None:
+                pids.append(sandbox_pid)
+            while pids:
+                child = pids.pop()
+                if child in self.sandboxes:
+                    continue
+                self.sandboxes[child] = pid
+                pids.extend(_children_of(child))
+        finally:
+            self._lock.release()
+
+    def untrack(self, pid):
+        """
+        stop following the sandbox that pid belongs to
+        """
+        self._lock.acquire()
+        try:
+            sandbox = self.sandboxes.get(pid)
+            for child, root in self.sandboxes.items():
+                if root == sandbox:
+                    del self.sandboxes[child]
+        finally:
+            self._lock.release()
+
+    def _parse(self, data):
+        events = []
+        offset = 0
+        while offset + _NLMSG_HDR.size <= len(data):
+            length, msg_type = _NLMSG_HDR.unpack_from(data, offset)[:2]
+            if length < _NLMSG_HDR.size:
+                break
+            payload = offset + _NLMSG_HDR.size + _CN_MSG.size
+            if msg_type == _NLMSG_DONE and payload + _PROC_EVENT.size <= \
+                    offset + length:
+                event = self._event(data, payload)
+                if event is not None:
+                    events.append(event)
+            offset += (length + 3) & ~3
+        return events
+
+    def _event(self, data, offset):
+        what, cpu, timestamp = _PROC_EVENT.unpack_from(data, offset)
+        what = _PROC_EVENTS.get(what)
+        if what is None:
+            return None
+        offset += _PROC_EVENT.size
+        parent = None
+        exit_code = None
+        if what == PROC_EVENT_FORK:
+            parent_pid, parent_tgid, pid, tgid = \
+                _FORK_EVENT.unpack_from(data, offset)
+            parent = parent_tgid
+        elif what == PROC_EVENT_EXEC:
+            pid, tgid = _EXEC_EVENT.unpack_from(data, offset)
+        else:
+            pid, tgid, exit_code, exit_signal = \
+                _EXIT_EVENT.unpack_from(data, offset)
+        # threads are not processes
+        if pid != tgid:
+            return None
+
+        self._lock.acquire()
+        try:
+            if what == PROC_EVENT_FORK:
+                sandbox = self.sandboxes.get(parent)
+                if sandbox is not None:
+                    self.sandboxes[pid] = sandbox
+            elif what == PROC_EVENT_EXIT:
+                sandbox = self.sandboxes.pop(pid, None)
+            else:
+                sandbox = self.sandboxes.get(pid)
+        finally:
+            self._lock.release()
+        if sandbox is None and not self.all_processes:
+            return None
+        return ProcEvent(what, pid, parent, exit_code, sandbox, timestamp)
+
+    def read(self):
+        """
+        return the events that are queued in the socket, or wait for one
+        """
+        while True:
+            try:
+                data = self.sock.recv(_RECV_SIZE)
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ENOBUFS:
+                    # the kernel dropped events, we could miss forks
+                    self.lost += 1
+                    continue
+                raise
+            return self._parse(data)
+
+    def events(self, timeout=None):
+        """
+        yield events, stop when nothing comes in timeout seconds
+        """
+        self.open()
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN)
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        while True:
+            if not _poll(poller, timeout):
+                return
+            for event in self.read():
+                yield event
+
+    def start(self, callback):
+        if self._thread is not None:
+            return
+        self.open()
+        self._stop_r, self._stop_w = os.pipe()
+        for fd in self._stop_r, self._stop_w:
+            _set_cloexec(fd)
+        self._thread = threading.Thread(target=self._run, args=(callback,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            os.write(self._stop_w, "x")
+            self._thread.join()
+            self._thread = None
+            os.close(self._stop_r)
+            os.close(self._stop_w)
+        self.close()
+
+    def _run(self, callback):
+        poller = select.poll()
+        poller.register(self._stop_r, select.POLLIN)
+        poller.register(self.sock.fileno(), select.POLLIN)
+        while True:
+            for fd, event in _poll(poller):
+                if fd == self._stop_r:
+                    return
+                for proc_event in self.read():
+                    callback(proc_event)
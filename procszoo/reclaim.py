@@ -0,0 +1,210 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Detach the namespace files that bind_ns_files left in ns_bind_dirs once
+their namespaces have no processes, or once they are older than a TTL.
+
+A bound namespace file pins the namespace, e.g., a whole network stack,
+and every mount is copied into each new mount namespace. The age of a
+bound file is the ctime of its nsfs inode, which is made when the
+namespace file is opened to be bound.
+"""
+
+import os
+import re
+import select
+import threading
+import time
+
+from procszoo.utils import workbench, _poll
+from procszoo.mountinfo import MountTable
+
+__all__ = ["NsBindReclaimer", "reclaim_ns_binds"]
+
+_NS_ROOT = re.compile(r"^(\w+):\[(\d+)\]$")
+
+def _slab_kb():
+    try:
+        hdr = open("/proc/meminfo", 'r')
+    except IOError:
+        return None
+    try:
+        for line in hdr:
+            if line.startswith("Slab:"):
+                return int(line.split()[1])
+    finally:
+        hdr.close()
+    return None
+
+def _live_namespaces(entries):
+    """
+    return the set of (entry, inode) of the namespaces of every thread
+    """
+    live = set()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            tasks = os.listdir("/proc/%s/task" % pid)
+        except OSError:
+            continue
+        # threads could setns on their own, e.g., into another net
+        for task in tasks:
+            for entry in entries:
+                try:
+                    link = os.readlink("/proc/%s/task/%s/ns/%s"
+                                       % (pid, task, entry))
+                except OSError:
+                    continue
+                match = _NS_ROOT.match(link)
+                if match is not None:
+                    live.add((match.group(1), int(match.group(2))))
+            if len(tasks) == 1:
+                break
+    return live
+
+class NsBindReclaimer(object):
+    """
+    E.g.,
+        reclaimer = NsBindReclaimer(["/tmp/ns"], ttl=3600)
+        print reclaimer.reclaim()
+
+    or every interval seconds in a thread, callback(report) is called
+    after each pass that detached something,
+        reclaimer.start(interval=60, callback=callback)
+        ...
+        reclaimer.stop()
+
+    A bound file is stale if no process is in its namespace, or if it
+    is older than ttl seconds. Pass ttl=None to reclaim only the
+    namespaces without processes. Empty files left by the unmounts are
+    removed with remove_files, so the ns_bind_dirs could be removed.
+    """
+    def __init__(self, ns_bind_dirs, ttl=None, remove_files=False,
+                 settle=0):
+        if isinstance(ns_bind_dirs, basestring):
+            ns_bind_dirs = [ns_bind_dirs]
+        self.ns_bind_dirs = [os.path.abspath(path) for path in ns_bind_dirs]
+        self.ttl = ttl
+        self.remove_files = remove_files
+        self.settle = settle
+        self.passes = 0
+        self.total_detached = 0
+        self._thread = None
+        self._stop_r = None
+        self._stop_w = None
+
+    def find(self):
+        """
+        return [(MountInfo, entry, inode, reason)] of the stale bound files
+        """
+        table = MountTable()
+        bound = []
+        for path in self.ns_bind_dirs:
+            for mount in table.below(path):
+                match = _NS_ROOT.match(mount.root)
+                if match is not None:
+                    bound.append((mount, match.group(1),
+                                  int(match.group(2))))
+        if not bound:
+            return []
+
+        live = _live_namespaces(set(entry for mount, entry, inode in bound))
+        now = time.time()
+        stale = []
+        for mount, entry, inode in bound:
+            if (entry, inode) not in live:
+                stale.append((mount, entry, inode, "no process"))
+                continue
+            if self.ttl is None:
+                continue
+            try:
+                age = now - os.stat(mount.mount_point).st_ctime
+            except OSError:
+                continue
+            if age > self.ttl:
+                stale.append((mount, entry, inode, "expired"))
+        return stale
+
+    def reclaim(self):
+        """
+        detach the stale bound files, return a report dict
+        """
+        start = time.time()
+        slab = _slab_kb()
+        flags = workbench.functions["umount2"].extra["flag"]["MNT_DETACH"]
+        stale = self.find()
+        detached = []
+        namespaces = {}
+        errors = []
+        # a file could be bound more than once, the top mount goes first
+        stale.sort(key=lambda item: -item[0].mount_id)
+        for mount, entry, inode, reason in stale:
+            try:
+                workbench._call_c_func("umount2", mount.mount_point, flags)
+            except OSError, e:
+                errors.append("%s: %s" % (mount.mount_point, e.strerror))
+                continue
+            detached.append({"path": mount.mount_point,
+                             "namespace": "%s:[%d]" % (entry, inode),
+                             "reason": reason})
+            namespaces[entry] = namespaces.get(entry, 0) + 1
+
+        if self.remove_files:
+            table = MountTable()
+            for path in sorted(set(item["path"] for item in detached)):
+                if table.is_mount_point(path):
+                    continue
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+        # net namespaces are cleaned up by a kernel worker after this
+        if self.settle:
+            time.sleep(self.settle)
+        slab_freed_kb = None
+        if slab is not None and detached:
+            slab_freed_kb = slab - (_slab_kb() or slab)
+        self.passes += 1
+        self.total_detached += len(detached)
+        return {"detached": detached, "namespaces": namespaces,
+                "errors": errors, "slab_freed_kb": slab_freed_kb,
+                "elapsed": time.time() - start}
+
+    def start(self, interval=60, callback=None):
+        if self._thread is not None:
+            return
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(interval, callback))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, interval, callback):
+        poller = select.poll()
+        poller.register(self._stop_r, select.POLLIN)
+        while True:
+            report = self.reclaim()
+            if callback is not None and (report["detached"] or
+                                         report["errors"]):
+                callback(report)
+            if _poll(poller, int(interval * 1000)):
+                return
+
+    def stop(self):
+        if self._thread is not None:
+            os.write(self._stop_w, "x")
+            self._thread.join()
+            self._thread = None
+            os.close(self._stop_r)
+            os.close(self._stop_w)
+
+def reclaim_ns_binds(ns_bind_dirs, ttl=None, remove_files=False):
+    """
+    detach the stale bound namespace files once, return the report of
+    NsBindReclaimer.reclaim
+    """
+    return NsBindReclaimer(ns_bind_dirs, ttl=ttl,
+                           remove_files=remove_files).reclaim()
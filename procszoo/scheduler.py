@@ -0,0 +1,436 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Admission control for bursts of spawn_namespaces.
+
+Spawn requests wait in a priority queue and are admitted when a per-CPU
+budget, the kernel namespace limits in /proc/sys/user and the pids limit
+of our cgroup leave room for them, instead of failing in unshare(2).
+"""
+
+import os
+import fcntl
+import heapq
+import select
+import threading
+import time
+
+from procszoo.utils import workbench, _poll
+from procszoo.inventory import NamespacesInventory
+
+__all__ = ["SpawnScheduler", "SpawnTicket", "SchedulerBusy"]
+
+_PROC_SYS_USER = "/proc/sys/user"
+_CGROUP_ROOT = "/sys/fs/cgroup"
+_POLL_TIMEOUT = 1000
+
+class SchedulerBusy(RuntimeError):
+    pass
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _read_int(path):
+    try:
+        hdr = open(path, 'r')
+    except IOError:
+        return None
+    try:
+        value = hdr.read().strip()
+    finally:
+        hdr.close()
+    if value.isdigit():
+        return int(value)
+    return None
+
+def _pids_cgroup():
+    try:
+        hdr = open("/proc/self/cgroup", 'r')
+    except IOError:
+        return None
+    path = None
+    for line in hdr:
+        fields = line.strip().split(":", 2)
+        if len(fields) != 3:
+            continue
+        if fields[0] == "0" or "pids" in fields[1].split(","):
+            if fields[0] == "0":
+                candidate = "%s%s" % (_CGROUP_ROOT, fields[2])
+            else:
+                candidate = "%s/pids%s" % (_CGROUP_ROOT, fields[2])
+            if os.path.exists("%s/pids.max" % candidate):
+                path = candidate
+    hdr.close()
+    return path
+
+class SpawnTicket(object):
+    """
+    a queued spawn request, wait() returns the pid once it is spawned
+    """
+    def __init__(self, priority, plan, nscmd):
+        self.priority = priority
+        self.plan = plan
+        self.nscmd = nscmd
+        self.submitted = time.time()
+        self.started = None
+        self.pid = None
+        self.error = None
+        self.cancelled = False
+        self._event = threading.Event()
+
+    @property
+    def wait_time(self):
+        if self.started is None:
+            return time.time() - self.submitted
+        return self.started - self.submitted
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        if not self._event.is_set():
+            raise SchedulerBusy("not spawned in %s seconds" % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.pid
+
+    def _finish(self, pid=None, error=None):
+        self.started = time.time()
+        self.pid = pid
+        self.error = error
+        self._event.set()
+
+class SpawnScheduler(object):
+    """
+    E.g.,
+        scheduler = SpawnScheduler(per_cpu=2)
+        scheduler.start()
+        ticket = scheduler.submit(priority=10, nscmd=["make"])
+        pid = ticket.wait()
+        ...
+        print scheduler.stats()
+        scheduler.stop()
+
+    submit() takes the arguments of spawn_plan, requests with lower
+    priority numbers are spawned first. At most per_cpu * CPUs sandboxes
+    run at once, unless max_running is given. A sandbox is admitted only
+    if the namespaces it needs stay below headroom of the kernel limits
+    and two more pids fit in our pids cgroup. When max_queue requests
+    are waiting, submit() blocks or raises SchedulerBusy.
+
+    A sandbox holds its slot until its keeper process exits.
+
+    live_namespaces counts the namespaces of every process on the host,
+    from a NamespacesInventory rescanned at most every scan_interval
+    seconds, plus the ones we have spawned since. Namespaces that are
+    kept only by bind mounts or open fds are not counted.
+    """
+    def __init__(self, per_cpu=2, max_running=None, max_queue=1024,
+                 headroom=0.9, proc_sys_user=_PROC_SYS_USER,
+                 scan_interval=1.0):
+        if max_running is None:
+            max_running = per_cpu * os.sysconf("SC_NPROCESSORS_ONLN")
+        self.max_running = max(1, max_running)
+        self.max_queue = max_queue
+        self.headroom = headroom
+        self.proc_sys_user = proc_sys_user
+        self.limits = {}
+        self.live_namespaces = {}
+        self.scan_interval = scan_interval
+        self._inventory = NamespacesInventory()
+        self._scanned = None
+        self.running = {}
+        self.admitted = 0
+        self.failed = 0
+        self.deferred_by_limits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._queue = []
+        self._seq = 0
+        self._lock = threading.Condition()
+        self._thread = None
+        self._stop = False
+        self._wake_r = None
+        self._wake_w = None
+        self._pids_cgroup = _pids_cgroup()
+        self.refresh_limits()
+        self.refresh_namespaces()
+
+    def refresh_limits(self):
+        """
+        reread max_*_namespaces and pids.max
+        """
+        limits = {}
+        for ns in workbench.namespaces.namespaces:
+            entry = getattr(workbench.namespaces, ns).entry
+            value = _read_int("%s/max_%s_namespaces"
+                              % (self.proc_sys_user, entry))
+            if value is not None:
+                limits[ns] = value
+        if self._pids_cgroup is not None:
+            value = _read_int("%s/pids.max" % self._pids_cgroup)
+            if value is not None:
+                limits["pids"] = value
+        self.limits = limits
+        return limits
+
+    def refresh_namespaces(self):
+        """
+        recount the live namespaces of the host
+        """
+        self._inventory.scan()
+        counts = self._inventory.counts()
+        live_namespaces = {}
+        for ns in workbench.namespaces.namespaces:
+            entry = getattr(workbench.namespaces, ns).entry
+            if entry in counts:
+                live_namespaces[ns] = counts[entry]
+        self._lock.acquire()
+        try:
+            self.live_namespaces = live_namespaces
+            self._scanned = time.time()
+        finally:
+            self._lock.release()
+        return live_namespaces
+
+    def queue_depth(self):
+        self._lock.acquire()
+        try:
+            return len(self._queue)
+        finally:
+            self._lock.release()
+
+    def submit(self, priority=0, block=True, timeout=None, **kwargs):
+        """
+        queue a spawn request, kwargs are passed to spawn_plan. Return a
+        SpawnTicket.
+        """
+        if self._thread is None:
+            raise SchedulerBusy("scheduler is not started")
+        plan = workbench.spawn_plan(**kwargs)
+        ticket = SpawnTicket(priority, plan, kwargs.get("nscmd"))
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._lock.acquire()
+        try:
+            while len(self._queue) >= self.max_queue:
+                if not block:
+                    raise SchedulerBusy("%d spawn requests are waiting"
+                                        % len(self._queue))
+                if deadline is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise SchedulerBusy("%d spawn requests are waiting"
+                                            % len(self._queue))
+                    self._lock.wait(remaining)
+            heapq.heappush(self._queue, (priority, self._seq, ticket))
+            self._seq += 1
+        finally:
+            self._lock.release()
+        self._wake()
+        return ticket
+
+    def cancel(self, ticket):
+        """
+        drop a ticket that is still queued, return True if so
+        """
+        self._lock.acquire()
+        try:
+            for i, item in enumerate(self._queue):
+                if item[2] is ticket:
+                    del self._queue[i]
+                    heapq.heapify(self._queue)
+                    ticket.cancelled = True
+                    ticket._finish(error=SchedulerBusy("cancelled"))
+                    self._lock.notify_all()
+                    return True
+            return False
+        finally:
+            self._lock.release()
+
+    def _wake(self):
+        if self._wake_w is not None:
+            try:
+                os.write(self._wake_w, "x")
+            except OSError:
+                pass
+
+    def _fits(self, plan):
+        if len(self.running) >= self.max_running:
+            return False
+        for ns in plan.namespaces:
+            limit = self.limits.get(ns)
+            if limit is None:
+                continue
+            if self.live_namespaces.get(ns, 0) + 1 > limit * self.headroom:
+                return False
+        if "pids" in self.limits:
+            current = _read_int("%s/pids.current" % self._pids_cgroup)
+            if (current is not None and
+                    current + 2 > self.limits["pids"] * self.headroom):
+                return False
+        return True
+
+    def _admit(self):
+        if (self._scanned is None or
+                time.time() - self._scanned >= self.scan_interval):
+            self.refresh_namespaces()
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._queue:
+                    return
+                priority, seq, ticket = self._queue[0]
+                if not self._fits(ticket.plan):
+                    if len(self.running) < self.max_running:
+                        self.deferred_by_limits += 1
+                    return
+                heapq.heappop(self._queue)
+                self._lock.notify_all()
+            finally:
+                self._lock.release()
+            self._launch(ticket)
+
+    def _launch(self, ticket):
+        try:
+            pid = ticket.plan.launch(ticket.nscmd)
+        except Exception, e:
+            self._lock.acquire()
+            try:
+                self.failed += 1
+            finally:
+                self._lock.release()
+            ticket._finish(error=e)
+            return
+        try:
+            pidfd = workbench.pidfd_open(pid)
+        except Exception:
+            pidfd = None
+        self._lock.acquire()
+        try:
+            self.running[pid] = (pidfd, ticket.plan.namespaces)
+            for ns in ticket.plan.namespaces:
+                self.live_namespaces[ns] = self.live_namespaces.get(ns, 0) + 1
+            ticket._finish(pid=pid)
+            self.admitted += 1
+            self.total_wait += ticket.wait_time
+            self.max_wait = max(self.max_wait, ticket.wait_time)
+        finally:
+            self._lock.release()
+
+    def _release(self, pid):
+        self._lock.acquire()
+        try:
+            pidfd, namespaces = self.running.pop(pid)
+            for ns in namespaces:
+                self.live_namespaces[ns] = max(
+                    0, self.live_namespaces.get(ns, 0) - 1)
+        finally:
+            self._lock.release()
+        if pidfd is not None:
+            os.close(pidfd)
+
+    def _exited(self, pid):
+        # without pidfd, a keeper that has exited is a zombie or gone
+        try:
+            hdr = open("/proc/%d/stat" % pid, 'r')
+        except IOError:
+            return True
+        try:
+            stat = hdr.read()
+        finally:
+            hdr.close()
+        return stat[stat.rindex(")") + 2] in "ZX"
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop = False
+        self._wake_r, self._wake_w = os.pipe()
+        # the sandboxes we launch must not inherit them
+        for fd in self._wake_r, self._wake_w:
+            _set_cloexec(fd)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        stop admitting requests, the queued tickets fail
+        """
+        if self._thread is None:
+            return
+        self._stop = True
+        self._wake()
+        self._thread.join()
+        self._thread = None
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        self._wake_r = self._wake_w = None
+        self._lock.acquire()
+        try:
+            for priority, seq, ticket in self._queue:
+                ticket._finish(error=SchedulerBusy("scheduler is stopped"))
+            self._queue = []
+            self._lock.notify_all()
+        finally:
+            self._lock.release()
+        for pid in self.running.keys():
+            self._release(pid)
+
+    def _run(self):
+        while not self._stop:
+            self._admit()
+            poller = select.poll()
+            poller.register(self._wake_r, select.POLLIN)
+            pidfds = {}
+            self._lock.acquire()
+            try:
+                for pid, (pidfd, namespaces) in self.running.items():
+                    if pidfd is None:
+                        if self._exited(pid):
+                            pidfds[None] = pid
+                        continue
+                    pidfds[pidfd] = pid
+                    poller.register(pidfd, select.POLLIN)
+            finally:
+                self._lock.release()
+            if None in pidfds:
+                self._release(pidfds.pop(None))
+                continue
+            for fd, event in _poll(poller, _POLL_TIMEOUT):
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                else:
+                    self._release(pidfds[fd])
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            waiting = [ticket.wait_time for priority, seq, ticket
+                       in self._queue]
+            stats = {
+                "queue_depth": len(self._queue),
+                "running": len(self.running),
+                "max_running": self.max_running,
+                "admitted": self.admitted,
+                "failed": self.failed,
+                "deferred_by_limits": self.deferred_by_limits,
+                "max_wait": self.max_wait,
+                "oldest_wait": max(waiting or [0.0]),
+                "live_namespaces": dict(self.live_namespaces),
+                "limits": dict(self.limits),
+            }
+            if self.admitted:
+                stats["avg_wait"] = self.total_wait / self.admitted
+            else:
+                stats["avg_wait"] = 0.0
+            return stats
+        finally:
+            self._lock.release()
@@ -0,0 +1,205 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Share memory between the host and sandboxes through sealed memfd.
+
+A buffer is an anonymous memfd mapped on both sides, so nothing is copied
+and no mount namespace has to see a common filesystem. The fd goes to a
+sandbox by inheritance at spawn, or over an unix socket.
+"""
+
+import os
+import json
+import mmap
+import fcntl
+
+from procszoo.utils import workbench
+
+__all__ = ["SharedBuffer", "SharedBufferError", "create_shared_buffer",
+           "receive_shared_buffer"]
+
+_F_ADD_SEALS = 1033
+_F_GET_SEALS = 1034
+_F_SEAL_SEAL = 0x0001
+_F_SEAL_SHRINK = 0x0002
+_F_SEAL_GROW = 0x0004
+_F_SEAL_WRITE = 0x0008
+_COPY_SIZE = 1 << 20
+
+class SharedBufferError(RuntimeError):
+    pass
+
+class SharedBuffer(object):
+    """
+    a memfd and its mapping, e.g.,
+        buf = create_shared_buffer(data=open("input.bin").read())
+        buf.seal()
+        fd = buf.inherit()
+        spawn_namespaces(nscmd=["worker", "%d" % fd])
+
+    and in the worker,
+        buf = SharedBuffer(int(sys.argv[1]))
+        data = buf.view()
+
+    A buffer whose writes are sealed is mapped read-only, others are
+    mapped read-write. The buffer owns fd and closes it.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.size = os.fstat(fd).st_size
+        self.mmap = None
+        self._map()
+
+    def _map(self):
+        if self.size == 0:
+            self.mmap = None
+            return
+        if self.readonly:
+            prot = mmap.PROT_READ
+        else:
+            prot = mmap.PROT_READ | mmap.PROT_WRITE
+        self.mmap = mmap.mmap(self.fd, self.size, mmap.MAP_SHARED, prot)
+
+    def _unmap(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def seals(self):
+        return fcntl.fcntl(self.fd, _F_GET_SEALS)
+
+    @property
+    def readonly(self):
+        return bool(self.seals() & _F_SEAL_WRITE)
+
+    @property
+    def sealed(self):
+        return bool(self.seals() & _F_SEAL_SEAL)
+
+    def seal(self, write=True):
+        """
+        fix the size of the buffer, and its content if write is True.
+        Nobody could change the seals after that.
+        """
+        seals = _F_SEAL_SHRINK | _F_SEAL_GROW | _F_SEAL_SEAL
+        if write:
+            seals |= _F_SEAL_WRITE
+            # F_SEAL_WRITE is refused while a writable shared mapping exists
+            self._unmap()
+        try:
+            fcntl.fcntl(self.fd, _F_ADD_SEALS, seals)
+        except IOError, e:
+            raise SharedBufferError("cannot seal the buffer: %s"
+                                    % os.strerror(e.errno))
+        finally:
+            if self.mmap is None:
+                self._map()
+
+    def resize(self, size):
+        self._unmap()
+        try:
+            os.ftruncate(self.fd, size)
+        except OSError, e:
+            raise SharedBufferError("cannot resize the buffer: %s"
+                                    % os.strerror(e.errno))
+        finally:
+            self.size = os.fstat(self.fd).st_size
+            self._map()
+
+    def view(self, offset=0, size=None):
+        """
+        return a read-only buffer object of the mapping, nothing is copied
+        """
+        if self.mmap is None:
+            return buffer("")
+        if size is None:
+            return buffer(self.mmap, offset)
+        return buffer(self.mmap, offset, size)
+
+    def write(self, data, offset=0):
+        if self.readonly:
+            raise SharedBufferError("the buffer is sealed")
+        if offset + len(data) > self.size:
+            raise SharedBufferError("%d bytes do not fit in the buffer"
+                                    % len(data))
+        self.mmap[offset:offset + len(data)] = data
+
+    def inherit(self):
+        """
+        let the fd survive exec, so a spawned command could use it.
+        Return the fd.
+        """
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFD)
+        fcntl.fcntl(self.fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        return self.fd
+
+    def send(self, sock, meta=None):
+        """
+        send the fd over an unix domain socket, meta is any json data
+        that goes with it
+        """
+        header = json.dumps({"size": self.size, "meta": meta})
+        workbench.send_fds(sock, header, [self.fd])
+
+    def close(self):
+        self._unmap()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+def create_shared_buffer(size=None, data=None, path=None, name="procszoo"):
+    """
+    create a buffer of size bytes, filled with data or the content of the
+    file path. The buffer is not sealed.
+    """
+    fd = workbench.memfd_create(name)
+    try:
+        if path is not None:
+            _copy_file(path, fd)
+        elif data is not None:
+            _write_all(fd, data)
+        if size is not None:
+            os.ftruncate(fd, size)
+        return SharedBuffer(fd)
+    except:
+        os.close(fd)
+        raise
+
+def _write_all(fd, data):
+    view = buffer(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _copy_file(path, fd):
+    src = os.open(path, os.O_RDONLY)
+    try:
+        while True:
+            data = os.read(src, _COPY_SIZE)
+            if not data:
+                break
+            _write_all(fd, data)
+    finally:
+        os.close(src)
+
+def receive_shared_buffer(sock, readonly=False):
+    """
+    receive a buffer that is sent by SharedBuffer.send, return
+    (buffer, meta). With readonly, a buffer that could still be written by
+    the sender is refused.
+    """
+    data, fds = workbench.recv_fds(sock, maxfds=1)
+    if not fds:
+        raise SharedBufferError("no buffer is received")
+    buf = SharedBuffer(fds[0])
+    if readonly and not (buf.readonly and buf.sealed):
+        buf.close()
+        raise SharedBufferError("the buffer is not sealed")
+    return buf, json.loads(data)["meta"]
@@ -0,0 +1,315 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+Tear sandboxes down in the background.
+
+Killing the processes of a sandbox, waiting for them, detaching its
+bound namespace files and mounts and removing its cgroups are queued and
+done by a worker thread, so the caller returns at once. The worker takes
+the queued sandboxes in batches: it kills every sandbox of a batch before
+it waits for any, and reads the mount table once per batch.
+"""
+
+import os
+import errno
+import signal
+import threading
+import time
+import Queue
+
+from procszoo.utils import workbench
+from procszoo.mountinfo import MountTable
+
+__all__ = ["TeardownQueue", "TeardownTicket", "TeardownBusy"]
+
+_BATCH_SIZE = 32
+_MAX_QUEUE = 1024
+_KILL_TIMEOUT = 5
+_CGROUP_TIMEOUT = 5
+
+class TeardownBusy(RuntimeError):
+    pass
+
+def _descendants(pid):
+    pids = []
+    children = [pid]
+    while children:
+        child = children.pop()
+        pids.append(child)
+        try:
+            tasks = os.listdir("/proc/%d/task" % child)
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                hdr = open("/proc/%d/task/%s/children" % (child, task), 'r')
+            except IOError:
+                continue
+            children.extend(int(pid) for pid in hdr.read().split())
+            hdr.close()
+    return pids
+
+def _alive(pid):
+    try:
+        hdr = open("/proc/%d/stat" % pid, 'r')
+    except IOError:
+        return False
+    try:
+        stat = hdr.read()
+    finally:
+        hdr.close()
+    return stat[stat.rindex(")") + 2] not in "ZX"
+
+class TeardownTicket(object):
+    """
+    a queued teardown, wait() returns when it is done
+    """
+    def __init__(self, pid, ns_bind_dir, mounts, cgroups, callback):
+        self.pid = pid
+        self.ns_bind_dir = ns_bind_dir
+        self.mounts = mounts or []
+        self.cgroups = cgroups or []
+        self.callback = callback
+        self.status = None
+        self.errors = []
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self._event = threading.Event()
+
+    @property
+    def wait_time(self):
+        if self.started is None:
+            return time.time() - self.queued
+        return self.started - self.queued
+
+    @property
+    def latency(self):
+        """
+        seconds from defer() to the end of the cleanup
+        """
+        if self.finished is None:
+            return None
+        return self.finished - self.queued
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+class TeardownQueue(object):
+    """
+    E.g.,
+        teardown = TeardownQueue()
+        teardown.start()
+        pid = spawn_namespaces(ns_bind_dir="/tmp/ns", nscmd=["sleep", "60"])
+        ...
+        teardown.defer(pid, ns_bind_dir="/tmp/ns")
+        ...
+        teardown.stop()
+        print teardown.stats()
+
+    pid is the pid that spawn_namespaces returned, it is killed with its
+    descendants and waited for if it is our child. Then the bound files
+    in ns_bind_dir and mounts are lazily detached, and cgroups, i.e.,
+    cgroup directories, are removed. callback(ticket) is called by the
+    worker after that. When max_queue teardowns are waiting, defer()
+    blocks or raises TeardownBusy.
+    """
+    def __init__(self, max_queue=_MAX_QUEUE, batch_size=_BATCH_SIZE,
+                 kill_signal=signal.SIGKILL, kill_timeout=_KILL_TIMEOUT):
+        self.batch_size = max(1, batch_size)
+        self.kill_signal = kill_signal
+        self.kill_timeout = kill_timeout
+        self.done_count = 0
+        self.failed = 0
+        self.batches = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._queue = Queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def defer(self, pid=None, ns_bind_dir=None, mounts=None, cgroups=None,
+              callback=None, block=True, timeout=None):
+        """
+        queue the teardown of a sandbox, return a TeardownTicket
+        """
+        ticket = TeardownTicket(pid, ns_bind_dir, mounts, cgroups, callback)
+        try:
+            self._queue.put(ticket, block, timeout)
+        except Queue.Full:
+            raise TeardownBusy("%d teardowns are waiting"
+                               % self._queue.qsize())
+        return ticket
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """
+        stop the worker after the queued teardowns are done
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            batch = [ticket for ticket in batch if ticket is not None]
+            if batch:
+                self._teardown(batch)
+            if stopping:
+                return
+
+    def _teardown(self, batch):
+        for ticket in batch:
+            ticket.started = time.time()
+        self._kill(batch)
+        self._unbind(batch)
+        for ticket in batch:
+            for mount_point in ticket.mounts:
+                self._detach(ticket, mount_point)
+        self._remove_cgroups(batch)
+
+        self._lock.acquire()
+        try:
+            self.batches += 1
+            for ticket in batch:
+                ticket.finished = time.time()
+                self.done_count += 1
+                if ticket.errors:
+                    self.failed += 1
+                self.total_latency += ticket.latency
+                self.max_latency = max(self.max_latency, ticket.latency)
+        finally:
+            self._lock.release()
+        for ticket in batch:
+            ticket._event.set()
+            if ticket.callback is not None:
+                try:
+                    ticket.callback(ticket)
+                except Exception, e:
+                    ticket.errors.append("callback: %s" % e)
+
+    def _kill(self, batch):
+        # every sandbox is signalled before we wait for any of them, so
+        # the kernel tears their namespaces down in parallel
+        waiting = []
+        for ticket in batch:
+            if ticket.pid is None:
+                continue
+            for pid in _descendants(ticket.pid):
+                try:
+                    os.kill(pid, self.kill_signal)
+                except OSError, e:
+                    if e.errno != errno.ESRCH:
+                        ticket.errors.append("kill %d: %s"
+                                             % (pid, e.strerror))
+            waiting.append(ticket)
+
+        deadline = time.time() + self.kill_timeout
+        delay = 0.001
+        while waiting:
+            for ticket in list(waiting):
+                try:
+                    pid, status = os.waitpid(ticket.pid, os.WNOHANG)
+                except OSError, e:
+                    if e.errno != errno.ECHILD:
+                        ticket.errors.append("waitpid: %s" % e.strerror)
+                        waiting.remove(ticket)
+                    # not our child, or reaped by someone else
+                    elif not _alive(ticket.pid):
+                        waiting.remove(ticket)
+                    continue
+                if pid != 0:
+                    ticket.status = status
+                    waiting.remove(ticket)
+            if not waiting:
+                break
+            if time.time() > deadline:
+                for ticket in waiting:
+                    ticket.errors.append("%d is still alive" % ticket.pid)
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def _unbind(self, batch):
+        tickets = [ticket for ticket in batch
+                   if ticket.ns_bind_dir is not None]
+        if not tickets:
+            return
+        table = MountTable()
+        for ticket in tickets:
+            path = os.path.abspath(ticket.ns_bind_dir)
+            # the top mount goes first if a file is bound more than once
+            for mount in sorted(table.below(path), reverse=True):
+                self._detach(ticket, mount.mount_point)
+
+    def _detach(self, ticket, mount_point):
+        flags = workbench.functions["umount2"].extra["flag"]["MNT_DETACH"]
+        try:
+            workbench._call_c_func("umount2", mount_point, flags)
+        except OSError, e:
+            if e.errno not in [errno.EINVAL, errno.ENOENT]:
+                ticket.errors.append("%s: %s" % (mount_point, e.strerror))
+
+    def _remove_cgroups(self, batch):
+        pending = [(ticket, path) for ticket in batch
+                   for path in ticket.cgroups]
+        deadline = time.time() + _CGROUP_TIMEOUT
+        delay = 0.001
+        # a cgroup could be removed only after its last process is gone,
+        # the children first
+        pending.sort(key=lambda item: -item[1].count("/"))
+        while pending:
+            for ticket, path in list(pending):
+                try:
+                    os.rmdir(path)
+                except OSError, e:
+                    if e.errno == errno.EBUSY and time.time() < deadline:
+                        continue
+                    if e.errno != errno.ENOENT:
+                        ticket.errors.append("%s: %s" % (path, e.strerror))
+                pending.remove((ticket, path))
+            if pending:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            stats = {
+                "queue_depth": self._queue.qsize(),
+                "done": self.done_count,
+                "failed": self.failed,
+                "batches": self.batches,
+                "max_latency": self.max_latency,
+            }
+            if self.done_count:
+                stats["avg_latency"] = self.total_latency / self.done_count
+            else:
+                stats["avg_latency"] = 0.0
+            return stats
+        finally:
+            self._lock.release()
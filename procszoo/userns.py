@@ -0,0 +1,84 @@
+# Copyright 2016 Red Hat, Inc. All Rights Reserved.
+# Licensed to GPL under a Contributor Agreement.
+
+"""
+One user namespace, mapped once, shared by many sandboxes.
+
+A new user namespace is useless until its parent writes uid_map and
+gid_map, so each spawn that makes one waits for a round trip to us.
+Sandboxes spawned with userns=SharedUserNamespace join a user namespace
+that a holder process keeps alive, and only unshare the other namespaces.
+The caller needs no privilege more than for a new user namespace: the
+owner of a user namespace has every capability in it.
+"""
+
+import os
+import fcntl
+
+from procszoo.utils import workbench
+
+__all__ = ["SharedUserNamespace"]
+
+class SharedUserNamespace(object):
+    """
+    E.g.,
+        userns = SharedUserNamespace(maproot=True)
+        userns.start()
+        for i in range(100):
+            spawn_namespaces(userns=userns, nscmd=["id"])
+        userns.stop()
+
+    maproot, users_map, groups_map and setgroups are the same as the ones
+    of spawn_namespaces. The holder exits when stop() is called, or when
+    this process exits.
+    """
+    def __init__(self, maproot=True, users_map=None, groups_map=None,
+                 setgroups=None):
+        self.maproot = maproot
+        self.users_map = users_map
+        self.groups_map = groups_map
+        self.setgroups = setgroups
+        self.pid = None
+        self.ns_file = None
+        self._w = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        if self.pid is not None:
+            return
+        plan = workbench.spawn_plan(
+            namespaces=["user"], maproot=self.maproot, mountproc=False,
+            users_map=self.users_map, groups_map=self.groups_map,
+            setgroups=self.setgroups)
+        r, w = os.pipe()
+        # sandboxes must not keep the holder alive
+        fcntl.fcntl(w, fcntl.F_SETFD,
+                    fcntl.fcntl(w, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        def hold():
+            while os.read(r, 1):
+                pass
+        try:
+            self.pid = plan.launch(target=hold)
+        finally:
+            os.close(r)
+        self._w = w
+        # the keeper unshared the user namespace as well
+        self.ns_file = "/proc/%d/ns/user" % self.pid
+
+    def stop(self):
+        if self.pid is None:
+            return
+        os.close(self._w)
+        self._w = None
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        self.pid = None
+        self.ns_file = None
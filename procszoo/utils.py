@@ -5,8 +5,18 @@ import os
 import sys
 import atexit
 import re
-from ctypes import (cdll, c_int, c_long, c_char_p, c_size_t, string_at,
-                    create_string_buffer, c_void_p, CFUNCTYPE, pythonapi)
+import fcntl
+import errno
+import select
+import struct
+import termios
+import time
+import threading
+import traceback
+from ctypes import (cdll, c_int, c_uint, c_long, c_char_p, c_size_t,
+                    string_at, create_string_buffer, c_void_p, CFUNCTYPE,
+                    pythonapi, Structure, POINTER, pointer, byref, cast,
+                    sizeof)
 try:
     import pyroute2
 except ImportError:
@@ -28,6 +38,7 @@ import pickle
 from copy import copy
 import json
 from namespaces import *
+from mountinfo import read_mountinfo, MountTable
 
 try:
     from procszoo.syscall_pivot_root_number import NR_PIVOT_ROOT
@@ -56,12 +67,17 @@ __all__ = [
     "UnavailableNamespaceFound", "NamespaceSettingError",
     "NamespaceRequireSuperuserPrivilege",
     "CFunctionBaseException", "CFunctionNotFound",
-    "workbench", "atfork", "sched_getcpu", "mount", "umount",
-    "umount2", "unshare", "pivot_root", "adjust_namespaces",
+    "workbench", "atfork", "unregister_fork_hook", "show_fork_hooks_stats",
+    "sched_getcpu", "mount", "umount",
+    "umount2", "prune_mounts", "fresh_root", "mount_workspace", "unshare",
+    "pivot_root", "adjust_namespaces",
     "setns", "spawn_namespaces", "check_namespaces_available_status",
     "show_namespaces_status", "gethostname", "sethostname",
     "getdomainname", "setdomainname", "show_available_c_functions",
-    "__version__",]
+    "pidfd_open", "memfd_create", "splice", "copy_file_range",
+    "sendfile", "send_fds", "recv_fds", "enter_namespaces",
+    "enter_many_namespaces", "SpawnPlan", "spawn_plan",
+    "register_spawn_callback", "unregister_spawn_callback", "__version__",]
 
 _HOST_NAME_MAX = 256
 _CDLL = cdll.LoadLibrary(None)
@@ -70,6 +86,117 @@ _FORK_HANDLER_PROTOTYPE = CFUNCTYPE(None)
 _NULL_HANDLER_POINTER = _FORK_HANDLER_PROTOTYPE()
 _MAX_USERS_MAP = 5
 _MAX_GROUPS_MAP = 5
+_SOL_SOCKET = 1
+_SCM_RIGHTS = 1
+_MSG_CMSG_CLOEXEC = 0x40000000
+_MFD_CLOEXEC = 0x0001
+_MFD_ALLOW_SEALING = 0x0002
+_LOOP_SET_FD = 0x4C00
+_LOOP_CLR_FD = 0x4C01
+_LOOP_SET_STATUS64 = 0x4C04
+_LOOP_CTL_GET_FREE = 0x4C82
+_LO_FLAGS_READ_ONLY = 1
+_LO_FLAGS_AUTOCLEAR = 4
+# struct loop_info64, only lo_flags and lo_file_name are set
+_LOOP_INFO64 = struct.Struct("=QQQQQIIII64s64s32sQQ")
+_WORKSPACE_KEYS = ["path", "size", "inodes", "mode", "image", "fs_type",
+                   "readonly"]
+_ENTER_NAMESPACES_ORDER = ["user", "cgroup", "ipc", "uts", "net", "pid",
+                           "mount"]
+# children of launch() that are waited for at exit, see _wait_at_exit
+_SPAWNED_PIDS = set()
+_SPAWNED_PIDS_LOCK = threading.Lock()
+_SPAWNED_PIDS_MIN_PRUNE = 64
+_spawned_pids_prune_at = _SPAWNED_PIDS_MIN_PRUNE
+
+class _IOVec(Structure):
+    _fields_ = [("iov_base", c_void_p), ("iov_len", c_size_t)]
+
+class _MsgHdr(Structure):
+    _fields_ = [("msg_name", c_void_p), ("msg_namelen", c_uint),
+                ("msg_iov", POINTER(_IOVec)), ("msg_iovlen", c_size_t),
+                ("msg_control", c_void_p), ("msg_controllen", c_size_t),
+                ("msg_flags", c_int)]
+
+class _CMsgHdr(Structure):
+    _fields_ = [("cmsg_len", c_size_t), ("cmsg_level", c_int),
+                ("cmsg_type", c_int)]
+
+def _cmsg_align(length):
+    align = sizeof(c_size_t)
+    return (length + align - 1) & ~(align - 1)
+
+def _cmsg_len(length):
+    return _cmsg_align(sizeof(_CMsgHdr)) + length
+
+def _cmsg_space(length):
+    return _cmsg_align(sizeof(_CMsgHdr)) + _cmsg_align(length)
+
+def _poll(poller, timeout=None):
+    while True:
+        try:
+            return poller.poll(timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+def _wait_at_exit(pid):
+    """
+    remember a child to wait for at exit. The children that have been
+    reaped are dropped once the set doubles, so it stays as big as the
+    number of children alive.
+    """
+    global _spawned_pids_prune_at
+    _SPAWNED_PIDS_LOCK.acquire()
+    try:
+        _SPAWNED_PIDS.add(pid)
+        if len(_SPAWNED_PIDS) < _spawned_pids_prune_at:
+            return
+        for child in list(_SPAWNED_PIDS):
+            try:
+                os.kill(child, 0)
+            except OSError, e:
+                # a zombie could still be signaled, a reaped child not
+                if e.errno == errno.ESRCH:
+                    _SPAWNED_PIDS.discard(child)
+        _spawned_pids_prune_at = max(_SPAWNED_PIDS_MIN_PRUNE,
+                                     2 * len(_SPAWNED_PIDS))
+    finally:
+        _SPAWNED_PIDS_LOCK.release()
+
+def _wait_spawned_pids():
+    for pid in list(_SPAWNED_PIDS):
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+atexit.register(_wait_spawned_pids)
+
+def _dup_stdio(stdio):
+    if len(stdio) != 3:
+        raise ValueError("stdio should be three file descriptors")
+    fds = [os.dup(fd) for fd in stdio]
+    for i in range(3):
+        os.dup2(fds[i], i)
+        os.close(fds[i])
+
+def _close_cloexec_fds():
+    for name in os.listdir("/proc/self/fd"):
+        fd = int(name)
+        if fd < 3:
+            continue
+        try:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        except IOError:
+            continue
+        if flags & fcntl.FD_CLOEXEC:
+            os.close(fd)
+
+def _exit_status(status):
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
 
 def _fork():
     pid = os.fork()
@@ -98,7 +225,77 @@ def _map_id(map_file, map=None, pid=None):
     else:
         raise RuntimeError("%s: No such file" % path)
 
-def _write_to_uid_and_gid_map(maproot, users_map, groups_map, pid):
+def _ns_file(target, entry):
+    """
+    target is a pid, a namespace file, a ns_bind_dir or an object with a
+    ns_file attribute, e.g., a SharedUserNamespace
+    """
+    if hasattr(target, "ns_file"):
+        return target.ns_file
+    if isinstance(target, int) or isinstance(target, long):
+        return "/proc/%d/ns/%s" % (target, entry)
+    if os.path.isdir(target):
+        return "%s/%s" % (target.rstrip("/"), entry)
+    return target
+
+def _workspace(workspace):
+    """
+    workspace is a mount point or a dict of mount_workspace arguments
+    """
+    if isinstance(workspace, basestring):
+        workspace = {"path": workspace}
+    unknown_keys = set(workspace.keys()) - set(_WORKSPACE_KEYS)
+    if unknown_keys:
+        raise NamespaceSettingError("unknown workspace keys: %s"
+                                    % ", ".join(sorted(unknown_keys)))
+    if not workspace.get("path"):
+        raise NamespaceSettingError("workspace needs a path")
+    workspace = dict(workspace)
+    workspace["path"] = os.path.normpath(workspace["path"])
+    return workspace
+
+def _attach_loop(image, readonly=False):
+    """
+    attach image to a free loop device that is released when it is
+    unmounted, return the path and an open fd of the loop device. The
+    device is released once the fd is closed if nobody mounted it.
+    """
+    flags = _LO_FLAGS_AUTOCLEAR
+    if readonly:
+        image_fd = os.open(image, os.O_RDONLY)
+        flags |= _LO_FLAGS_READ_ONLY
+    else:
+        image_fd = os.open(image, os.O_RDWR)
+    ctl_fd = os.open("/dev/loop-control", os.O_RDWR)
+    try:
+        while True:
+            device = "/dev/loop%d" % fcntl.ioctl(ctl_fd, _LOOP_CTL_GET_FREE)
+            loop_fd = os.open(device, os.O_RDWR)
+            try:
+                fcntl.ioctl(loop_fd, _LOOP_SET_FD, image_fd)
+            except IOError, e:
+                os.close(loop_fd)
+                # another process got the device first
+                if e.errno == errno.EBUSY:
+                    continue
+                raise
+            break
+        try:
+            info = _LOOP_INFO64.pack(0, 0, 0, 0, 0, 0, 0, 0, flags,
+                                     image[-63:], "", "", 0, 0)
+            fcntl.ioctl(loop_fd, _LOOP_SET_STATUS64, info)
+        except:
+            fcntl.ioctl(loop_fd, _LOOP_CLR_FD, 0)
+            os.close(loop_fd)
+            raise
+    finally:
+        os.close(ctl_fd)
+        os.close(image_fd)
+    return device, loop_fd
+
+def _uid_and_gid_maps(maproot, users_map, groups_map):
+    uid_map = None
+    gid_map = None
     if maproot:
         maps = ["0 %d 1" % os.geteuid()]
     else:
@@ -108,8 +305,7 @@ def _write_to_uid_and_gid_map(maproot, users_map, groups_map, pid):
     if maps:
         if len(maps) > _MAX_USERS_MAP:
             raise NamespaceSettingError()
-        map_str = "%s\n" % "\n".join(maps)
-        _map_id("uid_map", map_str, pid)
+        uid_map = "%s\n" % "\n".join(maps)
 
     if maproot:
         maps = ["0 %d 1" % os.getegid()]
@@ -120,8 +316,8 @@ def _write_to_uid_and_gid_map(maproot, users_map, groups_map, pid):
     if maps:
         if len(maps) > _MAX_GROUPS_MAP:
             raise NamespaceSettingError()
-        map_str = "%s\n" % "\n".join(maps)
-        _map_id("gid_map", map_str, pid)
+        gid_map = "%s\n" % "\n".join(maps)
+    return uid_map, gid_map
 
 def _find_my_init(paths=None, name=None):
     if paths is None:
@@ -182,6 +378,273 @@ class CFunction(object):
                 self.func = func
                 break
 
+class SpawnPlan(object):
+    """
+    arguments of spawn_namespaces that have been checked and resolved, a
+    plan could be launched many times, and each launch only forks, unshares
+    and execs. Use workbench.spawn_plan to make one.
+    """
+    def __init__(self, workbench, namespaces=None, maproot=True,
+                 mountproc=True, mountpoint=None, ns_bind_dir=None,
+                 nscmd=None, propagation=None, negative_namespaces=None,
+                 setgroups=None, users_map=None, groups_map=None,
+                 keep_mounts=None, userns=None, workspace=None,
+                 mount_template=None):
+        self.workbench = workbench
+        workbench.check_namespaces_available_status()
+        if namespaces is not None:
+            namespaces = list(namespaces)
+        if mount_template is not None:
+            # a template made in a shared user namespace is used in it
+            if userns is None:
+                userns = getattr(mount_template, "userns", None)
+            mount_template = _ns_file(mount_template, "mnt")
+        if userns is not None:
+            userns = _ns_file(userns, "user")
+            if users_map or groups_map or setgroups is not None:
+                raise NamespaceSettingError(
+                    "ids are mapped in the user namespace of userns")
+            # the ids are mapped already, and the other namespaces are
+            # owned by the user namespace that we join
+            maproot = False
+            if namespaces is not None and "user" in namespaces:
+                namespaces.remove("user")
+            if negative_namespaces is None:
+                negative_namespaces = []
+            negative_namespaces = list(negative_namespaces) + ["user"]
+        if not workbench.user_namespace_available():
+            maproot = False
+            users_map = None
+            group_map = None
+        if setgroups == "allow" and maproot:
+            maproot = False
+            users_map = None
+            group_map = None
+        if not workbench.pid_namespace_available():
+            mountproc = False
+            mountpoint = None
+        if mountproc and mountpoint is None:
+            mountpoint = '/proc'
+        if not workbench.mount_namespace_available():
+            propagation = None
+
+        if setgroups == "allow" and maproot:
+            raise NamespaceSettingError()
+
+        namespaces = workbench.adjust_namespaces(namespaces,
+                                                 negative_namespaces)
+
+        all_namespaces = workbench.namespaces.namespaces
+        unsupported_namespaces = []
+        for ns in namespaces:
+            if ns not in all_namespaces:
+                unsupported_namespaces.append(ns)
+            elif not workbench._namespace_available(ns):
+                unsupported_namespaces.append(ns)
+        if unsupported_namespaces:
+            raise UnavailableNamespaceFound(unsupported_namespaces)
+
+        require_root_privilege = False
+        if not workbench.user_namespace_available():
+            require_root_privilege = True
+        if namespaces and "user" not in namespaces and userns is None:
+            require_root_privilege = True
+        if ns_bind_dir:
+            require_root_privilege = True
+        if users_map or groups_map:
+            require_root_privilege = True
+        if require_root_privilege:
+            euid = os.geteuid()
+            if euid != 0:
+                raise NamespaceRequireSuperuserPrivilege()
+
+        if mountproc:
+            if workbench.mount_namespace_available():
+                if "mount" not in namespaces:
+                    namespaces.append("mount")
+            else:
+                raise NamespaceSettingError()
+
+        if workspace is not None:
+            workspace = _workspace(workspace)
+            if not workbench.mount_namespace_available():
+                raise NamespaceSettingError(
+                    "workspace needs a mount namespace")
+            if "mount" not in namespaces:
+                namespaces.append("mount")
+
+        if mount_template is not None:
+            if not workbench.mount_namespace_available():
+                raise NamespaceSettingError(
+                    "mount_template needs a mount namespace")
+            if "mount" not in namespaces:
+                namespaces.append("mount")
+
+        if maproot:
+            if workbench.user_namespace_available():
+                if "user" not in namespaces:
+                    namespaces.append("user")
+            else:
+                raise NamespaceSettingError()
+
+        if workbench.mount_namespace_available():
+            if "mount" in namespaces and propagation is None:
+                propagation = "private"
+
+        path = "/proc/self/setgroups"
+        if workbench.user_namespace_available() and "user" in namespaces:
+            if os.path.exists(path):
+                if setgroups is None:
+                    setgroups = "deny"
+            elif setgroups == "deny":
+                raise NamespaceSettingError("cannot set setgroups to 'deny'")
+            else:
+                setgroups = None
+        else:
+            setgroups = None
+        if setgroups is not None:
+            ctrl_keys = workbench.namespaces.user.extra
+            if setgroups not in ctrl_keys:
+                raise RuntimeError("group control should be %s"
+                                   % ", ".join(ctrl_keys))
+
+        if "user" not in namespaces:
+            maproot = False
+            setgroups = None
+            users_map = None
+            groups_map = None
+
+        if "pid" not in namespaces:
+            mountproc = False
+
+        if "mount" not in namespaces:
+             ns_bind_dir = None
+             propagation = None
+             mountproc = False
+             keep_mounts = None
+        if propagation is not None:
+            propagation_types = workbench.functions["mount"].extra[
+                "propagation"]
+            if propagation not in propagation_types:
+                raise RuntimeError("%s: unknown propagation type"
+                                   % propagation)
+            if propagation == "unchanged":
+                propagation = None
+        if keep_mounts is not None:
+            # umount events must not propagate to the original namespace
+            if propagation not in ["private", "slave"]:
+                raise NamespaceSettingError(
+                    "keep_mounts needs private or slave propagation")
+            keep_mounts = [os.path.normpath(path) for path in keep_mounts]
+            if mountproc and mountpoint not in keep_mounts:
+                keep_mounts.append(os.path.normpath(mountpoint))
+            # a new root is made by fresh_root in a user namespace
+            if ("user" in namespaces or userns is not None) and \
+                    "pivot_root" not in workbench.available_c_functions:
+                raise NamespaceSettingError(
+                    "keep_mounts in a user namespace needs pivot_root")
+        if workspace is not None:
+            if propagation not in ["private", "slave"]:
+                raise NamespaceSettingError(
+                    "workspace needs private or slave propagation")
+            # block devices could not be mounted in a user namespace
+            if workspace.get("image") and ("user" in namespaces or
+                                           userns is not None):
+                raise NamespaceSettingError(
+                    "workspace image cannot be mounted in user namespace")
+
+        self.namespaces = namespaces
+        self.unshare_flags = 0
+        for ns_name in namespaces:
+            ns_obj = getattr(workbench.namespaces, ns_name)
+            if ns_obj.available:
+                self.unshare_flags |= ns_obj.value
+        self.mountproc = mountproc
+        self.mountpoint = mountpoint
+        self.propagation = propagation
+        self.keep_mounts = keep_mounts
+        self.ns_bind_dir = ns_bind_dir
+        self.userns = userns
+        self.mount_template = mount_template
+        self.workspace = workspace
+        self.setgroups = setgroups
+        self.uid_map, self.gid_map = _uid_and_gid_maps(
+            maproot, users_map, groups_map)
+        for map_file, map in [("uid_map", self.uid_map),
+                              ("gid_map", self.gid_map)]:
+            if map is not None and not os.path.exists(
+                    "/proc/self/%s" % map_file):
+                raise NamespaceSettingError("%s is not supported" % map_file)
+        # without these, the child does not wait for us after it unshares
+        self.needs_parent = (setgroups is not None or
+                             self.uid_map is not None or
+                             self.gid_map is not None or
+                             ns_bind_dir is not None)
+
+        self.my_init = None
+        if "pid" in namespaces:
+            self.my_init = _find_my_init()
+        self.argv = self._argv(nscmd)
+
+    def _argv(self, nscmd):
+        if nscmd is None:
+            nscmd = _find_shell()
+        if not isinstance(nscmd, list):
+            nscmd = [nscmd]
+        if self.my_init is None:
+            return nscmd
+        return ["python", self.my_init, "--skip-startup-files",
+                "--skip-runit", "--quiet", "--"] + nscmd
+
+    def launch(self, nscmd=None, stdio=None, target=None, ctty=False):
+        """
+        spawn the namespaces, nscmd overrides the nscmd of the plan, stdio
+        is None or a list of three file descriptors that will be the
+        stdin/stdout/stderr of nscmd. If target is given, target() is
+        called in the new namespaces instead of exec'ing nscmd. If ctty is
+        True, the child starts a new session and its stdin, a terminal,
+        becomes the controlling terminal.
+
+        With stdio or target, the file descriptors that have close-on-exec
+        flag are closed in the child, so the other ends of pipes and
+        sockets could see EOF. Return the pid of the child process, the
+        child exits with the exit status of nscmd or target.
+        """
+        if target is not None:
+            argv = None
+        elif nscmd is None:
+            argv = self.argv
+        else:
+            argv = self._argv(nscmd)
+        workbench = self.workbench
+
+        r1, w1 = os.pipe()
+        r2, w2 = os.pipe()
+        pid = _fork()
+
+        if pid == 0:
+            # errors must not unwind the stack of the caller in the forks
+            try:
+                if stdio is not None:
+                    _dup_stdio(stdio)
+                if ctty:
+                    os.setsid()
+                    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+                if stdio is not None or target is not None:
+                    _close_cloexec_fds()
+                workbench._run_cmd_in_new_namespaces(
+                    r1, w1, r2, w2, self, argv, target)
+            except BaseException:
+                traceback.print_exc()
+            os._exit(127)
+        else:
+            sandbox_pid = workbench._continue_original_flow(
+                r1, w1, r2, w2, self)
+            for callback in workbench.spawn_callbacks:
+                callback(pid, sandbox_pid)
+            _wait_at_exit(pid)
+            return pid
+
 class Workbench(object):
     """
     class used as a singleton.
@@ -199,6 +662,16 @@ class Workbench(object):
         self.namespaces = Namespaces()
         self._init_c_functions()
         self._namespaces_available_status_checked = False
+        # replaced, not changed, under the lock, so launches in other
+        # threads iterate over it without the lock
+        self.spawn_callbacks = ()
+        self._spawn_callbacks_lock = threading.Lock()
+        self._fork_hooks = {}
+        self._fork_hooks_seq = 0
+        self._fork_hooks_stats = {}
+        self._fork_hooks_table = {"prepare": (), "parent": (), "child": ()}
+        self._fork_hooks_lock = threading.Lock()
+        self._fork_trampolines_installed = False
 
     def _init_c_functions(self):
         exported_name = "unshare"
@@ -247,7 +720,7 @@ class Workbench(object):
                     "data": None,},
 
                 "flag": {
-                    "MS_NOSUID": 2, "MS_NODEV": 4,
+                    "MS_RDONLY": 1, "MS_NOSUID": 2, "MS_NODEV": 4,
                     "MS_NOEXEC": 8, "MS_REC": 16384,
                     "MS_PRIVATE": 1 << 18,
                     "MS_SLAVE": 1 << 19,
@@ -259,7 +732,11 @@ class Workbench(object):
                     "private": ["MS_REC", "MS_PRIVATE"],
                     "shared": ["MS_REC", "MS_SHARED"],
                     "bind": ["MS_BIND"],
+                    "rbind": ["MS_REC", "MS_BIND"],
                     "mount_proc": ["MS_NOSUID", "MS_NODEV", "MS_NOEXEC"],
+                    "workspace": ["MS_NOSUID", "MS_NODEV"],
+                    "workspace_readonly": ["MS_NOSUID", "MS_NODEV",
+                                           "MS_RDONLY"],
                     "unchanged": [],}
                 })
 
@@ -295,6 +772,53 @@ class Workbench(object):
             failed=lambda res: res == -1)
         self._register_fork_handler(_NULL_HANDLER_POINTER)
 
+        exported_name = "pidfd_open"
+        self.functions[exported_name] = CFunction(
+            exported_name=exported_name,
+            argtypes=[c_int, c_uint],
+            failed=lambda res: res == -1)
+
+        exported_name = "memfd_create"
+        self.functions[exported_name] = CFunction(
+            exported_name=exported_name,
+            argtypes=[c_char_p, c_uint],
+            failed=lambda res: res == -1)
+
+        exported_name = "splice"
+        self.functions[exported_name] = CFunction(
+            exported_name=exported_name,
+            argtypes=[c_int, c_void_p, c_int, c_void_p, c_size_t, c_uint],
+            restype=c_long,
+            failed=lambda res: res == -1)
+
+        exported_name = "copy_file_range"
+        self.functions[exported_name] = CFunction(
+            exported_name=exported_name,
+            argtypes=[c_int, c_void_p, c_int, c_void_p, c_size_t, c_uint],
+            restype=c_long,
+            failed=lambda res: res == -1)
+
+        exported_name = "sendfile"
+        self.functions[exported_name] = CFunction(
+            exported_name=exported_name,
+            argtypes=[c_int, c_int, c_void_p, c_size_t],
+            restype=c_long,
+            failed=lambda res: res == -1)
+
+        exported_name = "sendmsg"
+        self.functions[exported_name] = CFunction(
+            exported_name=exported_name,
+            argtypes=[c_int, POINTER(_MsgHdr), c_int],
+            restype=c_long,
+            failed=lambda res: res == -1)
+
+        exported_name = "recvmsg"
+        self.functions[exported_name] = CFunction(
+            exported_name=exported_name,
+            argtypes=[c_int, POINTER(_MsgHdr), c_int],
+            restype=c_long,
+            failed=lambda res: res == -1)
+
         exported_name = "gethostname"
         self.functions[exported_name] = CFunction(
             exported_name = exported_name,
@@ -363,7 +887,7 @@ class Workbench(object):
             raise AttributeError("'CFunction' object has no attribute '%s'"
                                      % name)
 
-    def atfork(self, prepare=None, parent=None, child=None):
+    def atfork(self, prepare=None, parent=None, child=None, priority=0):
         """
         This function will let us to insert our codes before and after fork
             prepare()
@@ -374,25 +898,96 @@ class Workbench(object):
             elif pid > 0:
                 parent()
                 ...
+
+        Return a hook id that could be passed to unregister_fork_hook.
+        Hooks with lower priority run first in the parent and the child,
+        and last in prepare, like the handlers of pthread_atfork(3).
         """
-        hdr_prototype = _FORK_HANDLER_PROTOTYPE
-        if prepare is None:
-            prepare = _NULL_HANDLER_POINTER
-        else:
-            prepare = _FORK_HANDLER_PROTOTYPE(prepare)
-        if parent is None:
-            parent = _NULL_HANDLER_POINTER
-        else:
-            parent = _FORK_HANDLER_PROTOTYPE(parent)
-        if child is None:
-            child = _NULL_HANDLER_POINTER
-        else:
-            child = _FORK_HANDLER_PROTOTYPE(child)
+        if not [hdr for hdr in prepare, parent, child if hdr is not None]:
+            return None
+        self._install_fork_trampolines()
 
-        for hdr in prepare, parent, child:
-            self._register_fork_handler(hdr)
+        self._fork_hooks_lock.acquire()
+        try:
+            self._fork_hooks_seq += 1
+            hook_id = self._fork_hooks_seq
+            self._fork_hooks[hook_id] = (priority, {
+                "prepare": prepare, "parent": parent, "child": child})
+            self._fork_hooks_stats[hook_id] = {}
+            self._rebuild_fork_hooks_table()
+        finally:
+            self._fork_hooks_lock.release()
+        return hook_id
+
+    def unregister_fork_hook(self, hook_id):
+        self._fork_hooks_lock.acquire()
+        try:
+            if self._fork_hooks.pop(hook_id, None) is not None:
+                self._fork_hooks_stats.pop(hook_id, None)
+                self._rebuild_fork_hooks_table()
+        finally:
+            self._fork_hooks_lock.release()
 
-        return self._c_func_atfork(prepare, parent, child)
+    def show_fork_hooks_stats(self):
+        """
+        return {hook_id: {phase: [calls, total seconds, max seconds,
+        errors]}}, phase is "prepare", "parent" or "child". The child
+        stats are collected in child processes, so the parent only sees
+        the stats that were there when it forked.
+        """
+        self._fork_hooks_lock.acquire()
+        try:
+            return dict((hook_id, dict((phase, list(stats))
+                                       for phase, stats in phases.items()))
+                        for hook_id, phases
+                        in self._fork_hooks_stats.items())
+        finally:
+            self._fork_hooks_lock.release()
+
+    def _rebuild_fork_hooks_table(self):
+        hooks = sorted((priority, hook_id, funcs)
+                       for hook_id, (priority, funcs)
+                       in self._fork_hooks.items())
+        table = {}
+        for phase in "prepare", "parent", "child":
+            table[phase] = tuple((hook_id, funcs[phase])
+                                 for priority, hook_id, funcs in hooks
+                                 if funcs[phase] is not None)
+        table["prepare"] = tuple(reversed(table["prepare"]))
+        self._fork_hooks_table = table
+
+    def _run_fork_hooks(self, phase):
+        for hook_id, func in self._fork_hooks_table[phase]:
+            start = time.time()
+            failed = 0
+            try:
+                func()
+            except Exception:
+                failed = 1
+            cost = time.time() - start
+            stats = self._fork_hooks_stats.get(hook_id)
+            if stats is None:
+                continue
+            if phase not in stats:
+                stats[phase] = [0, 0.0, 0.0, 0]
+            phase_stats = stats[phase]
+            phase_stats[0] += 1
+            phase_stats[1] += cost
+            if cost > phase_stats[2]:
+                phase_stats[2] = cost
+            phase_stats[3] += failed
+
+    def _install_fork_trampolines(self):
+        if self._fork_trampolines_installed:
+            return
+        trampolines = [
+            _FORK_HANDLER_PROTOTYPE(
+                lambda phase=phase: self._run_fork_hooks(phase))
+            for phase in "prepare", "parent", "child"]
+        for trampoline in trampolines:
+            self._register_fork_handler(trampoline)
+        self._c_func_atfork(*trampolines)
+        self._fork_trampolines_installed = True
 
     def check_namespaces_available_status(self):
         """
@@ -426,10 +1021,12 @@ class Workbench(object):
 
                 pickle.dump(keys, tmpfile)
                 tmpfile.close()
-                sys.exit(0)
+                # sys.exit would run the with blocks and atexit handlers
+                # of the caller in the forked children
+                os._exit(0)
             else:
                 os.waitpid(pid1, 0)
-                sys.exit(0)
+                os._exit(0)
         else:
             os.close(w)
             tmpfile = os.fdopen(r, 'rb')
@@ -447,6 +1044,28 @@ class Workbench(object):
     def show_available_c_functions(self):
         return self.available_c_functions
 
+    def register_spawn_callback(self, callback):
+        """
+        callback(pid, sandbox_pid) is called after spawn_namespaces or
+        SpawnPlan.launch spawned namespaces, pid is the child process that
+        spawn_namespaces returns, sandbox_pid is the first process in the
+        new namespaces
+        """
+        self._spawn_callbacks_lock.acquire()
+        try:
+            if callback not in self.spawn_callbacks:
+                self.spawn_callbacks = self.spawn_callbacks + (callback,)
+        finally:
+            self._spawn_callbacks_lock.release()
+
+    def unregister_spawn_callback(self, callback):
+        self._spawn_callbacks_lock.acquire()
+        try:
+            self.spawn_callbacks = tuple(
+                func for func in self.spawn_callbacks if func != callback)
+        finally:
+            self._spawn_callbacks_lock.release()
+
     def sched_getcpu(self):
         return self._c_func_sched_getcpu()
 
@@ -508,7 +1127,7 @@ class Workbench(object):
         if not isinstance(mountpoint, basestring):
             raise RuntimeError("mountpoint should be a path to a mount point")
         if not os.path.exists(mountpoint):
-            raise RuntimeError("mount point '%s': cannot found")
+            raise RuntimeError("mount point '%s': cannot found" % mountpoint)
         self._c_func_umount(mountpoint)
 
     def umount2(self, mountpoint=None, behavior=None):
@@ -518,7 +1137,7 @@ class Workbench(object):
         if not isinstance(mountpoint, basestring):
             raise RuntimeError("mountpoint should be a path to a mount point")
         if not os.path.exists(mountpoint):
-            raise RuntimeError("mount point '%s': cannot found")
+            raise RuntimeError("mount point '%s': cannot found" % mountpoint)
 
         behaviors = func_obj.extra["behaviors"]
         flag = func_obj.extra["flag"]
@@ -540,6 +1159,133 @@ class Workbench(object):
             return
         self.mount(source="none", target="/", mount_type=type)
 
+    def prune_mounts(self, keep_mounts, mountinfo="/proc/self/mountinfo"):
+        """
+        lazily detach every mount that is not in keep_mounts, not above
+        one of them, and not below one of them except "/", e.g.,
+            workbench.prune_mounts(["/", "/dev", "/tmp"])
+        keeps /, /dev, /dev/pts, /dev/shm and /tmp. Call it only in a new
+        mount namespace with private or slave propagation. Return the
+        mount points that were detached, mounts that could not be
+        detached, e.g., locked ones in a user namespace, are left.
+        """
+        keep_mounts = [os.path.normpath(path) for path in keep_mounts]
+        def kept(path):
+            for keep in keep_mounts:
+                if path == keep or keep.startswith(path.rstrip("/") + "/"):
+                    return True
+                if keep != "/" and path.startswith(keep + "/"):
+                    return True
+            return False
+
+        mount_points = [mount.mount_point
+                        for mount in read_mountinfo(path=mountinfo)]
+
+        detached = []
+        flags = c_int(self.functions["umount2"].extra["flag"]["MNT_DETACH"])
+        # a lazy umount detaches the mounts below, so parents go first
+        for mount_point in sorted(set(mount_points),
+                                  key=lambda path: path.count("/")):
+            if kept(mount_point):
+                continue
+            if [path for path in detached
+                if mount_point.startswith(path.rstrip("/") + "/")]:
+                continue
+            for i in range(mount_points.count(mount_point)):
+                try:
+                    self._c_func_umount2(mount_point, flags)
+                except RuntimeError:
+                    break
+            else:
+                detached.append(mount_point)
+        return detached
+
+    def fresh_root(self, keep_mounts, base="/tmp"):
+        """
+        make a tmpfs the root, with keep_mounts bound recursively from the
+        original root, and detach the original root. If "/" is in
+        keep_mounts, the whole original tree is bound. Call it only in a
+        new mount namespace with private or slave propagation, it needs
+        pivot_root.
+        """
+        self.mount(source="tmpfs", target=base, filesystemtype="tmpfs",
+                   data="mode=0755")
+        new_root = "%s/newroot" % base
+        old_root = "%s/oldroot" % base
+        os.mkdir(new_root, 0755)
+        os.mkdir(old_root, 0755)
+        self.mount(source=new_root, target=new_root, mount_type="bind")
+        self.pivot_root(base, old_root)
+        os.chdir("/")
+
+        keep_mounts = set(os.path.normpath(path) for path in keep_mounts)
+        if "/" in keep_mounts:
+            # the other paths are below it
+            keep_mounts = ["/"]
+        for path in sorted(keep_mounts, key=lambda path: path.count("/")):
+            if path == "/":
+                self.mount(source="/oldroot", target="/newroot",
+                           mount_type="rbind")
+                continue
+            source = "/oldroot%s" % path
+            target = "/newroot%s" % path
+            if not os.path.exists(source):
+                continue
+            if os.path.isdir(source):
+                if not os.path.isdir(target):
+                    os.makedirs(target, 0755)
+            else:
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target), 0755)
+                open(target, 'a').close()
+            self.mount(source=source, target=target, mount_type="rbind")
+        self.umount2("/oldroot", "detach")
+
+        # the tmpfs that holds newroot is stacked on it, then detached
+        os.chdir("/newroot")
+        self.pivot_root(".", ".")
+        self.umount2(".", "detach")
+        os.chdir("/")
+
+    def mount_workspace(self, path, size=None, inodes=None, mode=01777,
+                        image=None, fs_type="ext4", readonly=False):
+        """
+        mount a scratch area on path, a tmpfs of size bytes (or "512m",
+        "10%") with at most inodes files, or, if image is given, the file
+        system in image through a loop device. A single lazy umount
+        frees all of it however many files are there, e.g.,
+            workbench.mount_workspace("/scratch", size="1g", inodes=100000)
+            ...
+            workbench.umount2("/scratch", "detach")
+        If path does not exist, it is made, and it is left behind after
+        the umount, e.g., on the host file system if the mount namespace
+        was not given a fresh root. Return the loop device or None.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path, 0755)
+        if readonly:
+            mount_type = "workspace_readonly"
+        else:
+            mount_type = "workspace"
+        if image is None:
+            options = ["mode=%o" % mode]
+            if size is not None:
+                options.append("size=%s" % size)
+            if inodes is not None:
+                options.append("nr_inodes=%s" % inodes)
+            self.mount(source="workspace", target=path,
+                       filesystemtype="tmpfs", mount_type=mount_type,
+                       data=",".join(options))
+            return None
+        device, loop_fd = _attach_loop(image, readonly)
+        try:
+            self.mount(source=device, target=path, filesystemtype=fs_type,
+                       mount_type=mount_type)
+        finally:
+            # the loop device is released by the umount from now on
+            os.close(loop_fd)
+        return device
+
     def unshare(self, namespaces=None):
         if namespaces is None:
             return
@@ -622,6 +1368,117 @@ class Workbench(object):
         else:
             return self._c_func_setns(fd, flags)
 
+    def pidfd_open(self, pid):
+        """
+        return a file descriptor that refers to the process pid, it becomes
+        readable when the process exits
+        """
+        return self._c_func_pidfd_open(c_int(pid), c_uint(0))
+
+    def memfd_create(self, name="procszoo", flags=None):
+        """
+        return a close-on-exec anonymous file descriptor that allows sealing
+        """
+        if flags is None:
+            flags = _MFD_CLOEXEC | _MFD_ALLOW_SEALING
+        return self._c_func_memfd_create(c_char_p(name), c_uint(flags))
+
+    def splice(self, fd_in, fd_out, length, flags=0):
+        """
+        move up to length bytes from fd_in to fd_out in the kernel, one of
+        them should be a pipe. Like os.read, return the number of bytes
+        moved, 0 at EOF, and raise OSError on errors, e.g., EAGAIN.
+        """
+        return self._call_c_func("splice", fd_in, None, fd_out, None,
+                                 length, flags)
+
+    def copy_file_range(self, fd_in, fd_out, length):
+        """
+        copy up to length bytes between regular files in the kernel, at
+        their file offsets. Return the number of bytes copied, 0 at EOF,
+        and raise OSError on errors, e.g., EXDEV on old kernels.
+        """
+        return self._call_c_func("copy_file_range", fd_in, None,
+                                 fd_out, None, length, 0)
+
+    def sendfile(self, fd_out, fd_in, length):
+        """
+        copy up to length bytes from fd_in to fd_out in the kernel, at
+        their file offsets. Return the number of bytes copied, 0 at EOF,
+        and raise OSError on errors.
+        """
+        return self._call_c_func("sendfile", fd_out, fd_in, None, length)
+
+    def _call_c_func(self, func_name, *args):
+        """
+        call a C function like os.read does, raise OSError with errno
+        when it fails
+        """
+        if func_name not in self.available_c_functions:
+            raise CFunctionNotFound(func_name)
+        func_obj = self.functions[func_name]
+        res = func_obj.func(*args)
+        if func_obj.failed(res):
+            err = c_int.in_dll(pythonapi, "errno").value
+            raise OSError(err, os.strerror(err))
+        return res
+
+    def send_fds(self, sock, data, fds=None):
+        """
+        send data and file descriptors over an unix domain socket, e.g.,
+            workbench.send_fds(sock, "hello", [0, 1, 2])
+        """
+        if fds is None:
+            fds = []
+        buf = create_string_buffer(data, len(data))
+        iov = _IOVec(cast(buf, c_void_p), len(data))
+        msg = _MsgHdr()
+        msg.msg_iov = pointer(iov)
+        msg.msg_iovlen = 1
+        if fds:
+            length = len(fds) * sizeof(c_int)
+            ctrl = create_string_buffer(_cmsg_space(length))
+            cmsg = _CMsgHdr.from_buffer(ctrl)
+            cmsg.cmsg_len = _cmsg_len(length)
+            cmsg.cmsg_level = _SOL_SOCKET
+            cmsg.cmsg_type = _SCM_RIGHTS
+            fd_array = (c_int * len(fds)).from_buffer(ctrl, _cmsg_len(0))
+            fd_array[:] = fds
+            msg.msg_control = cast(ctrl, c_void_p)
+            msg.msg_controllen = sizeof(ctrl)
+        return self._c_func_sendmsg(sock.fileno(), byref(msg), 0)
+
+    def recv_fds(self, sock, bufsize=65536, maxfds=16):
+        """
+        receive data and file descriptors that are sent by send_fds, the
+        received file descriptors have close-on-exec flag set
+        """
+        buf = create_string_buffer(bufsize)
+        iov = _IOVec(cast(buf, c_void_p), bufsize)
+        ctrl = create_string_buffer(_cmsg_space(maxfds * sizeof(c_int)))
+        msg = _MsgHdr()
+        msg.msg_iov = pointer(iov)
+        msg.msg_iovlen = 1
+        msg.msg_control = cast(ctrl, c_void_p)
+        msg.msg_controllen = sizeof(ctrl)
+        size = self._c_func_recvmsg(sock.fileno(), byref(msg),
+                                    _MSG_CMSG_CLOEXEC)
+
+        fds = []
+        offset = 0
+        while offset + sizeof(_CMsgHdr) <= msg.msg_controllen:
+            cmsg = _CMsgHdr.from_buffer(ctrl, offset)
+            if cmsg.cmsg_len < _cmsg_len(0):
+                break
+            if (cmsg.cmsg_level == _SOL_SOCKET and
+                    cmsg.cmsg_type == _SCM_RIGHTS):
+                count = (cmsg.cmsg_len - _cmsg_len(0)) / sizeof(c_int)
+                fd_array = (c_int * count).from_buffer(
+                    ctrl, offset + _cmsg_len(0))
+                fds.extend(fd_array)
+            offset += _cmsg_align(cmsg.cmsg_len)
+        return string_at(buf, size), fds
+
     def gethostname(self):
         buf_len = _HOST_NAME_MAX
         buf = create_string_buffer(buf_len)
@@ -728,8 +1585,9 @@ class Workbench(object):
             os.mkdir(ns_bind_dir)
 
         if not os.access(ns_bind_dir, os.R_OK | os.W_OK):
-            raise RuntimeError("cannot access %s" % bind_ns_dir)
+            raise RuntimeError("cannot access %s" % ns_bind_dir)
 
+        table = MountTable()
         path = "/proc/%d/ns" % pid
         for ns in namespaces:
             if ns == "mount": continue
@@ -740,15 +1598,33 @@ class Workbench(object):
             target = "%s/%s" % (ns_bind_dir.rstrip("/"), entry)
             if not os.path.exists(target):
                 os.close(os.open(target, os.O_CREAT | os.O_RDWR))
+            elif table.is_mount_point(os.path.abspath(target)):
+                st_source = os.stat(source)
+                st_target = os.stat(target)
+                if (st_source.st_dev, st_source.st_ino) == \
+                        (st_target.st_dev, st_target.st_ino):
+                    continue
+                # do not stack binds of dead namespaces on the target
+                self.umount2(target, "detach")
             self.mount(source=source, target=target, mount_type="bind")
 
-    def _run_cmd_in_new_namespaces(
-            self, r1, w1, r2, w2, namespaces, mountproc,
-            mountpoint, nscmd, propagation):
+    def _run_cmd_in_new_namespaces(self, r1, w1, r2, w2, plan, argv,
+                                   target=None):
         os.close(r1)
         os.close(w2)
 
-        self.unshare(namespaces)
+        if plan.userns is not None:
+            self._enter_ns_files([("user", plan.userns)])
+        if plan.mount_template is not None:
+            # setns(2) moves us to the root of the template, unshare(2)
+            # then gives us a private copy of its mounts
+            cwd = os.getcwd()
+            self._enter_ns_files([("mount", plan.mount_template)])
+            try:
+                os.chdir(cwd)
+            except OSError:
+                pass
+        self._c_func_unshare(plan.unshare_flags)
 
         r3, w3 = os.pipe()
         r4, w4 = os.pipe()
@@ -761,10 +1637,10 @@ class Workbench(object):
             os.close(r3)
             os.close(w4)
 
-            if "mount" in namespaces and propagation is not None:
-                self.set_propagation(propagation)
-            if mountproc:
-                self._mount_proc(mountpoint=mountpoint)
+            if plan.propagation is not None:
+                self.set_propagation(plan.propagation)
+            if plan.mountproc:
+                self._mount_proc(mountpoint=plan.mountpoint)
 
             os.write(w3, chr(_ACLCHAR))
             os.close(w3)
@@ -772,20 +1648,45 @@ class Workbench(object):
             if ord(os.read(r4, 1)) != _ACLCHAR:
                 raise "sync failed"
             os.close(r4)
-            my_init = _find_my_init()
-            if nscmd is None:
-                nscmd = _find_shell()
-            args = ["-c", my_init, "--skip-startup-files",
-                    "--skip-runit", "--quiet"]
-            if isinstance(nscmd, list):
-                args = args + nscmd
-            else:
-                args.append(nscmd)
-            if "pid" in namespaces:
-                os.execlp("python", *args)
-            else:
-                os.execlp(nscmd, (nscmd))
-            sys.exit(0)
+
+            try:
+                # files could be made only after uid_map and gid_map are set
+                if plan.keep_mounts is None:
+                    pass
+                elif "user" in plan.namespaces or plan.userns is not None:
+                    # mounts from the original namespace are locked together
+                    # in a new user namespace, they cannot be pruned one by
+                    # one
+                    self.fresh_root(plan.keep_mounts)
+                else:
+                    self.prune_mounts(plan.keep_mounts)
+                if plan.workspace is not None:
+                    self.mount_workspace(**plan.workspace)
+            except BaseException:
+                traceback.print_exc()
+                os._exit(127)
+            if target is not None:
+                try:
+                    target()
+                except SystemExit, e:
+                    status = e.code
+                    if status is not None and not isinstance(status, int):
+                        sys.stderr.write("%s\n" % status)
+                        status = 1
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(status or 0)
+                except BaseException:
+                    traceback.print_exc()
+                    os._exit(1)
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(0)
+            try:
+                os.execvp(argv[0], argv)
+            except BaseException, e:
+                sys.stderr.write("%s: %s\n" % (argv[0], e))
+            os._exit(127)
         else:
             os.close(w3)
             os.close(r4)
@@ -797,26 +1698,25 @@ class Workbench(object):
             os.write(w1, "%d" % pid)
             os.close(w1)
 
-            if ord(os.read(r2, 1)) != _ACLCHAR:
+            if plan.needs_parent and ord(os.read(r2, 1)) != _ACLCHAR:
                 raise "sync failed"
             os.close(r2)
 
             os.write(w4, chr(_ACLCHAR))
             os.close(w4)
 
-            os.waitpid(pid, 0)
-            sys.exit(0)
-
-    def _continue_original_flow(
-            self, r1, w1, r2, w2, namespaces, ns_bind_dir,
-            setgroups, maproot, users_map, groups_map):
-        if setgroups == "allow" and maproot:
-            raise NamespaceSettingError()
-
-        if maproot:
-            uid = os.geteuid()
-            gid = os.getegid()
+            pid, status = os.waitpid(pid, 0)
+            if plan.workspace is not None:
+                # we are in the mount namespace of the child
+                try:
+                    self.umount2(plan.workspace["path"], "detach")
+                except RuntimeError:
+                    pass
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(_exit_status(status))
 
+    def _continue_original_flow(self, r1, w1, r2, w2, plan):
         os.close(w1)
         os.close(r2)
 
@@ -827,136 +1727,241 @@ class Workbench(object):
         except ValueError:
             raise RuntimeError("failed to get the child pid")
 
-        if "user" in namespaces:
-            self.setgroups_control(setgroups, child_pid)
-            _write_to_uid_and_gid_map(maproot, users_map,
-                                          groups_map, child_pid)
-
-        if ns_bind_dir is not None and "mount" in namespaces:
-            self.bind_ns_files(child_pid, namespaces, ns_bind_dir)
-        os.write(w2, chr(_ACLCHAR))
+        if plan.setgroups is not None:
+            _write2file("/proc/%d/setgroups" % child_pid, plan.setgroups)
+        # the plan has checked that the map files exist
+        if plan.uid_map is not None:
+            _write2file("/proc/%d/uid_map" % child_pid, plan.uid_map)
+        if plan.gid_map is not None:
+            _write2file("/proc/%d/gid_map" % child_pid, plan.gid_map)
+
+        if plan.ns_bind_dir is not None:
+            self.bind_ns_files(child_pid, plan.namespaces, plan.ns_bind_dir)
+        if plan.needs_parent:
+            os.write(w2, chr(_ACLCHAR))
         os.close(w2)
+        return child_pid
 
     def _namespace_available(self, namespace):
         ns_obj = getattr(self.namespaces, namespace)
         return ns_obj.available
 
+    def spawn_plan(self, namespaces=None, maproot=True, mountproc=True,
+                   mountpoint=None, ns_bind_dir=None, nscmd=None,
+                   propagation=None, negative_namespaces=None,
+                   setgroups=None, users_map=None, groups_map=None,
+                   keep_mounts=None, userns=None, workspace=None,
+                   mount_template=None):
+        """
+        check and resolve spawn_namespaces arguments once, e.g.,
+            plan = workbench.spawn_plan(namespaces=["pid", "net", "mount"])
+            for i in range(100):
+                plan.launch(nscmd=["/bin/true"])
+        """
+        return SpawnPlan(
+            self, namespaces=namespaces, maproot=maproot,
+            mountproc=mountproc, mountpoint=mountpoint,
+            ns_bind_dir=ns_bind_dir, nscmd=nscmd, propagation=propagation,
+            negative_namespaces=negative_namespaces, setgroups=setgroups,
+            users_map=users_map, groups_map=groups_map,
+            keep_mounts=keep_mounts, userns=userns, workspace=workspace,
+            mount_template=mount_template)
+
     def spawn_namespaces(self, namespaces=None, maproot=True, mountproc=True,
                              mountpoint=None, ns_bind_dir=None, nscmd=None,
                              propagation=None, negative_namespaces=None,
                              setgroups=None, users_map=None,
-                             groups_map=None):
+                             groups_map=None, stdio=None, keep_mounts=None,
+                             userns=None, workspace=None,
+                             mount_template=None):
         """
         workbench.spawn_namespace(namespaces=["pid", "net", "mount"])
-        """
-        self.check_namespaces_available_status()
-        if not self.user_namespace_available():
-            maproot = False
-            users_map = None
-            group_map = None
-        if setgroups == "allow" and maproot:
-            maproot = False
-            users_map = None
-            group_map = None
-        if not self.pid_namespace_available():
-            mountproc = False
-            mountpoint = None
-        if mountproc and mountpoint is None:
-            mountpoint = '/proc'
-        if not self.mount_namespace_available():
-            propagation = None
-
-        if setgroups == "allow" and maproot:
-            raise NamespaceSettingError()
-
-        namespaces = self.adjust_namespaces(namespaces, negative_namespaces)
-
-        all_namespaces = self.namespaces.namespaces
-        unsupported_namespaces = []
-        for ns in namespaces:
-            if ns not in all_namespaces:
-                unsupported_namespaces.append(ns)
-            elif not self._namespace_available(ns):
-                unsupported_namespaces.append(ns)
-        if unsupported_namespaces:
-            raise UnavailableNamespaceFound(unsupported_namespaces)
-
-        require_root_privilege = False
-        if not user_namespace_available():
-            require_root_privilege = True
-        if namespaces and "user" not in namespaces:
-            require_root_privilege = True
-        if ns_bind_dir:
-            require_root_privilege = True
-        if users_map or groups_map:
-            require_root_privilege = True
-        if require_root_privilege:
-            euid = os.geteuid()
-            if euid != 0:
-                raise NamespaceRequireSuperuserPrivilege()
 
-        if mountproc:
-            if self.mount_namespace_available():
-                if "mount" not in namespaces:
-                    namespaces.append("mount")
-            else:
-                raise NamespaceSettingError()
-
-        if maproot:
-            if self.user_namespace_available():
-                if "user" not in namespaces:
-                    namespaces.append("user")
-            else:
-                raise NamespaceSettingError()
-
-        if mount_namespace_available():
-            if "mount" in namespaces and propagation is None:
-                propagation = "private"
-
-        path = "/proc/self/setgroups"
-        if self.user_namespace_available and "user" in namespaces:
-            if os.path.exists(path):
-                if setgroups is None:
-                    setgroups = "deny"
-            elif setgroups == "allow":
-                pass
-            else:
-                setgroups = None
+        return the pid of the child process, the child exits with the exit
+        status of nscmd. stdio could be a list of three file descriptors
+        that will be the stdin/stdout/stderr of nscmd. If keep_mounts is a
+        list of mount points, the other mounts are detached in the new
+        mount namespace, see prune_mounts. If userns is given, e.g., a
+        SharedUserNamespace or a pid, the child joins that user namespace,
+        whose ids are mapped already, instead of making a new one.
+        workspace is a path or a dict of mount_workspace arguments, the
+        scratch area is mounted in the new mount namespace and lazily
+        unmounted when the child exits. If mount_template is given, e.g., a
+        MountTemplate or a pid, the new mount namespace is a copy of its
+        mount namespace.
+        """
+        plan = self.spawn_plan(
+            namespaces=namespaces, maproot=maproot, mountproc=mountproc,
+            mountpoint=mountpoint, ns_bind_dir=ns_bind_dir, nscmd=nscmd,
+            propagation=propagation, negative_namespaces=negative_namespaces,
+            setgroups=setgroups, users_map=users_map, groups_map=groups_map,
+            keep_mounts=keep_mounts, userns=userns, workspace=workspace,
+            mount_template=mount_template)
+        return plan.launch(stdio=stdio)
+
+    def _ns_files_of_target(self, target, namespaces=None):
+        if isinstance(target, basestring):
+            path = target.rstrip("/")
+        elif isinstance(target, int) or isinstance(target, long):
+            path = "/proc/%d/ns" % target
         else:
-            setgroups = None
-
-        if "user" not in namespaces:
-            maproot = False
-            setgroups = None
-            users_map = None
-            groups_map = None
-
-        if "pid" not in namespaces:
-            mountproc = False
-
-        if "mount" not in namespaces:
-             ns_bind_dir = None
-             propagation = None
-             mountproc = False
+            raise TypeError("target should be a pid or a ns_bind_dir")
+        if namespaces is None:
+            namespaces = self.namespaces.namespaces
+        ns_files = []
+        for ns in _ENTER_NAMESPACES_ORDER:
+            if ns not in namespaces:
+                continue
+            ns_obj = getattr(self.namespaces, ns)
+            if not ns_obj.available:
+                continue
+            ns_file = "%s/%s" % (path, ns_obj.entry)
+            if ns == "pid" and os.path.exists("%s_for_children" % ns_file):
+                ns_file = "%s_for_children" % ns_file
+            if os.path.exists(ns_file):
+                ns_files.append((ns, ns_file))
+        if not ns_files:
+            raise NamespaceSettingError("%s: no namespace files found" % path)
+        return ns_files
+
+    def _enter_ns_files(self, ns_files, always=False):
+        """
+        setns(2) into ns_files that the calling thread is not in, or into
+        all of them if always is True, return their names
+        """
+        # namespaces are per thread, /proc/self is the main thread
+        if os.path.exists("/proc/thread-self"):
+            ns_dir = "/proc/thread-self/ns"
+        else:
+            ns_dir = "/proc/self/ns"
+        fds = []
+        for ns, ns_file in ns_files:
+            fd = os.open(ns_file, os.O_RDONLY)
+            entry = getattr(self.namespaces, ns).entry
+            ns_self = "%s/%s" % (ns_dir, entry)
+            if (not always and
+                    os.fstat(fd).st_ino == os.stat(ns_self).st_ino):
+                os.close(fd)
+                continue
+            fds.append((ns, fd))
+        try:
+            for ns, fd in fds:
+                self.setns(fd=fd, namespace=ns)
+        finally:
+            for ns, fd in fds:
+                os.close(fd)
+        return [ns for ns, fd in fds]
+
+    def _enter_and_exec(self, ns_files, nscmd, w):
+        entered_namespaces = self._enter_ns_files(ns_files)
+        if nscmd is None:
+            nscmd = _find_shell()
+        if not isinstance(nscmd, list):
+            nscmd = [nscmd]
+        if "pid" in entered_namespaces:
+            pid = _fork()
+            if pid > 0:
+                os.close(w)
+                pid, status = os.waitpid(pid, 0)
+                os._exit(_exit_status(status))
+        os.execvp(nscmd[0], nscmd)
+
+    def enter_namespaces(self, target, nscmd=None, namespaces=None):
+        """
+        run nscmd in the namespaces of an existed process, e.g.,
+            workbench.enter_namespaces(1234, ["ip", "link"])
+            workbench.enter_namespaces("/tmp/ns", ["ip", "link"])
 
-        r1, w1 = os.pipe()
-        r2, w2 = os.pipe()
+        target is a pid or a ns_bind_dir. Return the pid of the child
+        process, the child exits with the exit status of nscmd.
+        """
+        ns_files = self._ns_files_of_target(target, namespaces)
+        r, w = os.pipe()
+        fcntl.fcntl(w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
         pid = _fork()
-
         if pid == 0:
-            self._run_cmd_in_new_namespaces(
-                r1, w1, r2, w2, namespaces,
-                mountproc, mountpoint, nscmd, propagation)
-        else:
-            self._continue_original_flow(
-                r1, w1, r2, w2, namespaces, ns_bind_dir,
-                setgroups, maproot, users_map, groups_map)
-            def ensure_wait_child_process(pid=pid):
+            os.close(r)
+            try:
+                self._enter_and_exec(ns_files, nscmd, w)
+            except BaseException, e:
                 try:
-                    os.waitpid(pid, 0)
-                except OSError:
-                    pass
-            atexit.register(ensure_wait_child_process)
+                    os.write(w, "%s" % e)
+                finally:
+                    os._exit(127)
+
+        os.close(w)
+        msg = os.read(r, 4096)
+        os.close(r)
+        if msg:
+            os.waitpid(pid, 0)
+            raise NamespaceSettingError("%s: %s" % (target, msg))
+        return pid
+
+    def enter_many_namespaces(self, targets, nscmd=None, namespaces=None,
+                              max_jobs=None):
+        """
+        run nscmd in the namespaces of each target, at most max_jobs in
+        parallel. Return a list of (target, exit status), if we failed to
+        enter the namespaces of a target, the exit status is None.
+        """
+        if max_jobs is None:
+            max_jobs = 16
+        if max_jobs < 1:
+            raise RuntimeError("max_jobs should be a positive number")
+        targets = list(targets)
+        statuses = [None] * len(targets)
+        running = {}
+        poller = select.poll()
+        # milliseconds between waitpid(2) calls when there is no pidfd
+        delay = 1
+        index = 0
+        while index < len(targets) or running:
+            while index < len(targets) and len(running) < max_jobs:
+                try:
+                    pid = self.enter_namespaces(
+                        targets[index], nscmd, namespaces)
+                except (NamespaceGenericException, RuntimeError), e:
+                    sys.stderr.write("%s\n" % e)
+                else:
+                    try:
+                        pidfd = self.pidfd_open(pid)
+                    except (CFunctionNotFound, RuntimeError):
+                        pidfd = None
+                    else:
+                        poller.register(pidfd, select.POLLIN)
+                    running[pid] = (index, pidfd)
+                index += 1
+            if not running:
+                continue
+
+            # only our own children are waited for, waitpid(-1) would
+            # steal the children of other code of the caller
+            exited = []
+            timeout = None
+            for pid, (i, pidfd) in running.items():
+                if pidfd is not None:
+                    continue
+                wpid, status = os.waitpid(pid, os.WNOHANG)
+                if wpid == pid:
+                    exited.append((pid, status))
+                else:
+                    timeout = delay
+            if not exited:
+                for fd, event in _poll(poller, timeout):
+                    for pid, (i, pidfd) in running.items():
+                        if pidfd == fd:
+                            exited.append(os.waitpid(pid, 0))
+            if exited:
+                delay = 1
+            elif timeout is not None:
+                delay = min(delay * 2, 100)
+            for pid, status in exited:
+                i, pidfd = running.pop(pid)
+                statuses[i] = _exit_status(status)
+                if pidfd is not None:
+                    poller.unregister(pidfd)
+                    os.close(pidfd)
+        return zip(targets, statuses)
 
 class CFunctionBaseException(Exception):
     pass
@@ -970,8 +1975,15 @@ class CFunctionUnknowSyscall(CFunctionNotFound):
 workbench = Workbench()
 del Workbench
 
-def atfork(prepare=None, parent=None, child=None):
-    return workbench.atfork(prepare=None, parent=None, child=None)
+def atfork(prepare=None, parent=None, child=None, priority=0):
+    return workbench.atfork(prepare=prepare, parent=parent, child=child,
+                            priority=priority)
+
+def unregister_fork_hook(hook_id):
+    return workbench.unregister_fork_hook(hook_id)
+
+def show_fork_hooks_stats():
+    return workbench.show_fork_hooks_stats()
 
 def sched_getcpu():
     return workbench.sched_getcpu()
@@ -1005,6 +2017,17 @@ def mount(source=None, target=None, mount_type=None,
 def umount(mountpoint=None):
     return workbench.umount(mountpoint)
 
+def prune_mounts(keep_mounts, mountinfo="/proc/self/mountinfo"):
+    return workbench.prune_mounts(keep_mounts, mountinfo)
+
+def fresh_root(keep_mounts, base="/tmp"):
+    return workbench.fresh_root(keep_mounts, base)
+
+def mount_workspace(path, size=None, inodes=None, mode=01777, image=None,
+                    fs_type="ext4", readonly=False):
+    return workbench.mount_workspace(path, size, inodes, mode, image,
+                                     fs_type, readonly)
+
 def umount2(mountpoint=None, behavior=None):
     return workbench.umount2(mountpoint, behavior)
 
@@ -1020,6 +2043,35 @@ def setns(**kwargs):
     """
     return workbench.setns(**kwargs)
 
+def pidfd_open(pid):
+    return workbench.pidfd_open(pid)
+
+def memfd_create(name="procszoo", flags=None):
+    return workbench.memfd_create(name, flags)
+
+def splice(fd_in, fd_out, length, flags=0):
+    return workbench.splice(fd_in, fd_out, length, flags)
+
+def copy_file_range(fd_in, fd_out, length):
+    return workbench.copy_file_range(fd_in, fd_out, length)
+
+def sendfile(fd_out, fd_in, length):
+    return workbench.sendfile(fd_out, fd_in, length)
+
+def send_fds(sock, data, fds=None):
+    return workbench.send_fds(sock, data, fds)
+
+def recv_fds(sock, bufsize=65536, maxfds=16):
+    return workbench.recv_fds(sock, bufsize, maxfds)
+
+def enter_namespaces(target, nscmd=None, namespaces=None):
+    return workbench.enter_namespaces(target, nscmd, namespaces)
+
+def enter_many_namespaces(targets, nscmd=None, namespaces=None,
+                          max_jobs=None):
+    return workbench.enter_many_namespaces(targets, nscmd, namespaces,
+                                           max_jobs)
+
 def gethostname():
     return workbench.gethostname()
 
@@ -1042,12 +2094,35 @@ def spawn_namespaces(namespaces=None, maproot=True, mountproc=True,
                          mountpoint="/proc", ns_bind_dir=None, nscmd=None,
                          propagation=None, negative_namespaces=None,
                          setgroups=None, users_map=None,
-                         groups_map=None):
+                         groups_map=None, stdio=None, keep_mounts=None,
+                         userns=None, workspace=None, mount_template=None):
     return workbench.spawn_namespaces(
         namespaces=namespaces, maproot=maproot, mountproc=mountproc,
         mountpoint=mountpoint, ns_bind_dir=ns_bind_dir, nscmd=nscmd,
         propagation=propagation, negative_namespaces=negative_namespaces,
-        setgroups=setgroups, users_map=users_map, groups_map=groups_map)
+        setgroups=setgroups, users_map=users_map, groups_map=groups_map,
+        stdio=stdio, keep_mounts=keep_mounts, userns=userns,
+        workspace=workspace, mount_template=mount_template)
+
+def spawn_plan(namespaces=None, maproot=True, mountproc=True,
+               mountpoint="/proc", ns_bind_dir=None, nscmd=None,
+               propagation=None, negative_namespaces=None,
+               setgroups=None, users_map=None, groups_map=None,
+               keep_mounts=None, userns=None, workspace=None,
+               mount_template=None):
+    return workbench.spawn_plan(
+        namespaces=namespaces, maproot=maproot, mountproc=mountproc,
+        mountpoint=mountpoint, ns_bind_dir=ns_bind_dir, nscmd=nscmd,
+        propagation=propagation, negative_namespaces=negative_namespaces,
+        setgroups=setgroups, users_map=users_map, groups_map=groups_map,
+        keep_mounts=keep_mounts, userns=userns, workspace=workspace,
+        mount_template=mount_template)
+
+def register_spawn_callback(callback):
+    return workbench.register_spawn_callback(callback)
+
+def unregister_spawn_callback(callback):
+    return workbench.unregister_spawn_callback(callback)
 
 def check_namespaces_available_status():
     return workbench.check_namespaces_available_status()
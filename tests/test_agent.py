@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import *
+from procszoo.agent import SandboxAgent, AgentError
+
+if __name__ == "__main__":
+    count = 100
+    with SandboxAgent(namespaces=["pid", "mount", "uts", "ipc"]) as agent:
+        result = agent.run(["sh", "-c", "echo $$; cat; echo oops >&2"],
+                           input="hello\n")
+        print "pid %d, returncode %d, stdout %r, stderr %r" % (
+            result.pid, result.returncode, result.stdout, result.stderr)
+        result = agent.run(["sh", "-c", "echo $FOO; pwd"],
+                           env={"FOO": "bar"}, cwd="/tmp")
+        print "env and cwd: %r" % result.stdout
+        result = agent.run(["sh", "-c", "exit 3"])
+        print "returncode %d" % result.returncode
+        result = agent.run(["no-such-command"])
+        print "returncode %d, stderr %r" % (result.returncode,
+                                            result.stderr.strip())
+        result = agent.run(["sleep", "10"], timeout=0.2)
+        print "timed out %s, returncode %d, elapsed < 1s %s" % (
+            result.timed_out, result.returncode, result.elapsed < 1)
+        result = agent.run(["sh", "-c", "i=0; while [ $i -lt 100000 ]; "
+                            "do i=$((i+1)); done"])
+        print "rusage: utime > 0 %s, maxrss > 0 %s" % (
+            result.rusage["ru_utime"] > 0, result.rusage["ru_maxrss"] > 0)
+
+        futures = [agent.submit(["sleep", "0.2"]) for i in range(10)]
+        start = time.time()
+        print "10 concurrent commands: %s, in < 1s %s" % (
+            [f.result().returncode for f in futures].count(0),
+            time.time() - start < 1)
+
+        start = time.time()
+        for i in range(count):
+            agent.run(["true"])
+        print "%d commands through the agent: %.3fs" % (
+            count, time.time() - start)
+
+        plan = spawn_plan(namespaces=["pid", "mount", "uts", "ipc"])
+        start = time.time()
+        for i in range(count):
+            os.waitpid(plan.launch(nscmd=["true"]), 0)
+        print "%d sandboxes: %.3fs" % (count, time.time() - start)
+
+        with SandboxAgent(target=agent.pid) as attached:
+            result = attached.run(["readlink", "/proc/self/ns/uts"])
+            print "attached agent in the same uts namespace: %s" % (
+                result.stdout.strip() ==
+                os.readlink("/proc/%d/ns/uts" % agent.pid))
+
+        future = agent.submit(["sleep", "10"])
+    try:
+        future.result()
+    except AgentError, e:
+        print "after stop: %s" % e
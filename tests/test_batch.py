@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import subprocess
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+richard_parker = "%s/bin/richard_parker" % cwd
+
+if __name__ == "__main__":
+    specs = [{"id": i, "namespaces": ["pid", "mount"],
+              "command": ["sh", "-c", "exit %d" % (i % 3)]}
+             for i in range(20)]
+    specs.append({"id": "bad", "unknown_key": True})
+    proc = subprocess.Popen([sys.executable, richard_parker, "--batch", "-",
+                             "-j", "4"], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    out, err = proc.communicate(
+        "".join("%s\n" % json.dumps(spec) for spec in specs))
+    results = [json.loads(line) for line in out.splitlines()]
+    for result in results:
+        print result
+    statuses = dict((result["id"], result.get("status"))
+                    for result in results)
+    print "all statuses are right: %s" % (
+        [statuses[i] for i in range(20)] == [i % 3 for i in range(20)])
+    print "exit status: %d" % proc.returncode
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import workbench
+from procszoo.capture import StdioCollector
+
+if __name__ == "__main__":
+    collector = StdioCollector(buffer_size=64)
+    plan = workbench.spawn_plan()
+    pids = []
+    for i in range(10):
+        nscmd = ["sh", "-c", "echo sandbox %d; echo oops %d >&2" % (i, i)]
+        pids.append(collector.launch(plan, nscmd))
+    pid = collector.spawn(stdio="pty", nscmd=[
+        "sh", "-c", "tty; exec 3</dev/tty && echo controlling terminal"])
+    pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+        collector.wait_eof(pid)
+        print "%d: %r %r" % (pid, collector.output(pid),
+                             collector.output(pid, "stderr")
+                             if "stderr" in collector.streams[pid] else "")
+
+    # other sandboxes closing their streams must not end the wait early
+    slow = collector.spawn(nscmd=["sleep", "0.5"])
+    others = [collector.spawn(nscmd=["true"]) for i in range(5)]
+    start = time.time()
+    print "timed out waiting: %s, after 0.3s: %s" % (
+        not collector.wait_eof(slow, timeout=0.3),
+        time.time() - start >= 0.3)
+    for pid in others:
+        os.waitpid(pid, 0)
+    print "eof after exit: %s" % collector.wait_eof(slow, timeout=5)
+    os.waitpid(slow, 0)
+
+    # a stream forgotten while the reader thread is reading it
+    chunks = []
+    def forget_early(pid, name, data):
+        chunks.append(data)
+        if len(chunks) == 1:
+            forgetful.forget(pid)
+    forgetful = StdioCollector(callback=forget_early)
+    pid = forgetful.spawn(nscmd=["cat", "/dev/zero"])
+    os.waitpid(pid, 0)
+    pid = forgetful.spawn(nscmd=["echo", "still captured"])
+    os.waitpid(pid, 0)
+    time.sleep(0.2)
+    print "reader alive after forget: %s" % forgetful._thread.is_alive()
+    forgetful.stop()
+    collector.stop()
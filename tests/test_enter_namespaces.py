@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import workbench, CFunctionNotFound
+
+if __name__ == "__main__":
+    if "setns" not in workbench.show_available_c_functions():
+        print "setns func unavailable, quit"
+        sys.exit(1)
+
+    pids = []
+    for i in range(4):
+        pids.append(workbench.spawn_namespaces(nscmd=["sleep", "3"]))
+    time.sleep(1)
+
+    pid = workbench.enter_namespaces(pids[0], ["hostname"])
+    os.waitpid(pid, 0)
+
+    for target, status in workbench.enter_many_namespaces(
+            pids, ["sh", "-c", "ls /proc | grep -c '^[0-9]'"], max_jobs=2):
+        print "%s: exit status %s" % (target, status)
+
+    # without pidfds, other children of ours must not be reaped
+    def no_pidfd(pid):
+        raise CFunctionNotFound("pidfd_open")
+    workbench.pidfd_open = no_pidfd
+    other = os.fork()
+    if other == 0:
+        os._exit(7)
+    statuses = workbench.enter_many_namespaces(pids, ["true"], max_jobs=2)
+    del workbench.pidfd_open
+    print "without pidfds: %s" % [status for target, status in statuses]
+    print "other child: exit status %d" % (os.waitpid(other, 0)[1] >> 8)
+
+    for pid in pids:
+        os.waitpid(pid, 0)
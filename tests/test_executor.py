@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import signal
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.executor import NamespacesExecutor, WorkerCrashed, Future, \
+    TimeoutError
+
+def whoami(i):
+    return i, os.getpid(), os.listdir("/sys/class/net")
+
+def crash():
+    os._exit(1)
+
+def die_later():
+    signal.alarm(1)
+    return os.getpid()
+
+if __name__ == "__main__":
+    executor = NamespacesExecutor(max_workers=2, max_tasks_per_worker=3,
+                                  namespaces=["user", "net", "pid"])
+    start = time.time()
+    futures = [executor.submit(whoami, i) for i in range(8)]
+    for future in futures:
+        print "task %d in pid %d, net devices: %s" % future.result()
+    print "8 tasks done in %.3fs" % (time.time() - start)
+
+    try:
+        executor.submit(crash).result()
+    except WorkerCrashed, e:
+        print "crashed: %s" % e
+    print "after crash: %s" % (executor.submit(whoami, 9).result(),)
+    try:
+        executor.submit(int, "x").result()
+    except ValueError, e:
+        print "task raised: %s" % e
+    print list(executor.map(pow, [2, 3], [10, 2]))
+    executor.shutdown()
+
+    # a worker that died between tasks is replaced as well
+    executor = NamespacesExecutor(max_workers=1, namespaces=["user"])
+    executor.submit(die_later).result()
+    time.sleep(1.5)
+    try:
+        executor.submit(whoami, 10).result()
+    except WorkerCrashed, e:
+        print "died between tasks: %s" % e
+    print "after that: %s, crashed workers: %d" % (
+        executor.submit(whoami, 11).result(), executor.crashed_workers)
+    executor.shutdown()
+
+    try:
+        Future().result(timeout=0.01)
+    except TimeoutError, e:
+        print "timeout: %s" % e
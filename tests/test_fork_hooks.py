@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import workbench
+
+if __name__ == "__main__":
+    def hook(name):
+        def _hook():
+            sys.stdout.write("%s in %d\n" % (name, os.getpid()))
+            sys.stdout.flush()
+        return _hook
+
+    def slow_prepare():
+        time.sleep(0.01)
+
+    first = workbench.atfork(prepare=hook("prepare 1"),
+                             parent=hook("parent 1"), child=hook("child 1"))
+    second = workbench.atfork(prepare=hook("prepare 2"),
+                              parent=hook("parent 2"), child=hook("child 2"),
+                              priority=-1)
+    slow = workbench.atfork(prepare=slow_prepare)
+
+    for i in range(2):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        if i == 0:
+            print "unregister hook %d" % first
+            workbench.unregister_fork_hook(first)
+
+    for hook_id, stats in workbench.show_fork_hooks_stats().items():
+        for phase, (calls, total, max_cost, errors) in stats.items():
+            print "hook %d %s: %d calls, %.4fs, max %.4fs, %d errors" % (
+                hook_id, phase, calls, total, max_cost, errors)
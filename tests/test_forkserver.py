@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+import os
+import sys
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.forkserver import ForkServer, ForkServerError
+
+def hello(name):
+    # runs in the forked fork server, the test module is its __main__
+    print "hello from %s, pid %d" % (name, os.getpid())
+    sys.exit(4)
+
+if __name__ == "__main__":
+    server = ForkServer(preload=["json"])
+    server.start()
+    print "fork server started: %d" % server.pid
+
+    for i in range(3):
+        pid, pidfd, fds = server.spawn(
+            nscmd=["echo", "hello from sandbox %d" % i], stdio="pipe")
+        stdin_w, stdout_r, stderr_r = fds
+        os.close(stdin_w)
+        status = server.wait(pid, pidfd)
+        print "pid %d exited with %d, output: %s" % (
+            pid, status, os.read(stdout_r, 4096).strip())
+        for fd in [stdout_r, stderr_r]:
+            os.close(fd)
+        if pidfd is not None:
+            os.close(pidfd)
+
+    pid, pidfd, fds = server.spawn(entry="__main__:hello",
+                                   args=["a python entry"],
+                                   namespaces=["pid"], stdio="pipe")
+    stdin_w, stdout_r, stderr_r = fds
+    os.close(stdin_w)
+    status = server.wait(pid, pidfd)
+    print "entry exited with %d, output: %s" % (
+        status, os.read(stdout_r, 4096).strip())
+    for fd in fds[1:] + [pidfd]:
+        if fd is not None:
+            os.close(fd)
+    try:
+        server.spawn(entry="__main__:no_such_function")
+    except ForkServerError, e:
+        print "bad entry: %s" % e
+
+    server.stop()
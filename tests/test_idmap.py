@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+import os
+import sys
+import tempfile
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import workbench
+from procszoo.idmap import SubordinateIdAllocator
+
+if __name__ == "__main__":
+    tmpdir = tempfile.mkdtemp()
+    subuid = "%s/subuid" % tmpdir
+    subgid = "%s/subgid" % tmpdir
+    for path in subuid, subgid:
+        hdr = open(path, 'w')
+        hdr.write("%d:100000:655360\n" % os.geteuid())
+        hdr.close()
+    state_file = "%s/state.json" % tmpdir
+
+    allocator = SubordinateIdAllocator(state_file=state_file,
+                                       subuid=subuid, subgid=subgid)
+    for i in range(10):
+        allocator.allocate("sandbox-%d" % i)
+    allocator.free("sandbox-3")
+    print "free uids: %s" % allocator.uids.ranges()
+
+    other = SubordinateIdAllocator(state_file=state_file,
+                                   subuid=subuid, subgid=subgid)
+    print "sandbox-10 gets %s" % other.allocate("sandbox-10")
+    print "users map: %s" % other.users_map("sandbox-10")
+
+    # a write of another process within the same mtime tick
+    other.free("sandbox-0")
+    other.free("sandbox-1")
+    mtime = int(os.stat(state_file).st_mtime)
+    os.utime(state_file, (mtime, mtime))
+    allocator.users_map("sandbox-2")
+    uids = other.allocate("sandbox-11")["uid"]
+    os.utime(state_file, (mtime, mtime))
+    print "sandbox-12 and sandbox-11 overlap: %s" % (
+        allocator.allocate("sandbox-12")["uid"] == uids)
+
+    if os.geteuid() == 0:
+        pid = workbench.spawn_namespaces(
+            maproot=False, nscmd=["cat", "/proc/self/uid_map"],
+            users_map=other.users_map("sandbox-10"),
+            groups_map=other.groups_map("sandbox-10"))
+        os.waitpid(pid, 0)
+
+        r, w = os.pipe()
+        pid = workbench.spawn_namespaces(
+            namespaces=["user"], maproot=False, setgroups="allow",
+            stdio=[r, 1, 2],
+            nscmd=["sh", "-c", "read a; cat /proc/self/setgroups"])
+        os.close(r)
+        other.write_maps("sandbox-10", pid, setgroups="deny")
+        os.write(w, "\n")
+        os.close(w)
+        os.waitpid(pid, 0)
+
+    for i in range(13):
+        other.free("sandbox-%d" % i)
+    print "free uids: %s" % other.uids.ranges()
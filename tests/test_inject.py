@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import os
+import sys
+import fcntl
+import time
+import shutil
+import tempfile
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import spawn_namespaces
+from procszoo.inject import FileInjector, inject_files
+
+def progress(stats):
+    if stats["files_done"] == stats["files_total"]:
+        print "progress: %s" % stats
+
+if __name__ == "__main__":
+    src_dir = tempfile.mkdtemp()
+    files = []
+    for i in range(40):
+        path = "%s/file%d" % (src_dir, i)
+        hdr = open(path, "w")
+        hdr.write(os.urandom(1 << 16) * (i + 1))
+        hdr.close()
+        files.append((path, "/run/injected/dir%d/file%d" % (i % 4, i)))
+    files.append(("%s/missing" % src_dir, "/run/injected/missing"))
+
+    pid = spawn_namespaces(
+        namespaces=["user", "mount", "pid"],
+        nscmd=["sh", "-c", "mount -t tmpfs tmpfs /run; sleep 30"])
+    time.sleep(0.5)
+    for via in "setns", "proc_root":
+        start = time.time()
+        results = inject_files(pid, files, via=via, jobs=4,
+                               progress=progress)
+        print "%s: %d files in %.3fs, ways: %s" % (
+            via, len(results), time.time() - start,
+            sorted(set(result.get("way") for result in results)))
+        print "errors: %s" % [result["error"] for result in results
+                              if result["error"]]
+    injector = FileInjector(pid)
+    print injector.inject([(files[3][0], "/run/injected/dir3/file3", 0600)])
+    r, w = os.pipe()
+    for fd in r, w:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    other = spawn_namespaces(stdio=[0, w, 2],
+                             nscmd=["sh", "-c", "ls /proc/$$/fd"])
+    os.close(w)
+    print "fds of a sandbox spawned while injecting: %s" % sorted(
+        os.fdopen(r).read().split())
+    os.waitpid(other, 0)
+    injector.close()
+    os.system("%s/bin/richard_parker -e %d -- sh -c "
+              "'ls /run/injected/dir3 | wc -l; ls -ln /run/injected/dir3/file3;"
+              " md5sum /run/injected/dir3/file3 | cut -c -32'" % (cwd, pid))
+    os.system("md5sum %s | cut -c -32; ls /run/injected 2>&1" % files[3][0])
+    for child in open("/proc/%d/task/%d/children" % (pid, pid)).read().split():
+        os.kill(int(child), 9)
+    os.waitpid(pid, 0)
+    shutil.rmtree(src_dir)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import workbench
+from procszoo.inventory import NamespacesInventory
+
+if __name__ == "__main__":
+    inventory = NamespacesInventory()
+    start = time.time()
+    inventory.scan()
+    print "full scan: %d pids in %.3fs" % (len(inventory.pid_ns),
+                                           time.time() - start)
+    print "namespaces: %s" % inventory.counts()
+
+    pid = workbench.spawn_namespaces(nscmd=["sleep", "2"])
+    time.sleep(1)
+    new_pids, gone_pids = inventory.scan()
+    print "new pids: %s, gone pids: %s" % (sorted(new_pids), sorted(gone_pids))
+    net = inventory.namespaces_of(pid)["net"]
+    print "pids in net namespace %d: %s" % (net, inventory.pids_of("net", net))
+    os.waitpid(pid, 0)
+    print inventory.to_json(with_pids=False)[:200]
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import *
+
+def run(namespaces, keep_mounts):
+    r, w = os.pipe()
+    start = time.time()
+    pid = spawn_namespaces(
+        namespaces=namespaces, keep_mounts=keep_mounts,
+        maproot="user" in namespaces, stdio=[0, w, 2],
+        nscmd=["cut", "-d", " ", "-f", "5", "/proc/self/mountinfo"])
+    os.close(w)
+    mounts = os.fdopen(r).read().split()
+    os.waitpid(pid, 0)
+    return mounts, time.time() - start
+
+if __name__ == "__main__":
+    print "mounts of the host: %d" % len(open("/proc/self/mountinfo")
+                                         .readlines())
+    mounts, elapsed = run(["pid", "mount"], None)
+    print "full tree: %d mounts, %.3fs" % (len(mounts), elapsed)
+    mounts, elapsed = run(["pid", "mount"], ["/", "/dev"])
+    print "pruned tree: %s, %.3fs" % (" ".join(mounts), elapsed)
+
+    if "pivot_root" in show_available_c_functions():
+        mounts, elapsed = run(["user", "mount"],
+                              ["/usr", "/bin", "/lib", "/lib64", "/etc",
+                               "/proc"])
+        print "fresh root in user namespace: %s, %.3fs" % (
+            " ".join(mounts), elapsed)
+        mounts, elapsed = run(["user", "mount"], ["/"])
+        print "whole tree kept in user namespace: %d mounts, %.3fs" % (
+            len(mounts), elapsed)
+    else:
+        print "pivot_root is not available, run ./configure first"
+
+    try:
+        spawn_namespaces(namespaces=["mount"], maproot=False,
+                         propagation="shared", keep_mounts=["/"])
+    except NamespaceSettingError, e:
+        print e
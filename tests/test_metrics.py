@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import fcntl
+import socket
+import resource
+import threading
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import workbench
+from procszoo.metrics import SandboxMetrics
+
+if __name__ == "__main__":
+    address = "/tmp/procszoo-metrics.sock"
+    metrics = SandboxMetrics(interval=0.5, address=address)
+    metrics.start()
+    pid = workbench.spawn_namespaces(
+        nscmd=["sh", "-c", "dd if=/dev/zero of=/dev/null bs=1M count=200; sleep 2"])
+    time.sleep(1.5)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    data = ""
+    while True:
+        buf = sock.recv(4096)
+        if not buf:
+            break
+        data += buf
+    sock.close()
+    print data
+
+    os.waitpid(pid, 0)
+    time.sleep(1)
+    print "tracked sandboxes after exit: %s" % metrics.sandboxes.keys()
+
+    # spawn callbacks run in the threads that spawn
+    pids = []
+    def spawn_some():
+        for i in range(5):
+            pids.append(workbench.spawn_namespaces(nscmd=["sleep", "1"]))
+    threads = [threading.Thread(target=spawn_some) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print "sandboxes spawned from 4 threads, sampled: %d" % len(
+        metrics.sample())
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    r, w = os.pipe()
+    for fd in r, w:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    pid = workbench.spawn_namespaces(
+        stdio=[0, w, 2], nscmd=["sh", "-c", "ls /proc/$$/fd"])
+    os.close(w)
+    print "fds of a sandbox: %s" % sorted(os.fdopen(r).read().split())
+    os.waitpid(pid, 0)
+
+    pid = workbench.spawn_namespaces(
+        nscmd=["sh", "-c", "sleep 1 & sleep 1; wait"])
+    time.sleep(0.2)
+    metrics.stop()
+    metrics.track(pid)
+    limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE,
+                       (len(os.listdir("/proc/self/fd")), limits[1]))
+    try:
+        metrics.sample()
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+    print "tracked when out of fds: %s" % (pid in metrics.sandboxes)
+    os.waitpid(pid, 0)
+    metrics.sample()
+    print "tracked after exit: %s" % (pid in metrics.sandboxes)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import *
+from procszoo.mounttemplate import MountTemplate, MountTemplateError
+
+MOUNTS = 30
+
+def setup():
+    mount(source="none", target="/mnt", filesystemtype="tmpfs")
+    for i in range(MOUNTS):
+        os.mkdir("/mnt/%d" % i)
+        mount(source="none", target="/mnt/%d" % i, filesystemtype="tmpfs",
+              data="size=1m")
+
+def run(count, **kwargs):
+    start = time.time()
+    for i in range(count):
+        pid = spawn_namespaces(namespaces=["mount", "uts"], maproot=False,
+                               nscmd=["true"], **kwargs)
+        os.waitpid(pid, 0)
+    return time.time() - start
+
+def count_mounts(**kwargs):
+    r, w = os.pipe()
+    pid = spawn_namespaces(namespaces=["mount"], maproot=False,
+                           stdio=[0, w, 2], **kwargs)
+    os.close(w)
+    output = os.fdopen(r).read()
+    os.waitpid(pid, 0)
+    return output.strip()
+
+if __name__ == "__main__":
+    if os.geteuid() != 0:
+        print "run it as root, quit"
+        sys.exit(0)
+    count = 20
+    plan = spawn_plan(namespaces=["mount", "uts"], maproot=False)
+    start = time.time()
+    for i in range(count):
+        os.waitpid(plan.launch(target=setup), 0)
+    print "%d sandboxes with %d mounts each: %.3fs" % (
+        count, MOUNTS + 1, time.time() - start)
+
+    with MountTemplate(setup) as template:
+        print "mounts below /mnt in a sandbox: %s" % count_mounts(
+            mount_template=template,
+            nscmd=["sh", "-c", "mount -t tmpfs none /mnt/0; "
+                   "grep -c ' /mnt' /proc/self/mounts"])
+        print "mounts below /mnt in the template: %s" % len(
+            [line for line in open("/proc/%d/mounts" % template.pid)
+             if " /mnt" in line])
+        print "%d sandboxes from the template: %.3fs" % (
+            count, run(count, mount_template=template))
+
+    try:
+        MountTemplate(lambda: mount(source="none", target="/nonexistent",
+                                    filesystemtype="tmpfs")).start()
+    except MountTemplateError, e:
+        print e.args[0].splitlines()[-1]
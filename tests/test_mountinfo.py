@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import tempfile
+import shutil
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import *
+from procszoo.mountinfo import *
+
+if __name__ == "__main__":
+    start = time.time()
+    mounts = read_mountinfo()
+    print "%d mounts parsed in %.6fs" % (len(mounts), time.time() - start)
+    root = [mount for mount in mounts if mount.mount_point == "/"][0]
+    print "/: id %d, %s, %s, %s" % (root.mount_id, root.fs_type,
+                                    root.source, root.propagation)
+
+    r, w = os.pipe()
+    pid = spawn_namespaces(namespaces=["mount"], maproot=False,
+                           propagation="private", stdio=[r, 1, 2],
+                           nscmd=["sh", "-c",
+                                  "read a; mount -t tmpfs none /mnt; "
+                                  "read a; umount /mnt; read a"])
+    os.close(r)
+    sandbox = int(open("/proc/%d/task/%d/children" % (pid, pid))
+                  .read().split()[0])
+    watcher = MountWatcher(sandbox)
+    for i in range(2):
+        os.write(w, "\n")
+        change = watcher.poll(timeout=5)
+        if change is None:
+            break
+        added, removed = change
+        print "added %s, removed %s" % (
+            [(mount.mount_point, mount.fs_type) for mount in added],
+            [(mount.mount_point, mount.fs_type) for mount in removed])
+    watcher.close()
+    os.write(w, "\n")
+    os.close(w)
+    os.waitpid(pid, 0)
+
+    ns_bind_dir = tempfile.mkdtemp()
+    workbench.bind_ns_files(os.getpid(), ["net", "uts"], ns_bind_dir)
+    count = len(MountTable().below(ns_bind_dir))
+    workbench.bind_ns_files(os.getpid(), ["net", "uts"], ns_bind_dir)
+    print "ns bind mounts: %d, after binding again: %d" % (
+        count, len(MountTable().below(ns_bind_dir)))
+    for mount in MountTable().below(ns_bind_dir):
+        umount(mount.mount_point)
+    shutil.rmtree(ns_bind_dir)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import os
+import sys
+import socket
+import time
+import threading
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import *
+from procszoo.netns import NetNamespacePool
+
+def listen(port):
+    os.system("ip link set lo up")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", port))
+    sock.listen(8)
+    return sock
+
+def net_ns():
+    return os.readlink("/proc/thread-self/ns/net")
+
+def submit_from_sandbox(pool, pid, results):
+    # a worker starts in the net namespace of the thread that made it
+    workbench._enter_ns_files([("net", "/proc/%d/ns/net" % pid)])
+    results.append(pool.submit(os.getpid(), net_ns).result())
+
+if __name__ == "__main__":
+    if os.geteuid() != 0:
+        print "joining net namespaces from threads needs root, quit"
+        sys.exit(0)
+    count = 20
+    r, w = os.pipe()
+    pids = []
+    for i in range(count):
+        pids.append(spawn_namespaces(namespaces=["net", "uts"],
+                                     stdio=[r, 1, 2],
+                                     nscmd=["sh", "-c", "read a"]))
+    os.close(r)
+
+    with NetNamespacePool(idle_timeout=5) as pool:
+        start = time.time()
+        futures = pool.map(pids, listen, 9000)
+        listeners = dict((pid, future.result())
+                         for pid, future in futures.items())
+        print "%d listeners on 127.0.0.1:9000 from %d threads, %.3fs" % (
+            len(listeners), pool.namespaces(), time.time() - start)
+
+        pid = pids[0]
+        client = pool.socket(pid).result()
+        client.connect(("127.0.0.1", 9000))
+        conn, addr = listeners[pid].accept()
+        client.sendall("hello")
+        print "received %s in the namespace of %d" % (conn.recv(5), pid)
+        for sock in [client, conn] + listeners.values():
+            sock.close()
+
+        try:
+            pool.submit("/proc/self/ns/net", listen, 0).result()
+            pool.submit(os.getpid(), listen, 9000).result()
+            pool.submit(os.getpid(), listen, 9000).result()
+        except socket.error, e:
+            print "the same namespace: %s" % e
+
+    with NetNamespacePool() as pool:
+        results = []
+        thread = threading.Thread(target=submit_from_sandbox,
+                                  args=(pool, pids[1], results))
+        thread.start()
+        thread.join()
+        print "worker made in a sandbox runs in our namespace: %s" % (
+            results == [os.readlink("/proc/self/ns/net")])
+
+    for pid in pids:
+        os.write(w, "\n")
+    os.close(w)
+    for pid in pids:
+        os.waitpid(pid, 0)
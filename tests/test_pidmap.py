@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import signal
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import spawn_namespaces
+from procszoo.pidmap import PidIndex
+from procszoo.procevents import ProcEventMonitor
+
+if __name__ == "__main__":
+    monitor = ProcEventMonitor()
+    try:
+        monitor.open()
+    except EnvironmentError:
+        monitor = None
+    with PidIndex() as index:
+        print "mode, with another monitor open: %s" % index.mode
+        r, w = os.pipe()
+        pid = spawn_namespaces(
+            namespaces=["pid", "mount"], stdio=[0, w, 2],
+            nscmd=["sh", "-c", "setsid sleep 30 & echo $!; exec sleep 30"])
+        os.close(w)
+        ns_pid = int(os.fdopen(r).readline())
+        time.sleep(0.2)
+        processes = index.processes(pid)
+        print "processes in the sandbox: %s" % sorted(processes)
+        host_pid = index.to_host(pid, ns_pid)
+        print "ns pid %d is host pid %s, back: %s" % (
+            ns_pid, host_pid, index.to_namespace(host_pid) == (pid, ns_pid))
+        print "host pgid of ns pgid %d: %s" % (
+            ns_pid, index.host_pgid(pid, ns_pid) == os.getpgid(host_pid))
+
+        count = 100000
+        start = time.time()
+        for i in range(count):
+            index.to_host(pid, ns_pid)
+        print "%d lookups: %.3fs" % (count, time.time() - start)
+
+        index.kill(pid, ns_pid, signal.SIGKILL)
+        for i in range(50):
+            if index.to_namespace(host_pid) is None:
+                break
+            time.sleep(0.02)
+        print "dropped after exit: %s" % (index.to_namespace(host_pid) is None)
+
+        index.kill(pid, 1, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        for i in range(50):
+            if pid not in index.sandboxes:
+                break
+            time.sleep(0.02)
+        print "sandbox dropped with its init: %s" % (
+            pid not in index.sandboxes)
+    if monitor is not None:
+        monitor.close()
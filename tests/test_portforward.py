@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import socket
+import select
+import hashlib
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import spawn_namespaces
+from procszoo.portforward import PortForwarder
+
+ECHO_SERVER = """
+import socket
+sock = socket.socket()
+sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+sock.bind(("127.0.0.1", 9000))
+sock.listen(8)
+while True:
+    conn, addr = sock.accept()
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        conn.sendall(data)
+    conn.close()
+"""
+
+def echo(address, data):
+    sock = socket.create_connection(address)
+    received = []
+    sent = 0
+    sock.setblocking(0)
+    while True:
+        wanted = [sock]
+        writable = []
+        if sent < len(data):
+            writable = [sock]
+        r, w, x = select.select(wanted, writable, [], 10)
+        if w:
+            try:
+                sent += sock.send(data[sent:sent + 65536])
+            except socket.error:
+                pass
+            if sent == len(data):
+                sock.shutdown(socket.SHUT_WR)
+        if r:
+            chunk = sock.recv(1 << 20)
+            if not chunk:
+                break
+            received.append(chunk)
+    sock.close()
+    return "".join(received)
+
+if __name__ == "__main__":
+    pid = spawn_namespaces(
+        namespaces=["user", "net", "pid", "mount"],
+        nscmd=["sh", "-c", "ip link set lo up; exec python2 -c '%s'"
+               % ECHO_SERVER.replace("'", "\"")])
+    time.sleep(0.5)
+    data = os.urandom(32 << 20)
+    for use_thread in True, False:
+        forwarder = PortForwarder(pid, use_thread=use_thread)
+        address = forwarder.forward(0, 9000)
+        forwarder.start()
+        start = time.time()
+        reply = echo(address, data)
+        print "use_thread=%s: 32MB echoed in %.3fs, same data: %s" % (
+            use_thread, time.time() - start,
+            hashlib.md5(reply).digest() == hashlib.md5(data).digest())
+        time.sleep(0.1)
+        print forwarder.stats()
+        forwarder.stop()
+    for child in open("/proc/%d/task/%d/children" % (pid, pid)).read().split():
+        os.kill(int(child), 9)
+    os.waitpid(pid, 0)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+import os
+import sys
+import fcntl
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import spawn_namespaces
+from procszoo.procevents import ProcEventMonitor
+
+if __name__ == "__main__":
+    monitor = ProcEventMonitor()
+    try:
+        monitor.open()
+    except EnvironmentError, e:
+        print "cannot listen to the process connector: %s" % e
+        sys.exit(0)
+    pid = spawn_namespaces(namespaces=["pid", "mount"],
+                           nscmd=["sh", "-c", "true; /bin/true; exit 3"])
+    os.system("true")
+    events = []
+    for event in monitor.events(timeout=1):
+        events.append(event)
+        print event
+        if event.what == "exit" and event.pid == pid:
+            break
+    os.waitpid(pid, 0)
+    other = ProcEventMonitor(track_spawned=False)
+    other.start(lambda event: None)
+    r, w = os.pipe()
+    for fd in r, w:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    other_pid = spawn_namespaces(stdio=[0, w, 2],
+                                 nscmd=["sh", "-c", "ls /proc/$$/fd"])
+    os.close(w)
+    print "two monitors, fds of a sandbox: %s" % sorted(
+        os.fdopen(r).read().split())
+    os.waitpid(other_pid, 0)
+    other.stop()
+    monitor.close()
+    print "%d events, all in sandbox %d: %s" % (
+        len(events), pid, set(event.sandbox for event in events) == set([pid]))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import tempfile
+import shutil
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import *
+from procszoo.mountinfo import MountTable
+from procszoo.reclaim import *
+
+if __name__ == "__main__":
+    dead_dir = tempfile.mkdtemp()
+    live_dir = tempfile.mkdtemp()
+    pid = spawn_namespaces(namespaces=["net", "uts", "ipc", "mount"],
+                           maproot=False, ns_bind_dir=dead_dir,
+                           nscmd=["true"])
+    os.waitpid(pid, 0)
+    r, w = os.pipe()
+    pid = spawn_namespaces(namespaces=["net", "uts", "ipc", "mount"],
+                           maproot=False, ns_bind_dir=live_dir,
+                           stdio=[r, 1, 2], nscmd=["sh", "-c", "read a"])
+    os.close(r)
+
+    reclaimer = NsBindReclaimer([dead_dir, live_dir], remove_files=True)
+    report = reclaimer.reclaim()
+    print "without processes: %s in %.4fs" % (
+        sorted(report["namespaces"].items()), report["elapsed"])
+    print "left: %s" % [mount.mount_point.replace(live_dir, "live")
+                        for mount in MountTable().below(dead_dir) +
+                        MountTable().below(live_dir)]
+
+    time.sleep(1.1)
+    report = reclaim_ns_binds([dead_dir, live_dir], ttl=1)
+    print "expired: %s" % sorted(set(item["reason"]
+                                     for item in report["detached"]))
+    os.write(w, "\n")
+    os.close(w)
+    os.waitpid(pid, 0)
+    shutil.rmtree(dead_dir)
+    shutil.rmtree(live_dir)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.scheduler import SpawnScheduler, SchedulerBusy
+
+def spawn_burst(scheduler, count):
+    tickets = []
+    for i in range(count):
+        tickets.append(scheduler.submit(
+            priority=count - i, namespaces=["user", "net", "pid"],
+            mountproc=False, nscmd=["sleep", "0.2"]))
+    for ticket in tickets:
+        pid = ticket.wait()
+        os.waitpid(pid, 0)
+    return tickets
+
+if __name__ == "__main__":
+    scheduler = SpawnScheduler(max_running=2)
+    print "limits: %s" % scheduler.limits
+    print "live namespaces on the host: %s" % scheduler.live_namespaces
+    try:
+        scheduler.submit(nscmd=["true"])
+    except SchedulerBusy, e:
+        print "before start: %s" % e
+    scheduler.start()
+    start = time.time()
+    tickets = spawn_burst(scheduler, 6)
+    order = sorted(range(len(tickets)), key=lambda i: tickets[i].started)
+    print "6 sandboxes, 2 at a time, in %.2fs" % (time.time() - start)
+    print "spawn order: %s" % order
+    print "stats: %s" % scheduler.stats()
+    fds_file = tempfile.mktemp()
+    pid = scheduler.submit(namespaces=["pid"], nscmd=[
+        "sh", "-c", "exec > %s; ls /proc/$$/fd" % fds_file]).wait()
+    os.waitpid(pid, 0)
+    print "fds of a sandbox: %s" % sorted(open(fds_file).read().split())
+    os.unlink(fds_file)
+    scheduler.stop()
+
+    proc_sys_user = tempfile.mkdtemp()
+    net_namespaces = scheduler.live_namespaces["net"]
+    open("%s/max_net_namespaces" % proc_sys_user, "w").write(
+        "%d\n" % (net_namespaces + 1))
+    scheduler = SpawnScheduler(max_running=8, max_queue=4, headroom=1.0,
+                               proc_sys_user=proc_sys_user)
+    scheduler.start()
+    start = time.time()
+    spawn_burst(scheduler, 3)
+    print "3 sandboxes with room for one more net namespace in %.2fs" % (
+        time.time() - start)
+    try:
+        for i in range(8):
+            scheduler.submit(block=False, namespaces=["net"],
+                             nscmd=["true"])
+    except SchedulerBusy, e:
+        print "backpressure: %s" % e
+    scheduler.stop()
+    shutil.rmtree(proc_sys_user)
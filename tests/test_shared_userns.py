@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import *
+from procszoo.userns import SharedUserNamespace
+
+def run(count, **kwargs):
+    plan = spawn_plan(namespaces=["user", "mount", "uts", "ipc"],
+                      **kwargs)
+    start = time.time()
+    for i in range(count):
+        os.waitpid(plan.launch(nscmd=["true"]), 0)
+    return time.time() - start
+
+if __name__ == "__main__":
+    count = 50
+    with SharedUserNamespace(maproot=True) as userns:
+        r, w = os.pipe()
+        pid = spawn_namespaces(userns=userns, stdio=[0, w, 2],
+                               nscmd=["sh", "-c",
+                                      "id -u; readlink /proc/self/ns/user"])
+        os.close(w)
+        output = os.fdopen(r).read().split()
+        os.waitpid(pid, 0)
+        print "uid %s, in the shared user namespace: %s" % (
+            output[0], output[1] == os.readlink(userns.ns_file))
+
+        elapsed = run(count)
+        print "%d sandboxes with new user namespaces: %.3fs" % (count,
+                                                                elapsed)
+        elapsed = run(count, userns=userns)
+        print "%d sandboxes in a shared user namespace: %.3fs" % (count,
+                                                                 elapsed)
+    try:
+        spawn_plan(userns=os.getpid(), users_map=["1 1 1"])
+    except NamespaceSettingError, e:
+        print e
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+import os
+import sys
+import socket
+import mmap
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import spawn_plan
+from procszoo.sharedbuffer import *
+
+if __name__ == "__main__":
+    data = "procszoo" * (1 << 17)
+    inputs = create_shared_buffer(data=data)
+    inputs.seal()
+    print "input: %d bytes, readonly: %s" % (inputs.size, inputs.readonly)
+    try:
+        mmap.mmap(inputs.fd, inputs.size, mmap.MAP_SHARED,
+                  mmap.PROT_READ | mmap.PROT_WRITE)
+    except EnvironmentError, e:
+        print "writable mapping is refused: %s" % os.strerror(e.errno)
+
+    results = create_shared_buffer(size=64)
+    results.seal(write=False)
+    parent_sock, child_sock = socket.socketpair(socket.AF_UNIX,
+                                                socket.SOCK_SEQPACKET)
+
+    def worker():
+        buf, meta = receive_shared_buffer(child_sock, readonly=True)
+        count = str(buf.view()).count("zoo")
+        results.write("%d %s" % (count, str(meta["name"])))
+        reply = create_shared_buffer(data="pid %d in the sandbox" % os.getpid())
+        reply.seal()
+        reply.send(child_sock)
+
+    inputs.inherit()
+    results.inherit()
+    plan = spawn_plan(namespaces=["user", "pid", "mount"], mountproc=False)
+    pid = plan.launch(target=worker)
+    child_sock.close()
+    inputs.send(parent_sock, {"name": "inputs"})
+    reply, meta = receive_shared_buffer(parent_sock, readonly=True)
+    os.waitpid(pid, 0)
+    print "results: %s" % str(results.view()).rstrip("\0")
+    print "reply: %s" % str(reply.view())
+    for buf in inputs, results, reply:
+        buf.close()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import atexit
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+import procszoo.utils
+from procszoo.utils import *
+
+def output(plan, nscmd):
+    r, w = os.pipe()
+    pid = plan.launch(nscmd=nscmd, stdio=[0, w, 2])
+    os.close(w)
+    data = os.fdopen(r).read().split()
+    pid, status = os.waitpid(pid, 0)
+    return data, status >> 8
+
+if __name__ == "__main__":
+    plans = {
+        "user": spawn_plan(namespaces=["user", "pid", "uts"]),
+        "net": spawn_plan(namespaces=["pid", "net", "mount"],
+                          maproot=False),
+        "ipc": spawn_plan(namespaces=["ipc"], maproot=False,
+                          mountproc=False, nscmd=["sh", "-c", "exit 5"]),
+    }
+    for name in sorted(plans):
+        plan = plans[name]
+        print "%s plan: namespaces %s, waits for us: %s" % (
+            name, ",".join(sorted(plan.namespaces)), plan.needs_parent)
+
+    for i in range(3):
+        data, status = output(plans["user"],
+                              ["sh", "-c", "id -u; echo $$; hostname %d; "
+                               "hostname" % i])
+        print "user plan, launch %d: uid %s, pid %s, hostname %s" % (
+            i, data[0], data[1], data[2])
+    data, status = output(plans["net"], ["sh", "-c", "tail -n +3 "
+                                         "/proc/net/dev | cut -d: -f1"])
+    print "net plan: %s" % " ".join(data)
+    data, status = output(plans["ipc"], None)
+    print "ipc plan with its own nscmd: exit status %d" % status
+    data, status = output(plans["user"], ["ls", "-d", "/"])
+    print "nscmd options are not taken by my_init: %s" % data
+    pid = plans["user"].launch(target=lambda: sys.exit(3))
+    print "target: exit status %d" % (os.waitpid(pid, 0)[1] >> 8)
+
+    count = 50
+    handlers = len(atexit._exithandlers)
+    start = time.time()
+    for i in range(count):
+        os.waitpid(plans["user"].launch(nscmd=["true"]), 0)
+    print "%d launches of a plan: %.3fs" % (count, time.time() - start)
+    start = time.time()
+    for i in range(count):
+        os.waitpid(spawn_namespaces(namespaces=["user", "pid", "uts"],
+                                    nscmd=["true"]), 0)
+    print "%d spawn_namespaces: %.3fs" % (count, time.time() - start)
+    print "atexit handlers added by %d launches: %d" % (
+        2 * count, len(atexit._exithandlers) - handlers)
+    print "children to wait for at exit: %d" % len(
+        procszoo.utils._SPAWNED_PIDS)
+
+    try:
+        spawn_plan(namespaces=["user"], setgroups="bogus")
+    except RuntimeError, e:
+        print e
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import tempfile
+import shutil
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import *
+from procszoo.mountinfo import MountTable
+from procszoo.teardown import TeardownQueue, TeardownBusy
+
+if __name__ == "__main__":
+    count = 20
+    base = tempfile.mkdtemp()
+    sandboxes = []
+    for i in range(count):
+        ns_bind_dir = "%s/%d" % (base, i)
+        os.mkdir(ns_bind_dir)
+        pid = spawn_namespaces(namespaces=["pid", "net", "uts", "mount"],
+                               maproot=False, ns_bind_dir=ns_bind_dir,
+                               nscmd=["sleep", "600"])
+        sandboxes.append((pid, ns_bind_dir))
+    print "bound files: %d" % len(MountTable().below(base))
+
+    teardown = TeardownQueue(batch_size=8)
+    teardown.start()
+    start = time.time()
+    tickets = [teardown.defer(pid, ns_bind_dir=ns_bind_dir)
+               for pid, ns_bind_dir in sandboxes]
+    print "%d teardowns queued in %.4fs" % (count, time.time() - start)
+    for ticket in tickets:
+        ticket.wait()
+    stats = teardown.stats()
+    print "done %d, failed %d, batches %d, max latency %.3fs" % (
+        stats["done"], stats["failed"], stats["batches"],
+        stats["max_latency"])
+    print "bound files: %d, sandboxes alive: %d" % (
+        len(MountTable().below(base)),
+        len([pid for pid, d in sandboxes if os.path.exists("/proc/%d" % pid)]))
+    teardown.stop()
+
+    teardown = TeardownQueue(max_queue=1)
+    teardown.defer()
+    try:
+        teardown.defer(block=False)
+    except TeardownBusy, e:
+        print e
+    teardown.start()
+    teardown.stop()
+    shutil.rmtree(base)
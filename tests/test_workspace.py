@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+cwd = os.path.abspath("%s/.." % os.path.dirname(os.path.abspath(__file__)))
+sys.path.append("%s" % cwd)
+from procszoo.utils import *
+
+def run(workspace, cmd, namespaces=["mount"]):
+    r, w = os.pipe()
+    pid = spawn_namespaces(namespaces=namespaces, maproot=False,
+                           workspace=workspace, stdio=[0, w, 2],
+                           nscmd=["sh", "-c", cmd])
+    os.close(w)
+    output = os.fdopen(r).read().strip()
+    pid, status = os.waitpid(pid, 0)
+    return output
+
+if __name__ == "__main__":
+    files = 20000
+    scratch = tempfile.mkdtemp()
+    cmd = ("cd %s && i=0; while [ $i -lt %d ]; do printf '' > f$i; "
+           "i=$((i+1)); done 2>/dev/null; ls | wc -l; "
+           "df -i . | tail -1 | tr -s ' ' | cut -d ' ' -f 2" % (scratch, files))
+    start = time.time()
+    output = run({"path": scratch, "size": "64m", "inodes": 5000}, cmd)
+    print "files and inodes in a 5000 inodes workspace: %s, %.3fs" % (
+        " ".join(output.split()), time.time() - start)
+    print "files left on the host: %d" % len(os.listdir(scratch))
+    os.rmdir(scratch)
+
+    image_dir = tempfile.mkdtemp()
+    image = "%s/workspace.img" % image_dir
+    status = os.system("truncate -s 32m %s && mkfs.ext4 -q -F %s"
+                       % (image, image))
+    if status == 0 and os.path.exists("/dev/loop-control"):
+        output = run({"path": "/mnt", "image": image},
+                     "echo hello > /mnt/hello; "
+                     "grep ' /mnt ' /proc/self/mounts | cut -d ' ' -f 3")
+        print "image workspace: %s" % output
+        loops = os.popen("losetup -j %s" % image).read().strip()
+        print "loop devices left: %d" % len(loops.splitlines())
+    shutil.rmtree(image_dir)
+
+    try:
+        spawn_plan(namespaces=["mount"], propagation="shared",
+                   workspace="/mnt")
+    except NamespaceSettingError, e:
+        print e
+
+    # a failed setup in the sandbox must not return into our stack
+    me = os.getpid()
+    pid = spawn_namespaces(namespaces=["pid", "mount"], maproot=False,
+                           workspace={"path": "/mnt", "size": "bogus"},
+                           nscmd=["true"])
+    if os.getpid() != me:
+        os._exit(0)
+    print "bad workspace, exit status %d" % (os.waitpid(pid, 0)[1] >> 8)